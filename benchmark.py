@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from hydra.experimental import compose, initialize
+
+from common.data import to_channels_last
+from common.utils import MAX_GRADES, METADATA_FIELDS, update_max_grades
+from models import create_model
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+METADATA_LEVELS = {'AGE': 4, 'WOMAC': 4, 'BMI': 4, 'SEX': 2, 'INJ': 2, 'SURG': 2}
+
+
+def create_inputs(cfg, batch_size, img_size=256):
+    """Random inputs in the format of `train.prepare_batch`."""
+    input = {}
+    codes = []
+    for name in cfg.parser.metadata:
+        if name == "IMG":
+            input['IMG'] = torch.randn(batch_size, 3, img_size, img_size)
+        elif name in METADATA_FIELDS:
+            n_levels = cfg.n_pn_classes if name == cfg.grading else METADATA_LEVELS[name]
+            code = torch.randint(n_levels, (batch_size,))
+            input[name] = torch.nn.functional.one_hot(code, n_levels).float()
+            codes.append(code)
+    if len(codes) > 0:
+        input['META_CODES'] = torch.stack(codes, 1)
+    input['label_len'] = torch.tensor([cfg.seq_len] * batch_size, dtype=torch.int32)
+    return {k: v.to(device) for k, v in input.items()}
+
+
+def sum_outputs(outputs):
+    if isinstance(outputs, (tuple, list)):
+        return sum([sum_outputs(o) for o in outputs if isinstance(o, (torch.Tensor, tuple, list))])
+    return outputs.float().mean()
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def measure(model, input, n_iters, n_warmup, train):
+    """Seconds per forward pass, or per forward, backward and optimizer step if `train`."""
+    model.train(train)
+    for i in range(n_warmup + n_iters):
+        if i == n_warmup:
+            synchronize()
+            start = time.time()
+        if train:
+            with model.amp.autocast():
+                loss = sum_outputs(model(input))
+            model.optimizer.zero_grad()
+            model.amp.backward(loss)
+            model.amp.step(model.optimizer)
+        else:
+            with torch.no_grad(), model.amp.autocast():
+                model(input)
+    synchronize()
+    return (time.time() - start) / n_iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of a model config for several settings.")
+    parser.add_argument("--token_keep_rates", type=float, nargs="+", default=[1.0, 0.75, 0.5, 0.25])
+    parser.add_argument("--bs", type=int, default=32)
+    parser.add_argument("--n_iters", type=int, default=20)
+    parser.add_argument("--n_warmup", type=int, default=5)
+    parser.add_argument("--train", action="store_true", help="Measure training steps instead of inference.")
+    parser.add_argument("--memory_formats", nargs="+", default=["contiguous"], choices=["contiguous", "channels_last"],
+                        help="Memory formats of the backbone and its inputs.")
+    parser.add_argument("overrides", nargs="*", help="Overrides of configs/config_train.yaml, e.g. config=...")
+    args = parser.parse_args()
+
+    initialize(config_path="configs")
+    cfg = compose(config_name="config_train", overrides=args.overrides)
+    if cfg.method_name in ["gru", "lstm"]:
+        raise ValueError('The recurrent models need targets for teacher forcing and are not supported.')
+    update_max_grades(cfg)
+    input = create_inputs(cfg, args.bs)
+
+    mode = "train" if args.train else "eval"
+    print(f'{cfg.method_name} {mode} on {device} ({torch.get_num_threads()} threads), batch size {args.bs}, '
+          f'grading {cfg.grading} ({MAX_GRADES[cfg.grading] + 1} grades)')
+    print(f'{"memory_format":>14} {"token_keep_rate":>16} {"tokens":>8} {"ms/batch":>10} {"samples/s":>10} '
+          f'{"peak MB":>9}')
+    for memory_format in args.memory_formats:
+        cfg.channels_last = memory_format == "channels_last"
+        # As produced by the loaders
+        format_input = to_channels_last(input) if cfg.channels_last else input
+        for token_keep_rate in args.token_keep_rates:
+            cfg.token_keep_rate = token_keep_rate
+            torch.manual_seed(0)
+            np.random.seed(0)
+            model = create_model(cfg, device)
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            seconds = measure(model, format_input, args.n_iters, args.n_warmup, args.train)
+            peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else float("nan")
+            n_tokens = getattr(model, "n_kept_patches", "-")
+            print(f'{memory_format:>14} {token_keep_rate:>16.2f} {n_tokens:>8} {seconds * 1000:>10.1f} '
+                  f'{args.bs / seconds:>10.1f} {peak_mb:>9.0f}')
+            del model
+
+
+if __name__ == "__main__":
+    main()
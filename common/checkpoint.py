@@ -0,0 +1,240 @@
+import copy
+import hashlib
+import inspect
+import logging as log
+import os
+import queue
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+# Not a `.pth` file, so that the model search of `eval.py` skips it
+TRAINING_STATE_FILENAME = "training_state.ckpt"
+# Name in runs written before, which can still be resumed
+LEGACY_TRAINING_STATE_FILENAME = "training_state.pth"
+# The training state holds numpy and python RNG states, which pytorch>=2.6 does not unpickle by default
+_LOAD_KWARGS = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+
+
+def snapshot(obj):
+    """Copies the tensors of a (nested) state to CPU memory, so that training can continue while it is written."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    elif isinstance(obj, list):
+        return [snapshot(value) for value in obj]
+    elif isinstance(obj, tuple):
+        return tuple(snapshot(value) for value in obj)
+    else:
+        return copy.deepcopy(obj)
+
+
+def atomic_save(obj, filename):
+    """Writes to a temporary file first, so that a preempted write never leaves a truncated `filename`."""
+    tmp_filename = f"{filename}.tmp"
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def remove_file(filename):
+    if os.path.isfile(filename) or os.path.islink(filename):
+        os.remove(filename)
+
+
+def link_file(src, dst):
+    """Points `dst` to `src` with a hardlink, or a relative symlink or a copy where hardlinks are not supported."""
+    tmp_dst = f"{dst}.tmp"
+    remove_file(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(src, os.path.dirname(os.path.abspath(dst))), tmp_dst)
+        except OSError:
+            shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def hash_state_dict(state_dict):
+    """Hashes the names, dtypes, shapes and contents of the tensors of a state dict."""
+    h = hashlib.sha1()
+    for key, value in state_dict.items():
+        h.update(key.encode())
+        if isinstance(value, torch.Tensor):
+            value = value.detach().to('cpu').contiguous()
+            h.update(f"{value.dtype}{tuple(value.shape)}".encode())
+            if value.dtype == torch.bfloat16:
+                value = value.view(torch.int16)
+            h.update(value.numpy().reshape(-1).view(np.uint8))
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread.
+
+    :meth:`save` copies the tensors to CPU memory on the calling thread and returns, while serialization and disk
+    writes happen on the writer thread. Requests are processed in order, so a removal queued after a save of the
+    same file removes the new file.
+
+    Parameters
+    ----------
+    max_pending : int, optional
+        Number of queued requests before :meth:`save` blocks, which bounds the memory of in-flight snapshots.
+        (the default is 4)
+    """
+
+    def __init__(self, max_pending=4):
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, name="checkpoint_writer", daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            request = self.__queue.get()
+            try:
+                if request is None:
+                    return
+                function, args = request
+                function(*args)
+            except Exception as e:
+                log.error(f'Failed writing checkpoint: {e}')
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def __check_error(self):
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise error
+
+    def submit(self, function, *args):
+        """Runs `function(*args)` on the writer thread after the requests queued before."""
+        self.__check_error()
+        self.__queue.put((function, args))
+
+    def save(self, obj, filename):
+        self.submit(atomic_save, snapshot(obj), filename)
+
+    def remove(self, filename):
+        self.submit(remove_file, filename)
+
+    def flush(self):
+        """Blocks until all queued requests are written."""
+        self.__queue.join()
+        self.__check_error()
+
+    def close(self):
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+        self.__check_error()
+
+
+class BlobStore(object):
+    """Content-addressed storage of model weights in `<root>/blobs/<sha1>.pt`.
+
+    Within an epoch, every selection metric stores the same weights, so they are copied and hashed once per epoch
+    and written once per content. The files of :meth:`store` are hardlinks to the blob, and blobs without links
+    left are removed by :meth:`collect_garbage`.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the stored models.
+    writer : CheckpointWriter, optional
+        Writes blobs and links off the training thread when given. (the default is None)
+    """
+
+    def __init__(self, root, writer=None):
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.writer = writer
+        self.__epoch = None
+        self.__state = None
+        self.__blob = {}
+
+    def store(self, state_dict, filename, epoch_i):
+        if epoch_i != self.__epoch:
+            self.__epoch = epoch_i
+            self.__state = snapshot(state_dict) if self.writer is not None else state_dict
+            # Filled by the first store of the epoch, on the thread that writes
+            self.__blob = {}
+        if self.writer is not None:
+            self.writer.submit(self._store, self.__state, self.__blob, filename)
+        else:
+            self._store(self.__state, self.__blob, filename)
+
+    def _store(self, state_dict, blob, filename):
+        if 'fullname' not in blob:
+            blob['fullname'] = os.path.join(self.blob_dir, f"{hash_state_dict(state_dict)}.pt")
+            if not os.path.isfile(blob['fullname']):
+                atomic_save(state_dict, blob['fullname'])
+        link_file(blob['fullname'], filename)
+
+    def collect_garbage(self):
+        if self.writer is not None:
+            self.writer.submit(self._collect_garbage)
+        else:
+            self._collect_garbage()
+
+    def _collect_garbage(self):
+        root = os.path.dirname(self.blob_dir)
+        # Blobs referenced by symlinks, where hardlinks are not supported
+        linked = set()
+        for filename in os.listdir(root):
+            fullname = os.path.join(root, filename)
+            if os.path.islink(fullname):
+                linked.add(os.path.realpath(fullname))
+
+        for filename in os.listdir(self.blob_dir):
+            fullname = os.path.join(self.blob_dir, filename)
+            if not filename.endswith(".pt") or fullname == self.__blob.get('fullname'):
+                continue
+            if os.stat(fullname).st_nlink <= 1 and os.path.realpath(fullname) not in linked:
+                os.remove(fullname)
+
+
+def get_rng_states():
+    states = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def get_training_state(model, epoch_i, stored_models):
+    """Everything needed to resume training after epoch `epoch_i`.
+
+    Loaders restart from the beginning of the next epoch, and their shuffling follows from the restored RNG states.
+    """
+    return {'epoch': epoch_i,
+            'model': model.state_dict(),
+            'optimizer': model.optimizer.state_dict(),
+            'amp': model.amp.state_dict(),
+            'stored_models': stored_models,
+            'rng': get_rng_states()}
+
+
+def load_training_state(filename, model, restore_rng=True):
+    """Restores the model, optimizer and RNG states, and returns the saved state."""
+    state = torch.load(filename, map_location='cpu', **_LOAD_KWARGS)
+    model.load_state_dict(state['model'], strict=True)
+    model.optimizer.load_state_dict(state['optimizer'])
+    model.amp.load_state_dict(state['amp'])
+    if restore_rng:
+        set_rng_states(state['rng'])
+    return state
@@ -4,6 +4,7 @@ import torch
 import pandas as pd
 from sklearn import model_selection
 from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import Sampler
 try:  # Handling API difference between pytorch 1.1 and 1.2
     from torch.utils.data.dataloader import default_collate
@@ -11,6 +12,23 @@ except ImportError:
     from torch.utils.data._utils.collate import default_collate
 
 
+def to_channels_last(x):
+    """Converts the 4D tensors of a (nested) batch to the channels-last memory format."""
+    if isinstance(x, torch.Tensor):
+        return x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x
+    elif isinstance(x, dict):
+        return {k: to_channels_last(v) for k, v in x.items()}
+    elif isinstance(x, (list, tuple)):
+        return type(x)([to_channels_last(v) for v in x])
+    return x
+
+
+def channels_last_collate(batch):
+    """Like `default_collate`, but with image batches in the channels-last memory format. In multi-process loading,
+    the conversion runs in the workers instead of the training loop."""
+    return to_channels_last(default_collate(batch))
+
+
 class Splitter(object):
     def __init__(self):
         self.__ds_chunks = None
@@ -147,6 +165,104 @@ class DataFrameDataset(Dataset):
         return len(self.meta_data.index)
 
 
+class DistributedEvalSampler(Sampler):
+    """Splits the dataset over ranks in order and without padding, so that every sample is evaluated exactly once.
+
+    Ranks may get one sample less than others, which is fine as long as no collective runs per batch.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+
+class LossImportanceSampler(Sampler):
+    """Draws samples with replacement, with probabilities that grow with their running loss.
+
+    Losses are kept per item `ID` as exponential moving averages, updated with :meth:`update`. Items never seen get
+    the largest known loss, so that all items are visited early. The probabilities of an epoch are fixed when its
+    iterator is created, and :meth:`get_weights` returns the importance weights `1 / (N p_i)` that make the
+    weighted loss an unbiased estimate of the loss under uniform sampling.
+
+    Parameters
+    ----------
+    IDs : list
+        `ID` of each item of the dataset, in order.
+    num_samples : int, optional
+        Number of samples per epoch. (the default is None, the size of the dataset)
+    momentum : float, optional
+        Momentum of the running losses. (the default is 0.9)
+    power : float, optional
+        Exponent applied to the running losses. (the default is 1.0)
+    smoothing : float, optional
+        Share of the uniform distribution mixed in, which bounds the weights by `1 / smoothing`.
+        (the default is 0.1)
+    seed : int, optional
+        Seed of the draws, offset by the epoch. (the default is 0)
+    """
+
+    def __init__(self, IDs, num_samples=None, momentum=0.9, power=1.0, smoothing=0.1, seed=0):
+        self.IDs = list(IDs)
+        self.ID2index = {ID: i for i, ID in enumerate(self.IDs)}
+        self.num_samples = len(self.IDs) if num_samples is None else num_samples
+        self.momentum = momentum
+        self.power = power
+        self.smoothing = smoothing
+        self.seed = seed
+        self.epoch = 0
+        self.losses = np.full(len(self.IDs), np.nan)
+        self.probs = np.full(len(self.IDs), 1.0 / len(self.IDs))
+
+    def update(self, IDs, losses):
+        for ID, loss in zip(IDs, losses):
+            i = self.ID2index.get(ID)
+            if i is None or not np.isfinite(loss):
+                continue
+            if np.isnan(self.losses[i]):
+                self.losses[i] = loss
+            else:
+                self.losses[i] = self.momentum * self.losses[i] + (1.0 - self.momentum) * loss
+
+    def compute_probs(self):
+        seen = ~np.isnan(self.losses)
+        n = len(self.losses)
+        if not seen.any():
+            return np.full(n, 1.0 / n)
+        losses = np.where(seen, self.losses, self.losses[seen].max())
+        scores = np.maximum(losses, 1e-7) ** self.power
+        return (1.0 - self.smoothing) * scores / scores.sum() + self.smoothing / n
+
+    def get_weights(self, IDs):
+        n = len(self.IDs)
+        return np.array([1.0 / (n * self.probs[self.ID2index[ID]]) if ID in self.ID2index else 1.0 for ID in IDs],
+                        dtype=np.float32)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        self.probs = self.compute_probs()
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(torch.from_numpy(self.probs), self.num_samples, replacement=True,
+                                    generator=generator)
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
 class ItemLoader(object):
     """Combines DataFrameDataset and DataLoader, and provides single- or multi-process iterators over the dataset.
 
@@ -187,6 +303,12 @@ class ItemLoader(object):
     timeout : int, optional
         If positive, the timeout value for collecting a batch from workers.
         If ``0``, ignores ``timeout`` notion. Must be non-negative. (the default is 0)
+    distributed : bool, optional
+        Set to ``True`` to load only the shard of the current rank of ``torch.distributed``. With ``shuffle``,
+        shards are reshuffled by :meth:`set_epoch` and padded to the same length, otherwise every sample is
+        loaded exactly once. (the default is False)
+    seed : int, optional
+        Seed of the distributed shuffling, which must be the same on all ranks. (the default is 0)
     """
 
     def __init__(self, meta_data: pd.DataFrame or None = None,
@@ -196,7 +318,7 @@ class ItemLoader(object):
                  collate_fn: callable = default_collate, transform: callable or None = None,
                  sampler: Sampler or None = None,
                  batch_sampler=None, drop_last: bool = False, timeout: int = 0, name: str = "",
-                 worker_init_fn=None):
+                 worker_init_fn=None, distributed: bool = False, seed: int = 0):
         if root is None:
             root = ''
 
@@ -211,6 +333,9 @@ class ItemLoader(object):
         self.__pin_memory = pin_memory
         self.__timeout = timeout
         self.__worker_init_fn = worker_init_fn
+        self.__distributed = distributed
+        self.__seed = seed
+        self.__epoch = 0
 
         self.__transform = transform
         self.drop_last: bool = drop_last
@@ -252,10 +377,18 @@ class ItemLoader(object):
         if self.__dataset is None:
             self.__data_loader = None
         else:
+            sampler, shuffle = self.__sampler, self.__shuffle
+            if self.__distributed and sampler is None and self.__batch_sampler is None:
+                if shuffle:
+                    sampler = DistributedSampler(self.__dataset, shuffle=True, seed=self.__seed)
+                    sampler.set_epoch(self.__epoch)
+                else:
+                    sampler = DistributedEvalSampler(self.__dataset)
+                shuffle = False
             self.__data_loader = torch.utils.data.DataLoader(dataset=self.__dataset,
                                                              batch_size=self.batch_size,
-                                                             shuffle=self.__shuffle,
-                                                             sampler=self.__sampler,
+                                                             shuffle=shuffle,
+                                                             sampler=sampler,
                                                              batch_sampler=self.__batch_sampler,
                                                              num_workers=self.__num_workers,
                                                              collate_fn=self.__collate_fn,
@@ -268,6 +401,16 @@ class ItemLoader(object):
     def transform(self):
         return self.__transform
 
+    def set_transform(self, transform):
+        """Replaces the transform, e.g. to change the input size, from the next sampled batch on."""
+        self.__transform = transform
+        self.__iter_loader = None
+        self.update_dataset(self.__meta_data)
+
+    @property
+    def sampler(self):
+        return self.__sampler
+
     def __len__(self):
         """ Get length of the dataloader.
         """
@@ -303,4 +446,151 @@ class ItemLoader(object):
         return samples
 
     def set_epoch(self, epoch):
-        pass
+        self.__epoch = epoch
+        if self.__data_loader is not None and hasattr(self.__data_loader.sampler, "set_epoch"):
+            self.__data_loader.sampler.set_epoch(epoch)
+
+
+class TensorItemLoader(object):
+    """Holds a whole dataset in tensors, and makes mini-batches by indexing them in the main process.
+
+    Every row of `meta_data` is parsed once, and all items are collated into a single batch. Mini-batches are then
+    gathered from it, without workers and per-sample parsing or collation. This suits datasets that fit in memory
+    and whose items have no random transforms, e.g. metadata or cached image features. The interface follows
+    :class:`ItemLoader`.
+
+    Parameters
+    ----------
+    meta_data : pandas.DataFrame
+        Meta data of data and labels.
+    parse_item_cb : callable
+        Parses each row of :attr:`meta_data`.
+    parser_kwargs : dict, optional
+        Dict of args for :attr:`parse_item_cb`. (the default is None)
+    root : str, optional
+        Path to root directory of input data. (the default is None)
+    batch_size : int, optional
+        How many data per batch to load. (the default is 1)
+    num_workers : int, optional
+        How many subprocesses parse the dataset once. (the default is 0)
+    shuffle : bool, optional
+        Set to ``True`` to have the data reshuffled at every epoch. (the default is False)
+    collate_fn : callable, optional
+        Merges a list of samples to form a mini-batch. (the default is `default_collate`)
+    transform : callable, optional
+        Transforms row of :attr:`meta_data`, once. (the default is None)
+    sampler : Sampler, optional
+        Defines the strategy to draw samples from the dataset. If specified, ``shuffle`` must be False.
+        (the default is None)
+    drop_last : bool, optional
+        Set to ``True`` to drop the last incomplete batch. (the default is False)
+    name : str, optional
+        Name given to the batches. (the default is "")
+    distributed : bool, optional
+        Set to ``True`` to load only the shard of the current rank, as in :class:`ItemLoader`.
+        (the default is False)
+    seed : int, optional
+        Seed of the distributed shuffling, which must be the same on all ranks. (the default is 0)
+    """
+
+    def __init__(self, meta_data: pd.DataFrame, parse_item_cb: callable, parser_kwargs: dict or None = None,
+                 root: str or None = None, batch_size: int = 1, num_workers: int = 0, shuffle: bool = False,
+                 collate_fn: callable = default_collate, transform: callable or None = None,
+                 sampler: Sampler or None = None, drop_last: bool = False, name: str = "",
+                 distributed: bool = False, seed: int = 0):
+        self.__name = name
+        self.__shuffle = shuffle
+        self.__sampler = sampler
+        self.drop_last: bool = drop_last
+        self.batch_size: int = batch_size
+        self.__order = None
+        self.__pos = 0
+
+        dataset = DataFrameDataset('' if root is None else root, meta_data=meta_data, parse_item_cb=parse_item_cb,
+                                   transform=transform, parser_kwargs=parser_kwargs)
+        self.__n_items = len(dataset)
+        chunks = torch.utils.data.DataLoader(dataset, batch_size=max(batch_size, 256), shuffle=False,
+                                             num_workers=num_workers, collate_fn=collate_fn)
+        self.__data = self._concat(list(chunks))
+
+        self.__index_sampler = sampler
+        if distributed and sampler is None:
+            # Samplers only need the length of the dataset
+            if shuffle:
+                self.__index_sampler = DistributedSampler(range(self.__n_items), shuffle=True, seed=seed)
+            else:
+                self.__index_sampler = DistributedEvalSampler(range(self.__n_items))
+
+    @staticmethod
+    def _concat(chunks):
+        first = chunks[0]
+        if isinstance(first, torch.Tensor):
+            return torch.cat(chunks, 0)
+        elif isinstance(first, dict):
+            return {key: TensorItemLoader._concat([chunk[key] for chunk in chunks]) for key in first}
+        elif isinstance(first, (list, tuple)) and len(first) > 0 and isinstance(first[0], torch.Tensor):
+            # Collated sequences of tensors
+            return [TensorItemLoader._concat([chunk[i] for chunk in chunks]) for i in range(len(first))]
+        else:
+            values = np.empty(sum([len(chunk) for chunk in chunks]), dtype=object)
+            values[:] = [value for chunk in chunks for value in chunk]
+            return values
+
+    @staticmethod
+    def _gather(data, indices):
+        if isinstance(data, torch.Tensor):
+            return data.index_select(0, indices)
+        elif isinstance(data, dict):
+            return {key: TensorItemLoader._gather(value, indices) for key, value in data.items()}
+        elif isinstance(data, list):
+            return [TensorItemLoader._gather(value, indices) for value in data]
+        else:
+            return data[indices.numpy()].tolist()
+
+    @property
+    def name(self):
+        return self.__name
+
+    @name.setter
+    def name(self, input):
+        self.__name = input
+
+    @property
+    def sampler(self):
+        return self.__sampler
+
+    def _n_indices(self):
+        return len(self.__index_sampler) if self.__index_sampler is not None else self.__n_items
+
+    def _new_order(self):
+        if self.__index_sampler is not None:
+            return torch.tensor(list(iter(self.__index_sampler)), dtype=torch.int64)
+        elif self.__shuffle:
+            return torch.randperm(self.__n_items)
+        else:
+            return torch.arange(self.__n_items)
+
+    def __len__(self):
+        n = self._n_indices()
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def sample(self, k=1):
+        """Samples one or more mini-batches, see :meth:`ItemLoader.sample`."""
+        samples = []
+        for i in range(k):
+            n_left = 0 if self.__order is None else len(self.__order) - self.__pos
+            if n_left == 0 or (self.drop_last and n_left < self.batch_size):
+                self.__order = self._new_order()
+                self.__pos = 0
+            indices = self.__order[self.__pos:self.__pos + self.batch_size]
+            self.__pos += len(indices)
+
+            batch = self._gather(self.__data, indices)
+            batch['name'] = self.__name
+            samples.append(batch)
+
+        return samples
+
+    def set_epoch(self, epoch):
+        if self.__index_sampler is not None and hasattr(self.__index_sampler, "set_epoch"):
+            self.__index_sampler.set_epoch(epoch)
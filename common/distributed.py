@@ -0,0 +1,107 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(cfg):
+    """Joins the process group described by the `RANK`, `WORLD_SIZE`, `MASTER_ADDR` and `MASTER_PORT` environment
+    variables (set by `torchrun`), when `cfg.distributed` is on.
+
+    Returns
+    -------
+    distributed : bool
+        Whether the process is part of a process group.
+    """
+    if not hasattr(cfg, "distributed") or not cfg.distributed:
+        return False
+    if not dist.is_available():
+        raise ValueError('torch.distributed is not available in this build of pytorch.')
+    if "RANK" not in os.environ or "WORLD_SIZE" not in os.environ:
+        raise ValueError('Distributed training needs `RANK` and `WORLD_SIZE`, launch it with `torchrun`.')
+
+    backend = cfg.dist_backend if hasattr(cfg, "dist_backend") else "gloo"
+    if not is_distributed():
+        dist.init_process_group(backend=backend, init_method="env://")
+    return True
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_module(module, src=0):
+    """Copies the parameters and buffers of rank `src` to all ranks."""
+    if not is_distributed():
+        return
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def broadcast_buffers(module, src=0):
+    """Copies the buffers of rank `src` (e.g. the batch norm running statistics, which each rank updates on its own
+    batches) to all ranks."""
+    if not is_distributed():
+        return
+    for tensor in module.buffers():
+        dist.broadcast(tensor, src)
+
+
+def all_reduce_gradients(optimizer):
+    """Averages the gradients of the parameters of `optimizer` over all ranks in a single collective.
+
+    A parameter without gradient on some ranks (e.g. a head without valid targets in the local batch) gets the
+    average over the ranks that have one, and keeps `None` when no rank has a gradient for it.
+    """
+    world_size = get_world_size()
+    if world_size < 2:
+        return
+
+    params = [p for group in optimizer.param_groups for p in group['params'] if p.requires_grad]
+    if len(params) == 0:
+        return
+    device = params[0].device
+    grads = [p.grad.detach().flatten().float() if p.grad is not None else torch.zeros(p.numel(), device=device)
+             for p in params]
+    has_grad = torch.tensor([p.grad is not None for p in params], dtype=torch.float32, device=device)
+    flat = torch.cat(grads + [has_grad], 0)
+
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+
+    counts = flat[-len(params):]
+    offset = 0
+    for p, count in zip(params, counts.tolist()):
+        n = p.numel()
+        if count > 0:
+            grad = (flat[offset:offset + n] / count).view_as(p).type_as(p)
+            if p.grad is None:
+                p.grad = grad
+            else:
+                p.grad.copy_(grad)
+        offset += n
+
+
+def all_gather_objects(obj):
+    """Gathers a picklable object from all ranks, ordered by rank."""
+    if not is_distributed():
+        return [obj]
+    gathered = [None for _ in range(get_world_size())]
+    dist.all_gather_object(gathered, obj)
+    return gathered
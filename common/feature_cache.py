@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging as log
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from common.data import ItemLoader
+from common.utils import get_item_IDs, get_img_size
+
+
+def get_unique_items(dfs):
+    """Rows of `dfs` with distinct item IDs, as items shared by the splits are extracted once."""
+    df = pd.concat(dfs, axis=0)
+    return df[~pd.Series(get_item_IDs(df)).duplicated().values]
+
+
+def get_feature_cache_key(cfg, mean, std, IDs):
+    """Names the cache after everything that changes the backbone features of an image, and after the set of its
+    items. Each data split then has its own cache, which is never rewritten with the items of another split."""
+    pretrained_model = os.path.abspath(cfg.pretrained_model) if cfg.pretrained_model else ""
+    pretrained_mtime = os.path.getmtime(pretrained_model) if pretrained_model else 0
+    desc = json.dumps({'root': os.path.abspath(cfg.root), 'backbone_name': cfg.backbone_name,
+                       'pretrained': cfg.pretrained, 'input_3x3': cfg.input_3x3, 'max_depth': cfg.max_depth,
+                       'pretrained_model': pretrained_model, 'pretrained_mtime': pretrained_mtime,
+                       'img_size': get_img_size(cfg),
+                       'items': hashlib.sha1("\n".join(sorted(IDs)).encode()).hexdigest(),
+                       'mean': [float(v) for v in mean], 'std': [float(v) for v in std],
+                       'dtype': get_feature_cache_dtype(cfg)}, sort_keys=True)
+    return f"{cfg.backbone_name}_depth{cfg.max_depth}_{hashlib.sha1(desc.encode()).hexdigest()[:12]}"
+
+
+def get_feature_cache_dtype(cfg):
+    return cfg.feature_cache.dtype if "dtype" in cfg.feature_cache else "float32"
+
+
+class FeatureCache(object):
+    """Backbone feature maps of images, stored in a memory-mapped `<root>/<key>.npy` of shape `(N, C, H, W)`.
+
+    Rows are indexed by item ID in `<root>/<key>.json`. The memory map is opened on first access, so that the
+    cache can be pickled into loader workers, which then share the pages of the file.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the cache files.
+    key : str
+        Name of the cache, see :func:`get_feature_cache_key`.
+    """
+
+    def __init__(self, root, key):
+        self.filename = os.path.join(root, f"{key}.npy")
+        self.index_filename = os.path.join(root, f"{key}.json")
+        self.__features = None
+        self.__rows = None
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'index_filename': self.index_filename}
+
+    def __setstate__(self, state):
+        self.__init__(os.path.dirname(state['filename']), os.path.basename(state['filename'])[:-len(".npy")])
+
+    def exists(self):
+        # The index is written last, so a cache without it was interrupted
+        return os.path.isfile(self.filename) and os.path.isfile(self.index_filename)
+
+    @property
+    def rows(self):
+        if self.__rows is None:
+            with open(self.index_filename, "r") as f:
+                self.__rows = json.load(f)
+        return self.__rows
+
+    def __contains__(self, ID):
+        return ID in self.rows
+
+    def __getitem__(self, ID):
+        if self.__features is None:
+            self.__features = np.load(self.filename, mmap_mode='r')
+        return torch.from_numpy(np.array(self.__features[self.rows[ID]], dtype=np.float32))
+
+    def write(self, IDs, batches, shape, dtype="float32"):
+        """Fills the cache from an iterable of `(IDs, features)` batches, whose IDs are in `IDs`."""
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        rows = {ID: i for i, ID in enumerate(IDs)}
+        # Concurrent jobs of the same split write the same content, each to its own temporary files
+        features_tmp, index_tmp = f"{self.filename}.{os.getpid()}.tmp", f"{self.index_filename}.{os.getpid()}.tmp"
+        features = np.lib.format.open_memmap(features_tmp, mode="w+", dtype=dtype, shape=(len(IDs),) + tuple(shape))
+        for batch_IDs, batch_features in batches:
+            features[[rows[ID] for ID in batch_IDs]] = batch_features
+        features.flush()
+        del features
+        os.replace(features_tmp, self.filename)
+        with open(index_tmp, "w") as f:
+            json.dump(rows, f)
+        os.replace(index_tmp, self.index_filename)
+        self.__rows = rows
+
+
+def build_feature_cache(cfg, model, dfs, parse_item_cb, transform, cache):
+    """Runs the backbone of `model` once over the images of `dfs` with the eval `transform`, unless cached."""
+    df = get_unique_items(dfs)
+    IDs = get_item_IDs(df)
+    if cache.exists() and all(ID in cache for ID in IDs):
+        log.info(f'Use feature cache {cache.filename} of {len(cache.rows)} images.')
+        return cache
+
+    loader = ItemLoader(meta_data=df, root=cfg.root, batch_size=cfg.bs, num_workers=cfg.num_workers,
+                        transform=transform, parser_kwargs=cfg.parser, parse_item_cb=parse_item_cb, shuffle=False,
+                        drop_last=False)
+
+    def extract():
+        was_training = model.training
+        model.eval()
+        with torch.no_grad():
+            for _ in tqdm(range(len(loader)), total=len(loader), desc="feature_cache"):
+                batch = loader.sample(1)[0]
+                features = model.forward_backbone(batch['data']['input']['IMG'].to(model.device))
+                yield batch['data']['input']['ID'], features.float().to('cpu').numpy()
+        model.train(was_training)
+
+    dtype = get_feature_cache_dtype(cfg)
+    shape = (model.n_backbone_features, model.n_last_img_ft_size, model.n_last_img_ft_size)
+    log.info(f'Build feature cache {cache.filename} of {len(IDs)} images with shape {shape} in {dtype}.')
+    cache.write(IDs, extract(), shape, dtype=dtype)
+    return cache
+
+
+class CachedFeatureParser(object):
+    """Parses an item with `parse_item_cb`, except that its image is replaced by the cached backbone features.
+
+    The image is neither read nor transformed, and the features are given as `IMG_FT` in the input.
+    """
+
+    def __init__(self, parse_item_cb, cache):
+        self.parse_item_cb = parse_item_cb
+        self.cache = cache
+
+    def __call__(self, root, entry, trf, **kwargs):
+        kwargs = dict(kwargs)
+        kwargs['metadata'] = [name for name in kwargs['metadata'] if name != "IMG"]
+        item = self.parse_item_cb(root, entry, trf, **kwargs)
+        item['data']['input']['IMG_FT'] = self.cache[item['data']['input']['ID']]
+        return item
@@ -5,18 +5,48 @@ import torch.nn.functional as F
 
 
 def create_loss(loss_name, **kwargs):
-    if loss_name == 'CE':
-        return CrossEnropy(**kwargs)
+    if loss_name in LOSSES:
+        return LOSSES[loss_name](**kwargs)
     else:
         raise ValueError(f'Not support loss {loss_name}.')
 
 
+def reduce_by_horizon(loss, mask, reduction='mean', counts=None):
+    """Reduces a masked `(B,T)` loss per horizon and then over horizons.
+
+    Each horizon is averaged over its valid samples, and the horizons with at least one valid sample are averaged,
+    which matches looping over `t` and averaging the per-horizon losses.
+
+    When a batch is split into micro-batches, `counts` holds the number of valid samples per horizon in the whole
+    batch. The micro-batch losses then sum up to the loss of the whole batch.
+    """
+    mask = mask.type_as(loss)
+    counts = mask.sum(0) if counts is None else counts.type_as(loss)
+    per_t = (loss * mask).sum(0) / counts.clamp(min=1.0)
+    if reduction == "mean":
+        valid = counts > 0
+        return per_t[valid].sum() / valid.sum().clamp(min=1).type_as(loss)
+    elif reduction == "sum":
+        return per_t.sum()
+    else:
+        return per_t
+
+
 class CrossEnropy(nn.Module):
-    def __init__(self, normalized=False, reduction='mean', **kwargs):
+    """Cross-entropy loss.
+
+    Accepts either `(N,C)` inputs, or whole `(B,T,C)` sequence inputs together with a `(B,T)` mask of valid
+    horizons. In the latter case, `alpha` can be `(C,)` or per-horizon `(T,C)` class weights. `sample_weight` of
+    shape `(N,)` or `(B,)` scales the loss of each sample, e.g. to correct the bias of non-uniform sampling.
+    """
+    binary_single_logit = True
+
+    def __init__(self, normalized=False, reduction='mean', weight=None, **kwargs):
         super(CrossEnropy, self).__init__()
         self.reduction = reduction
         self.eps = 1e-7
         self.normalized = normalized
+        self.weight = weight
 
     def pc_logsoftmax(self, x, stats):
         numer = exp_x = torch.exp(x)
@@ -25,8 +55,22 @@ class CrossEnropy(nn.Module):
         _pls = torch.log(_ps + self.eps)
         return _pls
 
-    def forward(self, input, target, normalized=None, alpha=None, *args, **kwargs):
+    def log_probs(self, input, normalized, **kwargs):
+        if not normalized:
+            return F.log_softmax(input, dim=-1)
+        else:
+            return torch.log(input)
+
+    def modulate(self, loss, logpt):
+        return loss
+
+    def forward(self, input, target, normalized=None, alpha=None, mask=None, sample_weight=None, *args, **kwargs):
         normalized = self.normalized if normalized is None else normalized
+        alpha = self.weight if alpha is None else alpha
+        if input.dim() == 3 and mask is not None:
+            return self.forward_seq(input, target, mask, normalized=normalized, alpha=alpha,
+                                    sample_weight=sample_weight, **kwargs)
+
         if input.dim() > 2:
             input = input.view(input.size(0), input.size(1), -1)  # N,C,H,W => N,C,H*W
             input = input.transpose(1, 2)  # N,C,H*W => N,H*W,C
@@ -41,21 +85,18 @@ class CrossEnropy(nn.Module):
             _alpha = None
 
         # For binary classification
-        if input.dim() == 1 or (input.dim() == 2 and input.shape[1] == 1):
+        if self.binary_single_logit and (input.dim() == 1 or (input.dim() == 2 and input.shape[1] == 1)):
             if not normalized:
                 logpt = F.logsigmoid(input)
             else:
                 logpt = torch.log(input)
         else:  # Multi-class
-            if not normalized:
-                logpt = F.log_softmax(input, dim=-1)
-            else:
-                logpt = torch.log(input)
+            logpt = self.log_probs(input, normalized, **kwargs)
             logpt = logpt.gather(1, target)
 
         logpt = logpt.view(-1)
 
-        loss = -logpt
+        loss = self.modulate(-logpt, logpt)
 
         if _alpha is not None:
             if _alpha.type() != input.data.type():
@@ -69,9 +110,96 @@ class CrossEnropy(nn.Module):
             # at = _alpha
             loss = loss * Variable(at)
 
+        if sample_weight is not None:
+            loss = loss * sample_weight.type_as(loss).view(-1)
+
         if self.reduction == "mean":
             return loss.mean()
         elif self.reduction == "sum":
             return loss.sum()
         else:
             return loss
+
+    def forward_seq(self, input, target, mask, normalized=False, alpha=None, counts=None, sample_weight=None,
+                    **kwargs):
+        """Computes the loss of `(B,T,C)` predictions against `(B,T)` or `(B,T,1)` targets in one pass."""
+        mask = mask.bool()
+        target = target.view(mask.shape).type(torch.int64)
+        # Masked-out targets can be missing (-1), so point them to a valid class before gathering
+        target = target.masked_fill(~mask, 0).unsqueeze(-1)
+
+        logpt = self.log_probs(input, normalized, **kwargs).gather(-1, target).squeeze(-1)
+        loss = self.modulate(-logpt, logpt)
+
+        if alpha is not None:
+            if not isinstance(alpha, torch.Tensor):
+                alpha = torch.tensor(alpha)
+            alpha = alpha.type_as(loss)
+            if alpha.dim() == 1:
+                at = alpha[target.squeeze(-1)]
+            elif alpha.dim() == 2:
+                at = alpha.unsqueeze(0).expand(mask.shape[0], -1, -1).gather(-1, target).squeeze(-1)
+            else:
+                raise ValueError(f'Not support alpha with dim = {alpha.dim()}.')
+            loss = loss * at
+
+        if sample_weight is not None:
+            loss = loss * sample_weight.type_as(loss).view(-1, 1)
+
+        return reduce_by_horizon(loss, mask, self.reduction, counts=counts)
+
+
+class WeightedCrossEntropy(CrossEnropy):
+    """Cross-entropy with fixed class weights, used when `alpha` is not given at call time."""
+
+    def __init__(self, weight=None, normalized=False, reduction='mean', **kwargs):
+        if weight is not None and not isinstance(weight, torch.Tensor):
+            weight = torch.tensor(weight, dtype=torch.float32)
+        super(WeightedCrossEntropy, self).__init__(normalized=normalized, reduction=reduction, weight=weight)
+
+
+class FocalLoss(CrossEnropy):
+    """Focal loss `-(1 - p_t)^gamma * log(p_t)` from "Focal Loss for Dense Object Detection", Lin et. al."""
+
+    def __init__(self, gamma=2.0, normalized=False, reduction='mean', weight=None, **kwargs):
+        super(FocalLoss, self).__init__(normalized=normalized, reduction=reduction, weight=weight)
+        self.gamma = gamma
+
+    def modulate(self, loss, logpt):
+        if self.gamma > 0:
+            pt = logpt.exp()
+            loss = loss * (1.0 - pt).clamp(min=0.0) ** self.gamma
+        return loss
+
+
+class CumulativeLinkLoss(FocalLoss):
+    """Negative log-likelihood of the logistic cumulative link model.
+
+    Takes the latent scores `(...,1)` and the ordered `cutpoints`, and computes the class log-probabilities from
+    differences of log-sigmoids, so the model never needs to materialize and re-log the link probabilities.
+    Setting `gamma > 0` applies the focal modulation on top.
+    """
+
+    binary_single_logit = False
+
+    def __init__(self, gamma=0.0, reduction='mean', weight=None, **kwargs):
+        super(CumulativeLinkLoss, self).__init__(gamma=gamma, normalized=False, reduction=reduction, weight=weight)
+
+    def log_probs(self, input, normalized, cutpoints=None, **kwargs):
+        if cutpoints is None:
+            raise ValueError('`cutpoints` is required by the cumulative link loss.')
+        if normalized:
+            return torch.log(input.clamp(min=self.eps))
+        # log P(y <= k) and log P(y > k) for every cutpoint
+        log_cdf = F.logsigmoid(cutpoints - input)
+        log_sf = F.logsigmoid(input - cutpoints)
+        # log(sigmoid(c_k - x) - sigmoid(c_{k-1} - x)) = log_cdf_k + log(1 - exp(log_cdf_{k-1} - log_cdf_k))
+        diff = (log_cdf[..., :-1] - log_cdf[..., 1:]).clamp(max=-self.eps)
+        log_mid = log_cdf[..., 1:] + torch.log(-torch.expm1(diff))
+        return torch.cat((log_cdf[..., :1], log_mid, log_sf[..., -1:]), dim=-1)
+
+
+LOSSES = {'CE': CrossEnropy,
+          'WCE': WeightedCrossEntropy,
+          'FL': FocalLoss,
+          'CLL': CumulativeLinkLoss}
@@ -0,0 +1,75 @@
+import contextlib
+
+import torch
+from torch import nn
+
+from common.distributed import all_reduce_gradients
+
+PRECISIONS = {'fp32': torch.float32, 'bf16-autocast': torch.bfloat16, 'fp16': torch.float16}
+
+
+class MixedPrecision(object):
+    """Autocast context and loss scaling used by the `fit` methods of the models.
+
+    Parameters
+    ----------
+    precision : str
+        One of `fp32`, `bf16-autocast` (CPU or GPU) and `fp16` (GPU only). bfloat16 has the dynamic range of
+        float32, so only `fp16` uses a gradient scaler.
+    device : torch.device
+        Device the model runs on.
+    """
+
+    def __init__(self, precision='fp32', device=torch.device('cpu')):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Not support precision {precision}.')
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self.device_type = device.type if isinstance(device, torch.device) else torch.device(device).type
+
+        if precision == 'fp16' and self.device_type != 'cuda':
+            raise ValueError(f'Precision {precision} requires a GPU, use bf16-autocast on CPU.')
+        if self.enabled and not hasattr(torch, 'autocast'):
+            raise ValueError(f'Precision {precision} requires torch.autocast (pytorch>=1.10).')
+
+        self.scaler = torch.cuda.amp.GradScaler() if precision == 'fp16' else None
+
+    @property
+    def enabled(self):
+        return self.precision != 'fp32'
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def step(self, optimizer, parameters=None, clip_norm=-1):
+        # No-op unless training is distributed
+        all_reduce_gradients(optimizer)
+        if self.scaler is not None:
+            if clip_norm > 0:
+                self.scaler.unscale_(optimizer)
+                nn.utils.clip_grad_norm_(parameters, clip_norm)
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            if clip_norm > 0:
+                nn.utils.clip_grad_norm_(parameters, clip_norm)
+            optimizer.step()
+
+    def state_dict(self):
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state_dict):
+        if self.scaler is not None and state_dict:
+            self.scaler.load_state_dict(state_dict)
+
+
+def get_precision(cfg):
+    return cfg.precision if hasattr(cfg, "precision") else "fp32"
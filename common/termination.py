@@ -0,0 +1,123 @@
+import json
+import logging as log
+import time
+
+
+class TerminationController(object):
+    """Stops training when every selection metric has plateaued, or when the wall-clock budget is spent.
+
+    A metric improves when its best value in `stored_models` beats the best value seen by the controller by more
+    than its minimum improvement. It has plateaued when it has not improved for `patience` epochs.
+
+    Parameters
+    ----------
+    metrics : list
+        `(task, metric)` pairs tracked by model selection, e.g. `[('pn', 'ba'), ('all', 'loss')]`.
+    patience : int, optional
+        Epochs without improvement before a metric has plateaued, or -1 to never stop on plateaus.
+        (the default is -1)
+    min_delta : float, optional
+        Minimum improvement. (the default is 0.0)
+    metric_patience : dict, optional
+        Patience of specific metrics, keyed by `task/metric`. (the default is None)
+    metric_min_delta : dict, optional
+        Minimum improvement of specific metrics, keyed by `task/metric`. (the default is None)
+    max_hours : float, optional
+        Wall-clock budget of the run, summed over resumptions, or -1 for no budget. (the default is -1)
+    """
+
+    def __init__(self, metrics, patience=-1, min_delta=0.0, metric_patience=None, metric_min_delta=None,
+                 max_hours=-1):
+        metric_patience = {} if metric_patience is None else metric_patience
+        metric_min_delta = {} if metric_min_delta is None else metric_min_delta
+        self.metrics = [f'{task}/{metric_name}' for task, metric_name in metrics]
+        self.patience = {name: metric_patience[name] if name in metric_patience else patience
+                         for name in self.metrics}
+        self.min_delta = {name: metric_min_delta[name] if name in metric_min_delta else min_delta
+                          for name in self.metrics}
+        self.max_seconds = max_hours * 3600.0 if max_hours > 0 else -1
+
+        self.best = {name: None for name in self.metrics}
+        self.last_improved = {name: -1 for name in self.metrics}
+        self.prev_elapsed = 0.0
+        self.start_time = time.time()
+
+    @staticmethod
+    def is_minimized(name):
+        metric_name = name.split("/")[-1]
+        return metric_name == "mse" or "loss" in metric_name
+
+    @property
+    def elapsed(self):
+        return self.prev_elapsed + time.time() - self.start_time
+
+    def update(self, epoch_i, stored_models):
+        for name in self.metrics:
+            task, metric_name = name.split("/")
+            value = stored_models[task][metric_name]['best']
+            # Not stored yet
+            if not stored_models[task][metric_name]['filename']:
+                continue
+            best = self.best[name]
+            if self.is_minimized(name):
+                improved = best is None or value < best - self.min_delta[name]
+            else:
+                improved = best is None or value > best + self.min_delta[name]
+            if improved:
+                self.best[name] = float(value)
+                self.last_improved[name] = epoch_i
+
+    def check(self, epoch_i):
+        """Returns the reason for stopping after epoch `epoch_i`, or None to continue."""
+        if 0 < self.max_seconds <= self.elapsed:
+            return f'Wall-clock budget of {self.max_seconds / 3600.0:.2f} hours is spent.'
+
+        if len(self.metrics) == 0:
+            return None
+        plateaued = []
+        for name in self.metrics:
+            if self.patience[name] < 0:
+                return None
+            if epoch_i - self.last_improved[name] < self.patience[name]:
+                return None
+            plateaued.append(f'{name} since epoch {self.last_improved[name]}')
+        return f'No improvement of {", ".join(plateaued)}.'
+
+    def write_reason(self, reason, epoch_i, stored_models=None, filename="termination.json"):
+        """Writes why training stopped, and the stored model of each tracked metric, which is the one to use rather
+        than the weights of the last epoch."""
+        log.info(f'Stop after epoch {epoch_i}: {reason}')
+        best_models = {}
+        if stored_models is not None:
+            for name in self.metrics:
+                task, metric_name = name.split("/")
+                best_models[name] = stored_models[task][metric_name]['filename'] or None
+                log.info(f'Best model of {name}: {best_models[name]}')
+        with open(filename, "w") as f:
+            json.dump({'epoch': epoch_i, 'reason': reason, 'elapsed_hours': self.elapsed / 3600.0,
+                       'best': self.best, 'last_improved': self.last_improved, 'best_models': best_models}, f,
+                      indent=2)
+
+    def state_dict(self):
+        return {'best': dict(self.best), 'last_improved': dict(self.last_improved), 'elapsed': self.elapsed}
+
+    def load_state_dict(self, state_dict):
+        for name in self.metrics:
+            if name in state_dict['best']:
+                self.best[name] = state_dict['best'][name]
+                self.last_improved[name] = state_dict['last_improved'][name]
+        self.prev_elapsed = state_dict['elapsed']
+        self.start_time = time.time()
+
+
+def create_termination_controller(cfg, metrics):
+    if not hasattr(cfg, "termination"):
+        return TerminationController(metrics)
+    termination = cfg.termination
+    return TerminationController(
+        metrics,
+        patience=termination.patience if "patience" in termination else -1,
+        min_delta=termination.min_delta if "min_delta" in termination else 0.0,
+        metric_patience=dict(termination.metric_patience) if "metric_patience" in termination else None,
+        metric_min_delta=dict(termination.metric_min_delta) if "metric_min_delta" in termination else None,
+        max_hours=termination.max_hours if "max_hours" in termination else -1)
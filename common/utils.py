@@ -24,6 +24,8 @@ from tqdm import tqdm
 coloredlogs.install()
 
 MAX_GRADES = {'KL': 4, 'OSTL': 3, 'OSTM': 3, 'OSFL': 3, 'OSFM': 3, 'JSL': 3, 'JSM': 3, 'angle': 7}
+# One-hot metadata fields embedded by the models
+METADATA_FIELDS = ('AGE', 'WOMAC', 'BMI', 'SEX', 'INJ', 'SURG', 'KL')
 
 
 
@@ -791,6 +793,14 @@ def init_mean_std(cfg, output_dir, ds, parse_item_img_prog):
     return mean_vector, std_vector
 
 
+def get_item_IDs(df):
+    """Returns the `ID` that :func:`parse_item_progs` gives to each row of `df`."""
+    if 'V00SITE' in df.columns:
+        return [f"{row['V00SITE']}_{row['ID']}_{row['Side']}_{row['visit_id']}" for _, row in df.iterrows()]
+    else:
+        return [f"{row['ID']}_{row['Side']}_{row['visit_id']}" for _, row in df.iterrows()]
+
+
 def parse_item_progs(root, entry, trf, **kwargs):
     grading = kwargs['grading']
     prognosis = np.expand_dims(entry[kwargs['prognosis']], axis=1).astype(np.float32)
@@ -830,6 +840,10 @@ def parse_item_progs(root, entry, trf, **kwargs):
     meta = parse_metadata(entry, kwargs["metadata"])
     input.update(meta)
 
+    meta_codes = encode_metadata_codes(input, kwargs["metadata"])
+    if meta_codes is not None:
+        input['META_CODES'] = meta_codes
+
     return {'data': {'input': input},
             grading: torch.tensor(int(entry[grading])) if has_grading else torch.tensor(-1),
             f'{grading}_mask': has_grading,
@@ -837,7 +851,8 @@ def parse_item_progs(root, entry, trf, **kwargs):
             'prognosis_mask': torch.from_numpy(prognosis_mask.copy()) > 0}
 
 
-def store_model(epoch_i, task_name, metric_name, metrics, stored_models, model, saved_dir, cond="max", mode="avg"):
+def store_model(epoch_i, task_name, metric_name, metrics, stored_models, model, saved_dir, cond="max", mode="avg",
+                writer=None, blob_store=None):
     if isinstance(metric_name, str):
         if "." in metric_name:
             _tmp = []
@@ -883,7 +898,9 @@ def store_model(epoch_i, task_name, metric_name, metrics, stored_models, model,
 
             # Remove prev model
             prev_model_fullname = os.path.join(saved_dir, stored_models[task_name][metric_name]['filename'])
-            if os.path.isfile(prev_model_fullname):
+            if writer is not None and stored_models[task_name][metric_name]['filename']:
+                writer.remove(prev_model_fullname)
+            elif os.path.isfile(prev_model_fullname):
                 os.remove(prev_model_fullname)
             if os.path.isfile(prev_model_fullname[:-4] + ".json"):
                 os.remove(prev_model_fullname[:-4] + ".json")
@@ -893,7 +910,12 @@ def store_model(epoch_i, task_name, metric_name, metrics, stored_models, model,
                 "model_" + f"{epoch_i:03d}" + "_" + task_name + "_" + mode + "_" + metric_name + "_" + f'{cur_metric:.03f}' + ".pth"
             saved_model_fullname = os.path.join(saved_dir, stored_models[task_name][metric_name]['filename'])
             saved_log_fullname = saved_model_fullname[:-4] + ".json"
-            torch.save(model.state_dict(), saved_model_fullname)
+            if blob_store is not None:
+                blob_store.store(model.state_dict(), saved_model_fullname, epoch_i)
+            elif writer is not None:
+                writer.save(model.state_dict(), saved_model_fullname)
+            else:
+                torch.save(model.state_dict(), saved_model_fullname)
             if "." in metric_name:
                 results = {mode: cur_metric}
                 for name in metric_name.split("."):
@@ -908,6 +930,19 @@ def store_model(epoch_i, task_name, metric_name, metrics, stored_models, model,
     return stored_models
 
 
+def encode_metadata_codes(input, metadata):
+    """Level of each one-hot metadata field in the order of `metadata`, or the number of levels if missing."""
+    codes = []
+    for name in metadata:
+        if name not in METADATA_FIELDS:
+            continue
+        if name not in input:
+            return None
+        x = input[name]
+        codes.append(int(x.argmax()) if x.sum() > 0 else len(x))
+    return torch.tensor(codes, dtype=torch.int64) if len(codes) > 0 else None
+
+
 def parse_metadata(entry, metadata):
     n_segments = 4
     mean_bmi = 28
@@ -1030,7 +1065,20 @@ def unpack_solt_data(dc: sld.DataContainer):
     return img
 
 
-def init_transforms(mean=(0.51109564, 0.51109564, 0.51109564), std=(0.28390905, 0.28390905, 0.28390905), n_channels=3):
+def get_img_size(cfg, epoch_i=None):
+    """Input size of the images, following `img_size_schedule` of `[start_epoch, size]` pairs if `epoch_i` is given."""
+    img_size = cfg.img_size if hasattr(cfg, "img_size") else 256
+    if epoch_i is not None and hasattr(cfg, "img_size_schedule"):
+        for start_epoch, size in sorted([tuple(item) for item in cfg.img_size_schedule]):
+            if epoch_i >= start_epoch:
+                img_size = size
+    return img_size
+
+
+def init_transforms(mean=(0.51109564, 0.51109564, 0.51109564), std=(0.28390905, 0.28390905, 0.28390905), n_channels=3,
+                    img_size=256):
+    # Crops of `img_size` from images resized to 280 / 256 of it
+    resize = int(round(img_size * 280 / 256))
     if n_channels == 3:
         norm_mean_std = Normalize(mean, std)
     else:
@@ -1040,10 +1088,10 @@ def init_transforms(mean=(0.51109564, 0.51109564, 0.51109564), std=(0.28390905,
         img_labels2solt,
         slc.Stream([
             slt.CropTransform(crop_size=(700, 700), crop_mode='c'),
-            slt.ResizeTransform((280, 280)),
+            slt.ResizeTransform((resize, resize)),
             slt.ImageAdditiveGaussianNoise(p=0.5, gain_range=0.3),
             slt.RandomRotate(p=1, rotation_range=(-10, 10)),
-            slt.CropTransform(crop_size=(256, 256), crop_mode='r'),
+            slt.CropTransform(crop_size=(img_size, img_size), crop_mode='r'),
             slt.ImageGammaCorrection(p=0.5, gamma_range=(0.5, 1.5)),
         ], interpolation='area', padding='z'),
         unpack_solt_data,
@@ -1055,8 +1103,8 @@ def init_transforms(mean=(0.51109564, 0.51109564, 0.51109564), std=(0.28390905,
         slc.Stream([
             slt.PadTransform(pad_to=(700, 700)),
             slt.CropTransform(crop_size=(700, 700), crop_mode='c'),
-            slt.ResizeTransform((280, 280)),
-            slt.CropTransform(crop_size=(256, 256), crop_mode='c'),
+            slt.ResizeTransform((resize, resize)),
+            slt.CropTransform(crop_size=(img_size, img_size), crop_mode='c'),
         ], interpolation='area'),
         unpack_solt_data,
         ApplyTransform(norm_mean_std)
@@ -12,10 +12,13 @@ from omegaconf.listconfig import ListConfig
 from sklearn.metrics import roc_auc_score, balanced_accuracy_score, \
     mean_squared_error, cohen_kappa_score
 
+from common.checkpoint import LEGACY_TRAINING_STATE_FILENAME
 from common.data import ItemLoader
+from common.precision import get_precision
 from common.utils import proc_targets, calculate_metric, load_metadata, init_mean_std, parse_item_progs, \
-    update_max_grades, parse_img, init_transforms
+    update_max_grades, parse_img, init_transforms, get_img_size
 from models import create_model
+from models.fusion import optimize_backbone_for_inference
 from . import train
 
 # from prognosis.train import main_loop
@@ -80,8 +83,8 @@ def load_data(cfg, site):
     meta_test['visit'] = meta_test['visit'].astype(int)
     loader = ItemLoader(
         meta_data=meta_test, root=cfg.root, batch_size=cfg.bs, num_workers=cfg.num_workers,
-        transform=init_transforms(oai_mean, oai_std)['eval'], parser_kwargs=cfg.parser,
-        parse_item_cb=parse_item_progs, shuffle=False)
+        transform=init_transforms(oai_mean, oai_std, img_size=get_img_size(cfg))['eval'], parser_kwargs=cfg.parser,
+        parse_item_cb=parse_item_progs, collate_fn=train.get_collate_fn(cfg), shuffle=False)
     return loader
 
 
@@ -98,6 +101,11 @@ def eval(pretrained_model, loader, cfg, device, store=True):
         except ValueError:
             log.fatal(f'Failed loading {pretrained_model}')
 
+    if "fuse_backbone" in cfg and cfg.fuse_backbone:
+        # TorchScript graphs do not follow autocast
+        jit = "fuse_backbone_jit" in cfg and cfg.fuse_backbone_jit and get_precision(cfg) == "fp32"
+        optimize_backbone_for_inference(model, jit=jit)
+
     metrics, accumulated_metrics = train.main_loop(loader, 0, model, cfg, "test")
 
     if store:
@@ -142,10 +150,19 @@ def eval_from_saved_folders(cfg, root_dir, device, patterns="bacc"):
                            "most_meta_filename", "oai_meta_filename", "multi_class_mode",
                            "use_y0_class_weights", "use_pn_class_weights", "use_pr_class_weights",
                            "use_only_grading", "use_only_baseline", "model_selection_mode", "save_attn",
-                           "most_followup_meta_filename"]
+                           "most_followup_meta_filename", "precision", "fuse_backbone", "fuse_backbone_jit",
+                           "channels_last"]
         eval_config_names = ['output', 'root', 'patterns', 'n_resamplings', ]
         for k in or_config_names:
             config[k] = cfg[k]
+        # The input size is never overridden: models are evaluated on the `img_size` of their run, which its
+        # `img_size_schedule` ends at
+        config.img_size = get_img_size(config)
+        if "img_size" in cfg and cfg.img_size is not None and cfg.img_size != config.img_size:
+            print(f'Ignore img_size={cfg.img_size}, evaluate {dir} on its img_size={config.img_size}.')
+        # Token reduction has no parameters, so trained models can be evaluated with other keep rates
+        if "token_keep_rate" in cfg and cfg.token_keep_rate is not None:
+            config.token_keep_rate = cfg.token_keep_rate
 
         config.eval = {}
         for k in eval_config_names:
@@ -170,7 +187,7 @@ def eval_from_saved_folders(cfg, root_dir, device, patterns="bacc"):
                 else:
                     matched = patterns in filename
 
-                if filename.endswith(".pth") and matched:
+                if filename.endswith(".pth") and filename != LEGACY_TRAINING_STATE_FILENAME and matched:
                     model_fullname = os.path.join(r, filename)
 
                     key = f'Site:{config.site}:{config.fold_index}'
@@ -1,6 +1,8 @@
 import logging
+import math
 import os
 import pickle
+from functools import partial
 
 import coloredlogs
 import torch
@@ -8,8 +10,11 @@ from einops import rearrange
 from torch import nn
 
 from common.losses import create_loss
-from models.feature_transformer import FeatureTransformer
+from common.precision import MixedPrecision, get_precision
+from models.feature_transformer import FeatureTransformer, select_tokens
+from models.metadata_encoder import FusedMetadataEncoder
 from models.networks import make_network, get_output_channels
+from models.utils import checkpoint_forward, run_block_chunked, get_output_size, get_memory_format
 
 MIN_NUM_PATCHES = 0
 
@@ -27,34 +32,47 @@ class CLIMAT(nn.Module):
         self.input_data = cfg.parser.metadata
         self.pn_weights = torch.tensor(pn_weights) if pn_weights is not None else pn_weights
 
+        # Categorical metadata are embedded by one encoder, or by a module `<field>_ft` per field
+        self.fused_metadata = cfg.fused_metadata if hasattr(cfg, "fused_metadata") else True
+        meta_layers = {}
+
         if "AGE" in self.input_data:
-            self.age_ft = self.create_metadata_layers(4, self.n_meta_features)
+            meta_layers["AGE"] = self.create_metadata_layers(4, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
         if "WOMAC" in self.input_data:
-            self.womac_ft = self.create_metadata_layers(4, self.n_meta_features)
+            meta_layers["WOMAC"] = self.create_metadata_layers(4, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
         if "BMI" in self.input_data:
-            self.bmi_ft = self.create_metadata_layers(4, self.n_meta_features)
+            meta_layers["BMI"] = self.create_metadata_layers(4, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
         if "SEX" in self.input_data:
-            self.sex_ft = self.create_metadata_layers(2, self.n_meta_features)
+            meta_layers["SEX"] = self.create_metadata_layers(2, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
         if "INJ" in self.input_data:
-            self.inj_ft = self.create_metadata_layers(2, self.n_meta_features)
+            meta_layers["INJ"] = self.create_metadata_layers(2, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
         if "SURG" in self.input_data:
-            self.surg_ft = self.create_metadata_layers(2, self.n_meta_features)
+            meta_layers["SURG"] = self.create_metadata_layers(2, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
         if "KL" in self.input_data:
-            self.kl_ft = self.create_metadata_layers(cfg.n_pn_classes, self.n_meta_features)
+            meta_layers["KL"] = self.create_metadata_layers(cfg.n_pn_classes, self.n_meta_features)
             self.n_meta_out_features += self.n_meta_features
 
+        self.meta_fields = [name for name in self.input_data if name in meta_layers]
+        if self.fused_metadata and len(self.meta_fields) > 0:
+            self.meta_encoder = FusedMetadataEncoder(
+                [meta_layers[name][0].in_features for name in self.meta_fields], self.n_meta_features)
+            self.meta_encoder.load_layers([meta_layers[name] for name in self.meta_fields])
+        else:
+            for name, layers in meta_layers.items():
+                setattr(self, f"{name.lower()}_ft", layers)
+
         self.n_all_features = self.n_meta_out_features
         if "IMG" in self.input_data:
             if cfg.max_depth < 1 or cfg.max_depth > 5:
@@ -65,6 +83,9 @@ class CLIMAT(nn.Module):
 
             self.feature_extractor = make_network(name=cfg.backbone_name, pretrained=cfg.pretrained,
                                                   input_3x3=cfg.input_3x3)
+            # Convolutions of oneDNN and cuDNN are faster on channels-last (NHWC) tensors
+            self.memory_format = get_memory_format(cfg)
+            self.feature_extractor.to(memory_format=self.memory_format)
 
             self.blocks = []
             for i in range(cfg.max_depth):
@@ -83,12 +104,13 @@ class CLIMAT(nn.Module):
                 self.n_last_img_features = get_output_channels(self.blocks[-1], cfg.max_depth)
                 self.n_last_img_ft_size = self.sz_list[cfg.max_depth - 1]
             else:
-                # self.sz_list = [75, 75, 38, 19, 10] # 300x300
-                self.sz_list = [64, 64, 32, 16, 8]  # 256x256
                 self.n_last_img_features = get_output_channels(self.blocks[-1], cfg.max_depth)
-                self.n_last_img_ft_size = self.sz_list[cfg.max_depth - 1]
+                # Computed from the backbone, as other input sizes are used with progressive resizing
+                self.img_size = cfg.img_size if hasattr(cfg, "img_size") else 256
+                self.n_last_img_ft_size = get_output_size(self.blocks, self.img_size)[0]
 
             self.n_img_features = cfg.n_img_features
+            self.n_backbone_features = self.n_last_img_features
 
             if self.n_img_features <= 0:
                 self.img_ft_projection = nn.Identity()
@@ -100,11 +122,25 @@ class CLIMAT(nn.Module):
             logging.info(f'[INFO] Num of blocks: {len(self.blocks)}')
 
             self.n_patches = self.n_last_img_ft_size * self.n_last_img_ft_size
+            self.img_grid_size = (self.n_last_img_ft_size, self.n_last_img_ft_size)
         else:
             self.n_patches = self.cfg.seq_len
+            self.img_grid_size = None
 
         self.dropout = nn.Dropout(p=cfg.drop_rate)
         self.dropout_between = nn.Dropout(cfg.drop_rate_between)
+        self.checkpoint_img_blocks = cfg.checkpoint_img_blocks if hasattr(cfg, "checkpoint_img_blocks") else False
+        self.checkpoint_transformer = cfg.checkpoint_transformer if hasattr(cfg, "checkpoint_transformer") else False
+        self.grouped_heads = cfg.grouped_heads if hasattr(cfg, "grouped_heads") else True
+        self.broadcast_fusion = cfg.broadcast_fusion if hasattr(cfg, "broadcast_fusion") else False
+        # Image tokens passed from feat_kl to feat_prognosis
+        self.token_keep_rate = cfg.token_keep_rate if hasattr(cfg, "token_keep_rate") else 1.0
+        self.n_kept_patches = self.get_n_kept_patches(self.n_patches)
+        # Image features come from a precomputed cache, so the backbone is not trained
+        self.frozen_backbone = "IMG" in self.input_data and hasattr(cfg, "feature_cache") and cfg.feature_cache.enabled
+        if self.frozen_backbone:
+            for p in self.feature_extractor.parameters():
+                p.requires_grad = False
 
         self.n_classes = cfg.n_pn_classes
 
@@ -126,20 +162,27 @@ class CLIMAT(nn.Module):
                                               num_classes=0, dim=self.n_meta_features, depth=cfg.feat_fusion_depth,
                                               heads=cfg.feat_fusion_heads, mlp_dim=cfg.feat_fusion_mlp_dim,
                                               dropout=cfg.drop_rate,
-                                              emb_dropout=cfg.feat_fusion_emb_drop_rate, n_outputs=0)
+                                              emb_dropout=cfg.feat_fusion_emb_drop_rate, n_outputs=0,
+                                              checkpoint=self.checkpoint_transformer,
+                                              grouped_heads=self.grouped_heads)
 
         self.feat_kl = FeatureTransformer(num_patches=self.n_patches, with_cls=True, num_cls_num=1,
                                           patch_dim=self.feat_kl_dim,
                                           num_classes=cfg.n_pn_classes, dim=self.feat_kl_dim, depth=cfg.feat_kl_depth,
                                           heads=cfg.feat_kl_heads, mlp_dim=cfg.feat_kl_mlp_dim, dropout=cfg.drop_rate,
-                                          emb_dropout=cfg.feat_kl_emb_drop_rate, n_outputs=cfg.feat_kl_n_outputs)
+                                          emb_dropout=cfg.feat_kl_emb_drop_rate, n_outputs=cfg.feat_kl_n_outputs,
+                                          checkpoint=self.checkpoint_transformer,
+                                          grouped_heads=self.grouped_heads, grid_size=self.img_grid_size)
 
         self.feat_prognosis = FeatureTransformer(num_patches=self.n_patches + 1, with_cls=True,
                                                  num_cls_num=self.num_cls_num,
                                                  patch_dim=self.feat_dim,
                                                  num_classes=self.n_classes, dim=self.feat_dim, depth=cfg.feat_depth,
                                                  heads=cfg.feat_heads, mlp_dim=cfg.feat_mlp_dim, dropout=cfg.drop_rate,
-                                                 emb_dropout=cfg.feat_emb_drop_rate, n_outputs=cfg.feat_n_outputs)
+                                                 emb_dropout=cfg.feat_emb_drop_rate, n_outputs=cfg.feat_n_outputs,
+                                                 checkpoint=self.checkpoint_transformer,
+                                                 grouped_heads=self.grouped_heads, grid_size=self.img_grid_size,
+                                                 grid_offset=1)
 
         self.use_tensorboard = False
         if self.use_tensorboard:
@@ -178,16 +221,21 @@ class CLIMAT(nn.Module):
         print(f'PN weights:\n{_pn_weights}')
 
     def configure_crits(self):
+        gamma = self.cfg.focal.gamma if hasattr(self.cfg, "focal") else 2.0
         self.crit_pn = create_loss(loss_name=self.cfg.loss_name,
                                    normalized=False,
+                                   gamma=gamma,
                                    reduction='mean').to(self.device)
         self.crit_kl = create_loss(loss_name=self.cfg.loss_name,
                                    normalized=False,
+                                   gamma=gamma,
                                    reduction='mean').to(self.device)
 
     def configure_optimizers(self):
-        self.optimizer = torch.optim.Adam(self.parameters(), lr=self.cfg['lr'],
+        params = [p for p in self.parameters() if p.requires_grad]
+        self.optimizer = torch.optim.Adam(params, lr=self.cfg['lr'],
                                           betas=(self.cfg['beta1'], self.cfg['beta2']))
+        self.amp = MixedPrecision(get_precision(self.cfg), self.device)
 
     def has_y0(self):
         return self.cfg.kl_coef > 0
@@ -211,26 +259,36 @@ class CLIMAT(nn.Module):
         meta_features = []
         img_features = None
         for input_type in self.input_data:
-            if input_type.lower() == "img":
+            if input_type.lower() == "img" and "IMG_FT" in input:
+                img_features = self.forward_img_features(input["IMG_FT"])
+            elif input_type.lower() == "img":
                 img_features = self.forward_img(input[input_type.upper()])
-            else:
+            elif not self.fused_metadata or input_type not in self.meta_fields:
                 _ft = getattr(self, f"{input_type.lower()}_ft")(input[input_type.upper()])
                 _ft = torch.unsqueeze(_ft, 1)
                 _ft = self.dropout_between(_ft)
                 meta_features.append(_ft)
 
+        if self.fused_metadata and len(self.meta_fields) > 0:
+            if "META_CODES" in input:
+                codes = input["META_CODES"]
+            else:
+                codes = self.meta_encoder.codes_from_onehots([input[name] for name in self.meta_fields])
+            meta_features = [self.dropout_between(self.meta_encoder(codes))]
+
         preds, kl_preds, d_attn, f_attn, p_attn = self.predict_prognosis(img_features, meta_features)
 
         # Save image, metadata names, and attention map into pkl files
         if self.cfg.save_attn:
-            self.save_attentions(batch_i, root=self.cfg.log_dir, img=input['IMG'] if "IMG" in self.input_data else None,
+            # Inputs of the feature cache hold the image features instead of the images
+            self.save_attentions(batch_i, root=self.cfg.log_dir, img=input['IMG'] if "IMG" in input else None,
                                  metadata_names=self.input_data, diags=kl_preds,
                                  d_attn=d_attn, f_attn=f_attn, p_attn=p_attn, preds=preds, targets=target)
 
         return preds, kl_preds
 
     def save_attentions(self, batch_i, root, img, metadata_names, d_attn, f_attn, p_attn, preds, targets, diags):
-        data = {'img': img.to('cpu').detach().numpy(),
+        data = {'img': img.to('cpu').detach().numpy() if img is not None else None,
                 'metadata': metadata_names,
                 'D': d_attn.to('cpu').detach().numpy(),
                 'F': f_attn.to('cpu').detach().numpy(),
@@ -251,29 +309,76 @@ class CLIMAT(nn.Module):
         has_img = img_features is not None
         has_meta = meta_features != []
 
+        grid_size = None
         if has_img:
+            grid_size = tuple(img_features.shape[-2:])
             img_features = rearrange(img_features, 'b c h w -> b (h w) c')
 
-        kl_preds, img_descs, d_attns = self.feat_kl(img_features)
+        kl_preds, img_descs, d_attns = self.feat_kl(img_features, return_attn=self.cfg.save_attn, grid_size=grid_size)
         kl_preds = kl_preds.squeeze(1)
 
+        token_indices = None
+        n_patches = img_descs.shape[1] - 1
+        n_kept_patches = self.get_n_kept_patches(n_patches)
+        if n_kept_patches < n_patches:
+            # The prognosis transformer only attends to the image tokens most relevant to the CLS of feat_kl
+            img_descs, token_indices = select_tokens(img_descs, n_kept_patches)
+
         if has_meta:
             meta_features = torch.cat(meta_features, 1)
             # Apply Fusion transformer
-            _, fusion_features, f_attns = self.feat_fusion(meta_features)
+            _, fusion_features, f_attns = self.feat_fusion(meta_features, return_attn=self.cfg.save_attn)
             meta_features = fusion_features[:, 0:1, :]
 
-            meta_features = meta_features.repeat(1, img_descs.shape[1], 1)
-            meta_features = self.dropout(meta_features)
-            meta_features = torch.cat((img_descs, meta_features), dim=-1)
+            # Without dropout, broadcasting gives the outputs of the concatenation, so it is always used in eval
+            if self.broadcast_fusion or not self.training:
+                shared_features = self.dropout(meta_features)
+                meta_features = img_descs
+            else:
+                shared_features = None
+                meta_features = meta_features.repeat(1, img_descs.shape[1], 1)
+                meta_features = self.dropout(meta_features)
+                meta_features = torch.cat((img_descs, meta_features), dim=-1)
         else:
             meta_features = img_descs
+            shared_features = None
             f_attns = [None]
 
-        preds, _, p_attns = self.feat_prognosis(meta_features)
+        preds, _, p_attns = self.feat_prognosis(meta_features, return_attn=self.cfg.save_attn,
+                                                shared_features=shared_features, token_indices=token_indices,
+                                                grid_size=grid_size)
 
         return preds, kl_preds, d_attns[-1], f_attns[-1], p_attns[-1]
 
+    def get_n_kept_patches(self, n_patches):
+        return min(n_patches, max(1, int(math.ceil(self.token_keep_rate * n_patches))))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints store the metadata layers either fused or per field, whichever was used for training
+        names = [f"{prefix}{name.lower()}_ft" for name in self.meta_fields]
+        if self.fused_metadata and len(names) > 0 and f"{names[0]}.0.weight" in state_dict:
+            state_dict[f"{prefix}meta_encoder.embedding"] = torch.cat(
+                [FusedMetadataEncoder.fuse_linear(state_dict.pop(f"{name}.0.weight"), state_dict.pop(f"{name}.0.bias"))
+                 for name in names], 0)
+            state_dict[f"{prefix}meta_encoder.ln_weight"] = torch.stack(
+                [state_dict.pop(f"{name}.2.weight") for name in names], 0)
+            state_dict[f"{prefix}meta_encoder.ln_bias"] = torch.stack(
+                [state_dict.pop(f"{name}.2.bias") for name in names], 0)
+        elif not self.fused_metadata and len(names) > 0 and f"{prefix}meta_encoder.embedding" in state_dict:
+            embedding = state_dict.pop(f"{prefix}meta_encoder.embedding")
+            ln_weight = state_dict.pop(f"{prefix}meta_encoder.ln_weight")
+            ln_bias = state_dict.pop(f"{prefix}meta_encoder.ln_bias")
+            start = 0
+            for i, name in enumerate(names):
+                n_levels = getattr(self, f"{self.meta_fields[i].lower()}_ft")[0].in_features
+                weight, bias = FusedMetadataEncoder.unfuse_linear(embedding[start:start + n_levels + 1])
+                start += n_levels + 1
+                state_dict[f"{name}.0.weight"] = weight
+                state_dict[f"{name}.0.bias"] = bias
+                state_dict[f"{name}.2.weight"] = ln_weight[i]
+                state_dict[f"{name}.2.bias"] = ln_bias[i]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def create_metadata_layers(self, n_input_dim, n_output_dim):
         return nn.Sequential(
             nn.Linear(n_input_dim, n_output_dim, bias=True),
@@ -281,40 +386,56 @@ class CLIMAT(nn.Module):
             nn.LayerNorm(n_output_dim)
         )
 
+    def forward_backbone(self, x, n_chunks=1):
+        x = x.contiguous(memory_format=self.memory_format)
+        for block in self.blocks:
+            if self.checkpoint_img_blocks and self.training:
+                x = checkpoint_forward(partial(run_block_chunked, block, n_chunks=n_chunks), x, modules=block)
+            else:
+                x = run_block_chunked(block, x, n_chunks=n_chunks)
+            x = self.dropout_between(x)
+        return x
+
+    def project_img_features(self, x):
+        if self.cfg.feat_use:
+            # A view of contiguous memory with channels-last features
+            x = x.permute(0, 2, 3, 1)
+            img_ft = self.img_ft_projection(x)
+            img_ft = self.dropout(img_ft)
+            img_ft = img_ft.permute(0, 3, 1, 2)
+        else:
+            img_ft = self.gap(x)
+            img_ft = img_ft.squeeze(-1).squeeze(-1)
+        return img_ft
+
     def forward_img(self, input):
-        features = []
         if isinstance(input, torch.Tensor):
             input = (input,)
 
-        for x in input:
-            for block in self.blocks:
-                if isinstance(block, list) or isinstance(block, tuple):
-                    for sub_block in block:
-                        x = sub_block(x)
-                else:
-                    x = block(x)
-                x = self.dropout_between(x)
-
-            if self.cfg.feat_use:
-                x = x.permute(0, 2, 3, 1)
-                img_ft = self.img_ft_projection(x)
-                img_ft = self.dropout(img_ft)
-                img_ft = img_ft.permute(0, 3, 1, 2)
-            else:
-                img_ft = self.gap(x)
-                img_ft = img_ft.squeeze(-1).squeeze(-1)
-            features.append(img_ft)
+        # All images go through the backbone in one batch, with the batch norm statistics of each image
+        n_imgs = len(input)
+        x = input[0] if n_imgs == 1 else torch.cat(input, 0)
+        x = self.forward_backbone(x, n_chunks=n_imgs)
+        features = self.project_img_features(x)
 
-        features = torch.cat(features, 1)
+        features = torch.cat(features.chunk(n_imgs, 0), 1)
         return features
 
-    def fit(self, input, target, batch_i, n_iters, epoch_i, stage="train"):
+    def forward_img_features(self, x):
+        # Cached features are extracted without dropout, so only the dropout after the last block applies
+        x = self.dropout_between(x.to(self.device))
+        return self.project_img_features(x)
+
+    def fit(self, input, target, batch_i, n_iters, epoch_i, stage="train", zero_grad=True, step=True):
         grading_mask = target[f'current_{self.cfg.grading}_mask']
 
         pn_target = target['prognosis']
         pn_masks = target['prognosis_mask']
 
-        preds, kl_preds = self.forward(input, batch_i, target)
+        with self.amp.autocast():
+            preds, kl_preds = self.forward(input, batch_i, target)
+        # Losses and metrics are computed in fp32
+        preds, kl_preds = preds.float(), kl_preds.float()
 
         outputs = {'pn': {'prob': [], 'label': []}}
 
@@ -334,36 +455,35 @@ class CLIMAT(nn.Module):
                     self.y0_weights = self.y0_weights.to(self.alpha_power_y0.device)
                     y0_pw_weights = self.y0_weights ** self.alpha_power_y0
 
-                cur_kl_loss = self.crit_kl(grading_preds_mask, grading_target_mask, alpha=y0_pw_weights)
+                y0_sample_weights = target['sample_weights'][grading_mask] if 'sample_weights' in target else None
+                cur_kl_loss = self.crit_kl(grading_preds_mask, grading_target_mask, alpha=y0_pw_weights,
+                                           sample_weight=y0_sample_weights)
+                # Rescale the micro-batch mean to the mean over the whole accumulated batch
+                y0_count = target.get(f'current_{self.cfg.grading}_count')
+                if y0_count is not None:
+                    cur_kl_loss = cur_kl_loss * grading_target_mask.nelement() / max(y0_count, 1)
             else:
                 cur_kl_loss = torch.tensor(0.0, requires_grad=True)
 
         T_max = self.cfg.seq_len
 
-        pn_losses = torch.zeros((T_max), device=self.device)
-        n_t_pn = 0
-
         if self.pn_weights is not None:
             self.pn_weights = self.pn_weights.to(self.alpha_power_pn.device)
 
+        pn_probs = self._compute_probs(preds, to_numpy=True)
+        pn_labels = self._to_numpy(pn_target)
+        pn_masks_np = self._to_numpy(pn_masks)
         for t in range(T_max):
-            pn_logits_mask = preds[pn_masks[:, t], t, :]
-            pn_target_mask = pn_target[pn_masks[:, t], t]
-
-            outputs['pn']['prob'].append(
-                self._compute_probs(pn_logits_mask, to_numpy=True))
-
-            outputs['pn']['label'].append(self._to_numpy(pn_target_mask))
-
-            if self.has_pn() and pn_logits_mask.shape[0] > 0 and pn_target_mask.shape[0] > 0:
-                pn_pw_weights = self.pn_weights[t, :] ** self.alpha_power_pn[t] if self.pn_weights is not None else None
-                pn_loss = self.crit_pn(pn_logits_mask, pn_target_mask, normalized=False, alpha=pn_pw_weights)
+            outputs['pn']['prob'].append(pn_probs[pn_masks_np[:, t], t, :])
+            outputs['pn']['label'].append(pn_labels[pn_masks_np[:, t], t])
 
-                pn_losses[t] = pn_loss
-                n_t_pn += 1
+        n_t_pn = int(pn_masks.any(0).sum()) if self.has_pn() else 0
 
         if n_t_pn > 0:
-            prognosis_loss = pn_losses.sum() / n_t_pn
+            pn_pw_weights = self.pn_weights ** self.alpha_power_pn.unsqueeze(-1) if self.pn_weights is not None else None
+            prognosis_loss = self.crit_pn(preds, pn_target, mask=pn_masks, normalized=False, alpha=pn_pw_weights,
+                                          counts=target.get('prognosis_counts'),
+                                          sample_weight=target.get('sample_weights'))
         else:
             prognosis_loss = torch.tensor(0.0, requires_grad=True)
 
@@ -385,10 +505,10 @@ class CLIMAT(nn.Module):
 
         if stage == "train":
             with torch.autograd.set_detect_anomaly(True):
-                self.optimizer.zero_grad()
-                loss.backward()
-                if self.cfg.clip_norm > 0:
-                    nn.utils.clip_grad_norm_(self.params_main, self.cfg.clip_norm)
-                self.optimizer.step()
+                if zero_grad:
+                    self.optimizer.zero_grad()
+                self.amp.backward(loss)
+                if step:
+                    self.amp.step(self.optimizer, self.parameters(), self.cfg.clip_norm)
 
         return losses, outputs
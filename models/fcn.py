@@ -1,11 +1,14 @@
 import logging
+from functools import partial
 
 import coloredlogs
 import torch
 from torch import nn
 
 from common.losses import create_loss
+from common.precision import MixedPrecision, get_precision
 from models.networks import make_network, get_output_channels
+from models.utils import checkpoint_forward, run_block_chunked, get_output_size, get_memory_format
 
 coloredlogs.install()
 
@@ -59,6 +62,9 @@ class FCN(nn.Module):
 
             self.feature_extractor = make_network(name=cfg.backbone_name, pretrained=cfg.pretrained,
                                                   input_3x3=cfg.input_3x3)
+            # Convolutions of oneDNN and cuDNN are faster on channels-last (NHWC) tensors
+            self.memory_format = get_memory_format(cfg)
+            self.feature_extractor.to(memory_format=self.memory_format)
 
             self.blocks = []
             for i in range(cfg.max_depth):
@@ -68,9 +74,10 @@ class FCN(nn.Module):
                     self.blocks.append([self.feature_extractor.conv1, self.feature_extractor.bn1,
                                         self.feature_extractor.relu, self.feature_extractor.maxpool])
 
-            self.sz_list = [64, 64, 32, 16, 8]  # 256x256
             self.n_last_img_features = get_output_channels(self.blocks[-1], cfg.max_depth)
-            self.n_last_img_ft_size = self.sz_list[cfg.max_depth - 1]
+            # Computed from the backbone, as other input sizes are used with progressive resizing
+            self.img_size = cfg.img_size if hasattr(cfg, "img_size") else 256
+            self.n_last_img_ft_size = get_output_size(self.blocks, self.img_size)[0]
 
             self.n_img_features = cfg.n_img_features
 
@@ -88,6 +95,7 @@ class FCN(nn.Module):
 
         self.dropout = nn.Dropout(p=cfg.drop_rate)
         self.dropout_between = nn.Dropout(cfg.drop_rate_between)
+        self.checkpoint_img_blocks = cfg.checkpoint_img_blocks if hasattr(cfg, "checkpoint_img_blocks") else False
 
         self.n_classes = cfg.n_pr_classes + cfg.n_pn_classes
 
@@ -129,11 +137,13 @@ class FCN(nn.Module):
     def configure_crits(self):
         self.crit_pn = create_loss(loss_name=self.cfg.loss_name,
                                    normalized=False,
+                                   gamma=self.cfg.focal.gamma if hasattr(self.cfg, "focal") else 2.0,
                                    reduction='mean').to(self.device)
 
     def configure_optimizers(self):
         self.optimizer = torch.optim.Adam(self.parameters(), lr=self.cfg['lr'],
                                           betas=(self.cfg['beta1'], self.cfg['beta2']))
+        self.amp = MixedPrecision(get_precision(self.cfg), self.device)
 
     def has_y0(self):
         return self.cfg.kl_coef > 0
@@ -187,9 +197,9 @@ class FCN(nn.Module):
         else:
             raise ValueError(f'Not found image and features.')
 
-        meta_features_seq = meta_features.repeat(1, self.cfg.seq_len, 1)
-        preds = self.fc_progs(meta_features_seq)
-        return preds
+        # All horizons share the input, so the head runs once
+        preds = self.fc_progs(meta_features)
+        return preds.expand(-1, self.cfg.seq_len, -1)
 
     def create_metadata_layers(self, n_input_dim, n_output_dim):
         return nn.Sequential(
@@ -199,60 +209,58 @@ class FCN(nn.Module):
         )
 
     def forward_img(self, input):
-        features = []
         if isinstance(input, torch.Tensor):
             input = (input,)
 
-        for x in input:
-            for block in self.blocks:
-                if isinstance(block, list) or isinstance(block, tuple):
-                    for sub_block in block:
-                        x = sub_block(x)
-                else:
-                    x = block(x)
-                x = self.dropout_between(x)
+        # All images go through the backbone in one batch, with the batch norm statistics of each image
+        n_imgs = len(input)
+        x = input[0] if n_imgs == 1 else torch.cat(input, 0)
+        x = x.contiguous(memory_format=self.memory_format)
+        for block in self.blocks:
+            if self.checkpoint_img_blocks and self.training:
+                x = checkpoint_forward(partial(run_block_chunked, block, n_chunks=n_imgs), x, modules=block)
+            else:
+                x = run_block_chunked(block, x, n_chunks=n_imgs)
+            x = self.dropout_between(x)
 
-            img_ft = self.gap(x)
-            img_ft = img_ft.squeeze(-1).squeeze(-1)
-            features.append(img_ft)
+        img_ft = self.gap(x)
+        img_ft = img_ft.squeeze(-1).squeeze(-1)
 
-        features = torch.cat(features, 1)
+        features = torch.cat(img_ft.chunk(n_imgs, 0), 1)
         return features
 
-    def fit(self, input, target, batch_i, n_iters, epoch_i, stage="train"):
+    def fit(self, input, target, batch_i, n_iters, epoch_i, stage="train", zero_grad=True, step=True):
         pn_target = target['prognosis']
         pn_masks = target['prognosis_mask']
 
-        preds = self.forward(input, batch_i)
+        with self.amp.autocast():
+            preds = self.forward(input, batch_i)
+        # Losses and metrics are computed in fp32
+        preds = preds.float()
 
         outputs = {'pn': {'prob': [], 'label': []}}
 
         T_max = self.cfg.seq_len
 
-        pn_losses = torch.zeros((T_max), device=self.device)
-        n_t_pn = 0
-
         if self.pn_weights is not None:
             self.pn_weights = self.pn_weights.to(self.alpha_power_pn.device)
 
-        for t in range(T_max):
-            pn_logits_mask = preds[pn_masks[:, t], t, self.cfg.n_pr_classes:]
-            pn_target_mask = pn_target[pn_masks[:, t], t]
-
-            outputs['pn']['prob'].append(
-                self._compute_probs(pn_logits_mask, to_numpy=True))
+        pn_logits = preds[:, :, self.cfg.n_pr_classes:]
 
-            outputs['pn']['label'].append(self._to_numpy(pn_target_mask))
-
-            if self.has_pn() and pn_logits_mask.shape[0] > 0 and pn_target_mask.shape[0] > 0:
-                pn_pw_weights = self.pn_weights[t, :] ** self.alpha_power_pn[t] if self.pn_weights is not None else None
-                pn_loss = self.crit_pn(pn_logits_mask, pn_target_mask, normalized=False, alpha=pn_pw_weights)
+        pn_probs = self._compute_probs(pn_logits, to_numpy=True)
+        pn_labels = self._to_numpy(pn_target)
+        pn_masks_np = self._to_numpy(pn_masks)
+        for t in range(T_max):
+            outputs['pn']['prob'].append(pn_probs[pn_masks_np[:, t], t, :])
+            outputs['pn']['label'].append(pn_labels[pn_masks_np[:, t], t])
 
-                pn_losses[t] = pn_loss
-                n_t_pn += 1
+        n_t_pn = int(pn_masks.any(0).sum()) if self.has_pn() else 0
 
         if n_t_pn > 0:
-            prognosis_loss = pn_losses.sum() / n_t_pn
+            pn_pw_weights = self.pn_weights ** self.alpha_power_pn.unsqueeze(-1) if self.pn_weights is not None else None
+            prognosis_loss = self.crit_pn(pn_logits, pn_target, mask=pn_masks, normalized=False, alpha=pn_pw_weights,
+                                          counts=target.get('prognosis_counts'),
+                                          sample_weight=target.get('sample_weights'))
         else:
             prognosis_loss = torch.tensor(0.0, requires_grad=True)
 
@@ -270,10 +278,10 @@ class FCN(nn.Module):
 
         if stage == "train":
             with torch.autograd.set_detect_anomaly(True):
-                self.optimizer.zero_grad()
-                loss.backward()
-                if self.cfg.clip_norm > 0:
-                    nn.utils.clip_grad_norm_(self.params_main, self.cfg.clip_norm)
-                self.optimizer.step()
+                if zero_grad:
+                    self.optimizer.zero_grad()
+                self.amp.backward(loss)
+                if step:
+                    self.amp.step(self.optimizer, self.parameters(), self.cfg.clip_norm)
 
         return losses, outputs
@@ -1,15 +1,29 @@
+import math
+from functools import partial
+
 import torch
-from einops import rearrange
 from torch import nn
 from torch.nn import functional as F
 
+from models.utils import checkpoint_forward
+
+# Fused attention of pytorch>=2.0, which does not return the attention maps
+_HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
 
 class FeatureTransformer(nn.Module):
     def __init__(self, num_patches, patch_dim, num_classes, dim, depth, heads, mlp_dim, num_cls_num=1, with_cls=True,
-                 n_outputs=1, dropout=0., emb_dropout=0.):
+                 n_outputs=1, dropout=0., emb_dropout=0., checkpoint=False, grouped_heads=True, grid_size=None,
+                 grid_offset=0):
         super().__init__()
+        # Patches `grid_offset` to `grid_offset + h * w` form a `(h, w)` grid, whose position embeddings are
+        # interpolated for other grid sizes
+        self.grid_size = tuple(grid_size) if grid_size is not None else None
+        self.grid_offset = grid_offset
         self.patch_dim = patch_dim
         self.n_outputs = n_outputs
+        self.num_cls_num = num_cls_num
+        self.grouped_heads = grouped_heads
         self.with_cls = with_cls
         if self.with_cls:
             self.cls_token = nn.Parameter(torch.randn(1, num_cls_num, dim))
@@ -19,44 +33,159 @@ class FeatureTransformer(nn.Module):
         self.patch_to_embedding = nn.Linear(self.patch_dim, dim)
         self.dropout = nn.Dropout(emb_dropout)
 
-        self.transformer = Transformer(dim, depth, heads, mlp_dim, dropout)
+        self.transformer = Transformer(dim, depth, heads, mlp_dim, dropout, checkpoint=checkpoint)
 
         self.to_cls_token = nn.Identity()
 
-        for i in range(self.n_outputs):
-            setattr(self, f"mlp_head{i}", nn.Sequential(
-                nn.LayerNorm(dim),
-                nn.Linear(dim, mlp_dim),
-                nn.GELU(),
-                nn.Dropout(dropout),
-                nn.Linear(mlp_dim, num_classes)
-            ))
-
-    def forward(self, features, mask=None):
-        x = self.patch_to_embedding(features)
+        if self.grouped_heads and self.n_outputs > 0:
+            self.mlp_heads = GroupedMLPHeads(self.n_outputs, dim, mlp_dim, num_classes, dropout=dropout)
+        else:
+            for i in range(self.n_outputs):
+                setattr(self, f"mlp_head{i}", nn.Sequential(
+                    nn.LayerNorm(dim),
+                    nn.Linear(dim, mlp_dim),
+                    nn.GELU(),
+                    nn.Dropout(dropout),
+                    nn.Linear(mlp_dim, num_classes)
+                ))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints store the heads either stacked or one module per head, whichever was used for training
+        if self.n_outputs > 0:
+            if self.grouped_heads and f"{prefix}mlp_head0.0.weight" in state_dict:
+                GroupedMLPHeads.stack_state_dict(state_dict, prefix, self.n_outputs)
+            elif not self.grouped_heads and f"{prefix}mlp_heads.fc1_weight" in state_dict:
+                GroupedMLPHeads.unstack_state_dict(state_dict, prefix, self.n_outputs)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def embed_patches(self, features, shared_features=None):
+        if shared_features is None:
+            return self.patch_to_embedding(features)
+        # Same as embedding the concatenation of `features` and `shared_features` repeated over tokens, with the
+        # shared part projected once and added by broadcasting
+        n = features.shape[-1]
+        x = F.linear(features, self.patch_to_embedding.weight[:, :n], self.patch_to_embedding.bias)
+        return x + F.linear(shared_features, self.patch_to_embedding.weight[:, n:])
+
+    def get_embedding(self, grid_size=None):
+        embedding = self.pos_embedding + self.type_embedding
+        if grid_size is None or self.grid_size is None or tuple(grid_size) == self.grid_size:
+            return embedding
+        start = self.num_cls_num + self.grid_offset
+        end = start + self.grid_size[0] * self.grid_size[1]
+        grid = embedding[:, start:end].reshape(1, self.grid_size[0], self.grid_size[1], -1).permute(0, 3, 1, 2)
+        grid = F.interpolate(grid, size=tuple(grid_size), mode='bicubic', align_corners=False)
+        grid = grid.permute(0, 2, 3, 1).flatten(1, 2)
+        return torch.cat((embedding[:, :start], grid, embedding[:, end:]), 1)
+
+    def forward(self, features, mask=None, return_attn=False, shared_features=None, token_indices=None,
+                grid_size=None):
+        """`token_indices` are the `(B, n)` patch positions of the tokens in `features`, when they are a subset, and
+        `grid_size` is the size of the patch grid, when it differs from the one the model was built for."""
+        x = self.embed_patches(features, shared_features)
 
         if self.with_cls:
             cls_tokens = self.cls_token.expand(features.shape[0], -1, -1)
             x = torch.cat((cls_tokens, x), dim=1)
 
-        x += self.pos_embedding + self.type_embedding
+        if token_indices is None:
+            x += self.get_embedding(grid_size)
+        else:
+            embedding = self.get_embedding(grid_size)[0]
+            positions = token_indices + self.num_cls_num
+            if self.with_cls:
+                cls_positions = torch.arange(self.num_cls_num, device=positions.device)
+                positions = torch.cat((cls_positions.expand(positions.shape[0], -1), positions), 1)
+            x += embedding[positions]
         x = self.dropout(x)
 
-        states, attentions = self.transformer(x, mask)
+        states, attentions = self.transformer(x, mask, return_attn=return_attn)
 
         x = self.to_cls_token(states[:, 0:self.n_outputs])
 
-        outputs = []
-        for i in range(self.n_outputs):
-            out = getattr(self, f"mlp_head{i}")(x[:, i])
-            outputs.append(out)
+        if self.grouped_heads and self.n_outputs > 0:
+            outputs = self.mlp_heads(x)
+        else:
+            outputs = []
+            for i in range(self.n_outputs):
+                out = getattr(self, f"mlp_head{i}")(x[:, i])
+                outputs.append(out)
 
-        if len(outputs) > 0:
-            outputs = torch.stack(outputs, dim=1)
+            if len(outputs) > 0:
+                outputs = torch.stack(outputs, dim=1)
 
         return outputs, states, attentions
 
 
+def select_tokens(states, n_keep, n_cls=1):
+    """Keeps the `n_cls` CLS tokens, and the `n_keep` other tokens with the largest dot product with the first CLS.
+
+    Returns the kept tokens in their original order, and their positions in `states`.
+    """
+    cls_tokens, tokens = states[:, :n_cls], states[:, n_cls:]
+    scores = torch.einsum('bd,bnd->bn', cls_tokens[:, 0], tokens)
+    indices = scores.topk(n_keep, dim=1)[1].sort(dim=1)[0]
+    tokens = tokens.gather(1, indices.unsqueeze(-1).expand(-1, -1, tokens.shape[-1]))
+    positions = torch.cat((torch.arange(n_cls, device=indices.device).expand(indices.shape[0], -1),
+                           indices + n_cls), 1)
+    return torch.cat((cls_tokens, tokens), 1), positions
+
+
+class GroupedMLPHeads(nn.Module):
+    """The `LayerNorm -> Linear -> GELU -> Dropout -> Linear` heads of all outputs, with stacked parameters.
+
+    Head `i` is applied to token `i` of the input, and all heads are evaluated with batched matmuls. Parameters are
+    initialized as the per-head modules, in the same order.
+    """
+
+    # Names of the stacked parameters, and the indices of the matching modules in a per-head `nn.Sequential`
+    PARAMS = {'ln_weight': '0.weight', 'ln_bias': '0.bias', 'fc1_weight': '1.weight', 'fc1_bias': '1.bias',
+              'fc2_weight': '4.weight', 'fc2_bias': '4.bias'}
+
+    def __init__(self, n_heads, dim, mlp_dim, num_classes, dropout=0.):
+        super().__init__()
+        self.n_heads = n_heads
+        self.dim = dim
+        self.ln_weight = nn.Parameter(torch.ones(n_heads, dim))
+        self.ln_bias = nn.Parameter(torch.zeros(n_heads, dim))
+        self.fc1_weight = nn.Parameter(torch.empty(n_heads, mlp_dim, dim))
+        self.fc1_bias = nn.Parameter(torch.empty(n_heads, mlp_dim))
+        self.fc2_weight = nn.Parameter(torch.empty(n_heads, num_classes, mlp_dim))
+        self.fc2_bias = nn.Parameter(torch.empty(n_heads, num_classes))
+        self.act = nn.GELU()
+        self.dropout = nn.Dropout(dropout)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        with torch.no_grad():
+            for i in range(self.n_heads):
+                for weight, bias in [(self.fc1_weight, self.fc1_bias), (self.fc2_weight, self.fc2_bias)]:
+                    nn.init.kaiming_uniform_(weight[i], a=math.sqrt(5))
+                    bound = 1 / math.sqrt(weight.shape[-1])
+                    nn.init.uniform_(bias[i], -bound, bound)
+
+    @classmethod
+    def stack_state_dict(cls, state_dict, prefix, n_heads):
+        for name, key in cls.PARAMS.items():
+            state_dict[f"{prefix}mlp_heads.{name}"] = torch.stack(
+                [state_dict.pop(f"{prefix}mlp_head{i}.{key}") for i in range(n_heads)], 0)
+
+    @classmethod
+    def unstack_state_dict(cls, state_dict, prefix, n_heads):
+        for name, key in cls.PARAMS.items():
+            stacked = state_dict.pop(f"{prefix}mlp_heads.{name}")
+            for i in range(n_heads):
+                state_dict[f"{prefix}mlp_head{i}.{key}"] = stacked[i]
+
+    def forward(self, x):
+        # x: (b, n_heads, dim) -> (b, n_heads, num_classes)
+        x = F.layer_norm(x, (self.dim,)) * self.ln_weight + self.ln_bias
+        x = torch.einsum('bhd,hmd->bhm', x, self.fc1_weight) + self.fc1_bias
+        x = self.dropout(self.act(x))
+        x = torch.einsum('bhm,hcm->bhc', x, self.fc2_weight) + self.fc2_bias
+        return x
+
+
 class FeedForward(nn.Module):
     def __init__(self, dim, hidden_dim, dropout=0.):
         super().__init__()
@@ -84,32 +213,41 @@ class Attention(nn.Module):
             nn.Dropout(dropout)
         )
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, return_attn=False):
         b, n, _, h = *x.shape, self.heads
         qkv = self.to_qkv(x)
-        q, k, v = rearrange(qkv, 'b n (qkv h d) -> qkv b h n d', qkv=3, h=h)
-
-        dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
+        # b n (qkv h d) -> qkv b h n d
+        q, k, v = qkv.view(b, n, 3, h, -1).permute(2, 0, 3, 1, 4)
 
         if mask is not None:
             mask = F.pad(mask.flatten(1), (1, 0), value=True)
-            assert mask.shape[-1] == dots.shape[-1], 'mask has incorrect dimensions'
+            assert mask.shape[-1] == n, 'mask has incorrect dimensions'
             mask = mask[:, None, :] * mask[:, :, None]
-            dots.masked_fill_(~mask, float('-inf'))
-            del mask
-
-        attn = dots.softmax(dim=-1)
 
-        out = torch.einsum('bhij,bhjd->bhid', attn, v)
-        out = rearrange(out, 'b h n d -> b n (h d)')
+        if _HAS_SDPA and not return_attn:
+            # The fused kernel scales by the head dim, while the attention of this model scales by the model dim
+            q = q * (self.scale * q.shape[-1] ** 0.5)
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask[:, None] if mask is not None else None)
+            attn = None
+        else:
+            dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
+            if mask is not None:
+                dots.masked_fill_(~mask[:, None], float('-inf'))
+            attn = dots.softmax(dim=-1)
+            out = torch.einsum('bhij,bhjd->bhid', attn, v)
+
+        # b h n d -> b n (h d)
+        out = out.transpose(1, 2).reshape(b, n, -1)
         out = self.to_out(out)
         return out, attn
 
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, mlp_dim, dropout):
+    def __init__(self, dim, depth, heads, mlp_dim, dropout, checkpoint=False):
         super().__init__()
         self.depth = depth
+        # Recompute the activations of each layer during backward instead of storing them
+        self.checkpoint = checkpoint
 
         for d in range(depth):
             setattr(self, f"prenorm_0_{d}", nn.LayerNorm(dim))
@@ -118,16 +256,30 @@ class Transformer(nn.Module):
             setattr(self, f"prenorm_1_{d}", nn.LayerNorm(dim))
             setattr(self, f"ff_{d}", FeedForward(dim, mlp_dim, dropout=dropout))
 
-    def forward(self, x, mask=None):
-        attentions = []
-        for d in range(self.depth):
-            o = getattr(self, f"prenorm_0_{d}")(x)
-            o, attn = getattr(self, f"attn_{d}")(o, mask)
-            attentions.append(attn)
-            x = o + x
+    def forward_layer(self, d, x, mask=None, return_attn=False):
+        o = getattr(self, f"prenorm_0_{d}")(x)
+        o, attn = getattr(self, f"attn_{d}")(o, mask, return_attn=return_attn)
+        x = o + x
+
+        ff = getattr(self, f"prenorm_1_{d}")(x)
+        ff = getattr(self, f"ff_{d}")(ff)
+        x = ff + x
+        return x, attn
 
-            ff = getattr(self, f"prenorm_1_{d}")(x)
-            ff = getattr(self, f"ff_{d}")(ff)
-            x = ff + x
+    def forward_states(self, d, x, mask=None):
+        return self.forward_layer(d, x, mask)[0]
 
-        return x, attentions
\ No newline at end of file
+    def forward(self, x, mask=None, return_attn=False):
+        """Returns the states and, if `return_attn`, the attention maps of each layer, otherwise a list of None."""
+        attentions = []
+        # Attention maps are not kept under checkpointing, so the layers run without it when they are requested
+        use_checkpoint = self.checkpoint and self.training and torch.is_grad_enabled() and not return_attn
+        for d in range(self.depth):
+            if use_checkpoint:
+                x = checkpoint_forward(partial(self.forward_states, d, mask=mask), x)
+                attentions.append(None)
+            else:
+                x, attn = self.forward_layer(d, x, mask, return_attn=return_attn)
+                attentions.append(attn)
+
+        return x, attentions
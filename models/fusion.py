@@ -0,0 +1,100 @@
+import copy
+import logging
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.utils import run_block
+
+
+def create_trunk(blocks):
+    """One `nn.Sequential` of the modules of `blocks`, whose items are modules or lists of modules."""
+    return nn.Sequential(*[m for block in blocks for m in (block if isinstance(block, (list, tuple)) else [block])])
+
+
+def _get_conv_bn_pairs(module):
+    names = list(module._modules.keys())
+    if isinstance(module, nn.Sequential):
+        return list(zip(names, names[1:]))
+    # Outside of sequentials, the data flow is only known from the naming of the ResNet and SENet blocks, where
+    # `bn<k>` is registered after and directly applied to the output of `conv<k>`
+    pairs = []
+    for name in names:
+        bn_name = "bn" + name[len("conv"):]
+        if name.startswith("conv") and bn_name in names and names.index(name) < names.index(bn_name):
+            pairs.append((name, bn_name))
+    return pairs
+
+
+def _fold_batch_norms(module):
+    for child in module.children():
+        _fold_batch_norms(child)
+    for conv_name, bn_name in _get_conv_bn_pairs(module):
+        conv, bn = module._modules[conv_name], module._modules[bn_name]
+        if type(conv) is nn.Conv2d and type(bn) is nn.BatchNorm2d and bn.track_running_stats:
+            module._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+            module._modules[bn_name] = nn.Identity()
+
+
+def fold_batch_norms(module):
+    """Copy of `module` in eval mode, with each batch norm folded into the weights and bias of the preceding
+    convolution, and replaced by an identity."""
+    module = copy.deepcopy(module).eval()
+    _fold_batch_norms(module)
+    return module
+
+
+def get_relative_error(output, reference):
+    return ((output.float() - reference.float()).abs().max() / reference.float().abs().max().clamp_min(1e-6)).item()
+
+
+def optimize_backbone_for_inference(model, jit=False, rtol=1e-3):
+    """Replaces the backbone blocks of `model` with one trunk for inference, whose batch norms are folded into the
+    convolutions.
+
+    The trunk is checked against the original blocks on a random batch, and the original blocks are kept if they
+    differ. The dropout between the blocks is lost, so the model must not be trained afterwards.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model with a `blocks` list, in eval mode.
+    jit : bool, optional
+        Also trace and freeze the trunk, and optimize it with TorchScript, which fuses the convolutions with their
+        activations (pytorch>=1.10). (the default is False)
+    rtol : float, optional
+        Maximum difference from the original outputs, relative to their largest magnitude. (the default is 1e-3)
+
+    Returns
+    -------
+    bool
+        Whether the blocks were replaced.
+    """
+    if not hasattr(model, "blocks"):
+        return False
+    model.eval()
+    memory_format = model.memory_format if hasattr(model, "memory_format") else torch.contiguous_format
+    trunk = fold_batch_norms(create_trunk(model.blocks)).to(memory_format=memory_format)
+
+    n_channels = next(m for m in trunk.modules() if isinstance(m, nn.Conv2d)).in_channels
+    img_size = model.img_size if hasattr(model, "img_size") else 256
+    x = torch.randn(2, n_channels, img_size, img_size, device=model.device).contiguous(memory_format=memory_format)
+    with torch.no_grad():
+        reference = x
+        for block in model.blocks:
+            reference = run_block(block, reference)
+
+        if jit and hasattr(torch.jit, "optimize_for_inference"):
+            trunk = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(trunk, x)))
+        elif jit:
+            logging.warning(f'TorchScript optimization needs pytorch>=1.10, found {torch.__version__}.')
+
+        error = get_relative_error(trunk(x), reference)
+
+    if error > rtol:
+        logging.warning(f'Keep the original backbone, as the fused one differs by {error:.2e} (relative).')
+        return False
+    logging.info(f'Fused the batch norms of the backbone into its convolutions, relative error {error:.2e}.')
+    model.blocks = [trunk]
+    return True
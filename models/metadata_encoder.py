@@ -0,0 +1,62 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+class FusedMetadataEncoder(nn.Module):
+    """Encodes all categorical metadata fields with one embedding gather and a grouped LayerNorm.
+
+    It computes the same features as a `Linear -> ReLU -> LayerNorm` per field on one-hot inputs. The linear
+    layer of a one-hot input selects a column of its weight, so field `f` gets the embedding rows `W_f.T + b_f`,
+    and a row `b_f` for missing values, whose one-hot vectors are all zeros.
+
+    Parameters
+    ----------
+    n_levels : list
+        Number of levels of each field, in the order of the codes.
+    dim : int
+        Output dimension of each field.
+    """
+
+    def __init__(self, n_levels, dim):
+        super().__init__()
+        self.n_levels = list(n_levels)
+        self.dim = dim
+        # The last row of each field is its missing value
+        offsets = [0]
+        for n in self.n_levels[:-1]:
+            offsets.append(offsets[-1] + n + 1)
+        self.register_buffer("offsets", torch.tensor(offsets, dtype=torch.int64), persistent=False)
+        self.embedding = nn.Parameter(torch.zeros(sum(self.n_levels) + len(self.n_levels), dim))
+        self.ln_weight = nn.Parameter(torch.ones(len(self.n_levels), dim))
+        self.ln_bias = nn.Parameter(torch.zeros(len(self.n_levels), dim))
+
+    @staticmethod
+    def fuse_linear(weight, bias):
+        """Embedding rows of the levels and the missing value of a field, from its `Linear` parameters."""
+        return torch.cat((weight.t() + bias[None, :], bias[None, :]), 0)
+
+    @staticmethod
+    def unfuse_linear(rows):
+        bias = rows[-1]
+        return (rows[:-1] - bias[None, :]).t(), bias
+
+    def load_layers(self, layers):
+        """Copies the parameters of per-field `Linear -> ReLU -> LayerNorm` modules, in the order of the fields."""
+        with torch.no_grad():
+            self.embedding.copy_(torch.cat([self.fuse_linear(layer[0].weight, layer[0].bias) for layer in layers], 0))
+            self.ln_weight.copy_(torch.stack([layer[2].weight for layer in layers], 0))
+            self.ln_bias.copy_(torch.stack([layer[2].bias for layer in layers], 0))
+
+    def codes_from_onehots(self, onehots):
+        """Codes `(B, n_fields)` of one-hot inputs, with the missing level for all-zero vectors."""
+        codes = [torch.where(x.sum(-1) > 0, x.argmax(-1), torch.full_like(x[:, 0], n, dtype=torch.int64))
+                 for x, n in zip(onehots, self.n_levels)]
+        return torch.stack(codes, 1)
+
+    def forward(self, codes):
+        # (B, n_fields) -> (B, n_fields, dim)
+        x = F.embedding(codes.long() + self.offsets, self.embedding)
+        x = F.relu(x)
+        x = F.layer_norm(x, (self.dim,)) * self.ln_weight + self.ln_bias
+        return x
@@ -1,4 +1,5 @@
 import logging
+from functools import partial
 
 import coloredlogs
 import torch
@@ -6,8 +7,10 @@ from einops import rearrange
 from torch import nn
 
 from common.losses import create_loss
+from common.precision import MixedPrecision, get_precision
 from models.feature_transformer import FeatureTransformer
 from models.networks import make_network, get_output_channels
+from models.utils import checkpoint_forward, run_block_chunked, get_output_size, get_memory_format
 
 MIN_NUM_PATCHES = 0
 
@@ -85,6 +88,9 @@ class Multimodal_Transformer(nn.Module):
 
             self.feature_extractor = make_network(name=cfg.backbone_name, pretrained=cfg.pretrained,
                                                   input_3x3=cfg.input_3x3)
+            # Convolutions of oneDNN and cuDNN are faster on channels-last (NHWC) tensors
+            self.memory_format = get_memory_format(cfg)
+            self.feature_extractor.to(memory_format=self.memory_format)
 
             self.blocks = []
             for i in range(cfg.max_depth):
@@ -94,9 +100,10 @@ class Multimodal_Transformer(nn.Module):
                     self.blocks.append([self.feature_extractor.conv1, self.feature_extractor.bn1,
                                         self.feature_extractor.relu, self.feature_extractor.maxpool])
 
-            self.sz_list = [64, 64, 32, 16, 8]  # 256x256
             self.n_last_img_features = get_output_channels(self.blocks[-1], cfg.max_depth)
-            self.n_last_img_ft_size = self.sz_list[cfg.max_depth - 1]
+            # Computed from the backbone, as other input sizes are used with progressive resizing
+            self.img_size = cfg.img_size if hasattr(cfg, "img_size") else 256
+            self.n_last_img_ft_size = get_output_size(self.blocks, self.img_size)[0]
 
             self.n_img_features = cfg.n_img_features
 
@@ -118,6 +125,9 @@ class Multimodal_Transformer(nn.Module):
 
         self.dropout = nn.Dropout(p=cfg.drop_rate)
         self.dropout_between = nn.Dropout(cfg.drop_rate_between)
+        self.checkpoint_img_blocks = cfg.checkpoint_img_blocks if hasattr(cfg, "checkpoint_img_blocks") else False
+        self.checkpoint_transformer = cfg.checkpoint_transformer if hasattr(cfg, "checkpoint_transformer") else False
+        self.grouped_heads = cfg.grouped_heads if hasattr(cfg, "grouped_heads") else True
 
         # self.feat_patch_dim = cfg.feat_patch_dim
         self.n_classes = cfg.n_pr_classes + cfg.n_pn_classes
@@ -140,13 +150,16 @@ class Multimodal_Transformer(nn.Module):
             self.n_metadata += self.n_img_patches - 1  # Remove current KL (y_0)
 
         self.n_patches = self.n_metadata
+        img_grid_size = (self.n_last_img_ft_size, self.n_last_img_ft_size) if "IMG" in self.input_data else None
 
         self.feat_prognosis = FeatureTransformer(num_patches=self.n_patches, with_cls=True,
                                                  num_cls_num=self.num_cls_num,
                                                  patch_dim=self.feat_dim,
                                                  num_classes=n_out_classes, dim=self.feat_dim, depth=cfg.feat_depth,
                                                  heads=cfg.feat_heads, mlp_dim=cfg.feat_mlp_dim, dropout=cfg.drop_rate,
-                                                 emb_dropout=cfg.feat_emb_drop_rate, n_outputs=cfg.feat_n_outputs)
+                                                 emb_dropout=cfg.feat_emb_drop_rate, n_outputs=cfg.feat_n_outputs,
+                                                 checkpoint=self.checkpoint_transformer,
+                                                 grouped_heads=self.grouped_heads, grid_size=img_grid_size)
 
         self.use_tensorboard = False
         if self.use_tensorboard:
@@ -177,14 +190,21 @@ class Multimodal_Transformer(nn.Module):
         print(f'PN weights:\n{_pn_weights}')
 
     def configure_crits(self):
-        self.crit_pn = create_loss(loss_name=self.cfg.loss_name,
-                                   normalized=False,
-                                   gamma=self.cfg.focal.gamma,
-                                   reduction='mean').to(self.device)
+        if self.use_ordinal_regression:
+            # Focal modulation is kept on top of the cumulative link likelihood when the focal loss is selected
+            self.crit_pn = create_loss(loss_name='CLL',
+                                       gamma=self.cfg.focal.gamma if self.cfg.loss_name == 'FL' else 0.0,
+                                       reduction='mean').to(self.device)
+        else:
+            self.crit_pn = create_loss(loss_name=self.cfg.loss_name,
+                                       normalized=False,
+                                       gamma=self.cfg.focal.gamma,
+                                       reduction='mean').to(self.device)
 
     def configure_optimizers(self):
         self.optimizer = torch.optim.Adam(self.parameters(), lr=self.cfg['lr'],
                                           betas=(self.cfg['beta1'], self.cfg['beta2']))
+        self.amp = MixedPrecision(get_precision(self.cfg), self.device)
 
     def resort_cutpoints(self):
         cutpoints = self.cutpoints.data
@@ -223,6 +243,15 @@ class Multimodal_Transformer(nn.Module):
         return probs
 
     def forward(self, input, batch_i=None):
+        """Class probabilities of the cumulative link model with ordinal regression, else class logits, and the
+        attentions of the last layer."""
+        preds, attns = self.forward_scores(input, batch_i)
+        if self.use_ordinal_regression:
+            preds = self.logistic_cumulative_link(preds)
+        return preds, attns
+
+    def forward_scores(self, input, batch_i=None):
+        """Like `forward`, but with the latent scores of ordinal regression, from which the loss is computed."""
         meta_features = []
         img_features = None
         for input_type in self.input_data:
@@ -246,7 +275,9 @@ class Multimodal_Transformer(nn.Module):
         has_img = img_features is not None
         has_meta = meta_features != []
 
+        grid_size = None
         if has_img:
+            grid_size = tuple(img_features.shape[-2:])
             img_features = rearrange(img_features, 'b c h w -> b (h w) c')
 
         if has_meta:
@@ -256,9 +287,7 @@ class Multimodal_Transformer(nn.Module):
         else:
             meta_features = img_features
 
-        preds, _, p_attns = self.feat_prognosis(meta_features)
-        if self.use_ordinal_regression:
-            preds = self.logistic_cumulative_link(preds)
+        preds, _, p_attns = self.feat_prognosis(meta_features, return_attn=self.cfg.save_attn, grid_size=grid_size)
 
         return preds, p_attns[-1]
 
@@ -270,66 +299,67 @@ class Multimodal_Transformer(nn.Module):
         )
 
     def forward_img(self, input):
-        features = []
         if isinstance(input, torch.Tensor):
             input = (input,)
 
-        for x in input:
-            for block in self.blocks:
-                if isinstance(block, list) or isinstance(block, tuple):
-                    for sub_block in block:
-                        x = sub_block(x)
-                else:
-                    x = block(x)
-                x = self.dropout_between(x)
-
-            if self.cfg.feat_use:
-                x = x.permute(0, 2, 3, 1)
-                img_ft = self.img_ft_projection(x)
-                img_ft = self.dropout(img_ft)
-                img_ft = img_ft.permute(0, 3, 1, 2)
+        # All images go through the backbone in one batch, with the batch norm statistics of each image
+        n_imgs = len(input)
+        x = input[0] if n_imgs == 1 else torch.cat(input, 0)
+        x = x.contiguous(memory_format=self.memory_format)
+        for block in self.blocks:
+            if self.checkpoint_img_blocks and self.training:
+                x = checkpoint_forward(partial(run_block_chunked, block, n_chunks=n_imgs), x, modules=block)
             else:
-                img_ft = self.gap(x)
-                img_ft = img_ft.squeeze(-1).squeeze(-1)
-            features.append(img_ft)
+                x = run_block_chunked(block, x, n_chunks=n_imgs)
+            x = self.dropout_between(x)
+
+        if self.cfg.feat_use:
+            # A view of contiguous memory with channels-last features
+            x = x.permute(0, 2, 3, 1)
+            img_ft = self.img_ft_projection(x)
+            img_ft = self.dropout(img_ft)
+            img_ft = img_ft.permute(0, 3, 1, 2)
+        else:
+            img_ft = self.gap(x)
+            img_ft = img_ft.squeeze(-1).squeeze(-1)
 
-        features = torch.cat(features, 1)
+        features = torch.cat(img_ft.chunk(n_imgs, 0), 1)
         return features
 
-    def fit(self, input, target, batch_i, n_iters, epoch_i, stage="train"):
+    def fit(self, input, target, batch_i, n_iters, epoch_i, stage="train", zero_grad=True, step=True):
         pn_target = target['prognosis']
         pn_masks = target['prognosis_mask']
 
-        preds = self.forward(input, batch_i)
+        with self.amp.autocast():
+            preds, _ = self.forward_scores(input, batch_i)
+        # Losses and metrics are computed in fp32
+        preds = preds.float()
 
         outputs = {'pn': {'prob': [], 'label': []}}
 
         T_max = self.cfg.seq_len
 
-        pn_losses = torch.zeros((T_max), device=self.device)
-        n_t_pn = 0
-
         if self.pn_weights is not None:
             self.pn_weights = self.pn_weights.to(self.alpha_power_pn.device)
 
+        if self.use_ordinal_regression:
+            pn_probs = self._compute_probs(self.logistic_cumulative_link(preds), to_numpy=True, softmax=False)
+        else:
+            pn_probs = self._compute_probs(preds, to_numpy=True)
+        pn_labels = self._to_numpy(pn_target)
+        pn_masks_np = self._to_numpy(pn_masks)
         for t in range(T_max):
-            pn_logits_mask = preds[pn_masks[:, t], t, :]
-            pn_target_mask = pn_target[pn_masks[:, t], t]
-
-            outputs['pn']['prob'].append(
-                self._compute_probs(pn_logits_mask, to_numpy=True, softmax=not self.use_ordinal_regression))
-
-            outputs['pn']['label'].append(self._to_numpy(pn_target_mask))
+            outputs['pn']['prob'].append(pn_probs[pn_masks_np[:, t], t, :])
+            outputs['pn']['label'].append(pn_labels[pn_masks_np[:, t], t])
 
-            if pn_logits_mask.shape[0] > 0 and pn_target_mask.shape[0] > 0:
-                pn_pw_weights = self.pn_weights[t, :] ** self.alpha_power_pn[t] if self.pn_weights is not None else None
-                pn_loss = self.crit_pn(pn_logits_mask, pn_target_mask, normalized=self.use_ordinal_regression,
-                                       alpha=pn_pw_weights)
-                pn_losses[t] = pn_loss
-                n_t_pn += 1
+        n_t_pn = int(pn_masks.any(0).sum())
 
         if n_t_pn > 0:
-            prognosis_loss = pn_losses.sum() / n_t_pn
+            pn_pw_weights = self.pn_weights ** self.alpha_power_pn.unsqueeze(-1) if self.pn_weights is not None else None
+            prognosis_loss = self.crit_pn(preds, pn_target, mask=pn_masks, normalized=False, alpha=pn_pw_weights,
+                                          counts=target.get('prognosis_counts'),
+                                          sample_weight=target.get('sample_weights'),
+                                          cutpoints=self.cutpoints if self.use_ordinal_regression else None)
         else:
             prognosis_loss = torch.tensor(0.0, requires_grad=True)
 
@@ -346,12 +376,12 @@ class Multimodal_Transformer(nn.Module):
 
         if stage == "train":
             with torch.autograd.set_detect_anomaly(True):
-                self.optimizer.zero_grad()
-                loss.backward()
-                if self.cfg.clip_norm > 0:
-                    nn.utils.clip_grad_norm_(self.params_main, self.cfg.clip_norm)
-                self.optimizer.step()
-                if self.use_ordinal_regression:
-                    self.resort_cutpoints()
+                if zero_grad:
+                    self.optimizer.zero_grad()
+                self.amp.backward(loss)
+                if step:
+                    self.amp.step(self.optimizer, self.parameters(), self.cfg.clip_norm)
+                    if self.use_ordinal_regression:
+                        self.resort_cutpoints()
 
         return losses, outputs
@@ -1,11 +1,15 @@
 import logging
 import random
+from functools import partial
 from models.networks import make_network, get_output_channels
+from models.utils import checkpoint_forward, run_block_chunked, get_output_size, get_memory_format
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.optim import Adam
 
 from common.losses import create_loss
+from common.precision import MixedPrecision, get_precision
 
 
 class BiRecurrent_Model(nn.Module):
@@ -23,6 +27,7 @@ class BiRecurrent_Model(nn.Module):
         self.clip_norm = cfg.clip_norm
         self.drop = nn.Dropout(cfg.drop_rate)
         self.dropout_between = nn.Dropout(cfg.drop_rate_between)
+        self.checkpoint_img_blocks = cfg.checkpoint_img_blocks if hasattr(cfg, "checkpoint_img_blocks") else False
 
         if "AGE" in self.input_data:
             self.age_ft = self.create_metadata_layers(4, self.n_meta_features)
@@ -60,6 +65,9 @@ class BiRecurrent_Model(nn.Module):
 
             self.feature_extractor = make_network(name=cfg.backbone_name, pretrained=cfg.pretrained,
                                                   input_3x3=cfg.input_3x3)
+            # Convolutions of oneDNN and cuDNN are faster on channels-last (NHWC) tensors
+            self.memory_format = get_memory_format(cfg)
+            self.feature_extractor.to(memory_format=self.memory_format)
 
             self.blocks = []
             for i in range(cfg.max_depth):
@@ -69,9 +77,10 @@ class BiRecurrent_Model(nn.Module):
                     self.blocks.append([self.feature_extractor.conv1, self.feature_extractor.bn1,
                                         self.feature_extractor.relu, self.feature_extractor.maxpool])
 
-            self.sz_list = [64, 64, 32, 16, 8]  # 256x256
             self.n_last_img_features = get_output_channels(self.blocks[-1], cfg.max_depth)
-            self.n_last_img_ft_size = self.sz_list[cfg.max_depth - 1]
+            # Computed from the backbone, as other input sizes are used with progressive resizing
+            self.img_size = cfg.img_size if hasattr(cfg, "img_size") else 256
+            self.n_last_img_ft_size = get_output_size(self.blocks, self.img_size)[0]
 
             self.n_img_features = cfg.n_img_features
 
@@ -112,12 +121,20 @@ class BiRecurrent_Model(nn.Module):
         else:
             raise ValueError(f'Not support {cfg.rnn_layer}.')
 
+        # Unidirectional single-layer views of each layer and direction of the decoder, which share its parameters.
+        # They are kept out of the module tree, so that they add no parameters or state dict entries. Their own
+        # initialization is discarded, and does not consume the random state
+        with torch.random.fork_rng(devices=[]):
+            self.dec_views = [[self.create_decoder_view(layer_i, suffix) for suffix in ["", "_reverse"]]
+                              for layer_i in range(self.decoder.num_layers)]
+
         self.predict = nn.Linear(cfg.rnn_dim * 2, cfg.n_pn_classes, bias=True)
 
         # Optimizer
         self.optimizer = Adam(self.parameters(), lr=cfg['lr'], betas=(cfg['beta1'], cfg['beta2']))
 
         self.device = device
+        self.amp = MixedPrecision(get_precision(cfg), device)
         self.configure_loss_coefs(cfg)
         self.configure_crits()
         self.to(device)
@@ -125,6 +142,7 @@ class BiRecurrent_Model(nn.Module):
     def configure_crits(self):
         self.crit_pn = create_loss(loss_name=self.cfg.loss_name,
                                    normalized=False,
+                                   gamma=self.cfg.focal.gamma if hasattr(self.cfg, "focal") else 2.0,
                                    reduction='mean').to(self.device)
 
     def configure_loss_coefs(self, cfg):
@@ -148,24 +166,68 @@ class BiRecurrent_Model(nn.Module):
             nn.LayerNorm(n_output_dim)
         )
 
+    def create_decoder_view(self, layer_i, suffix):
+        rnn = nn.LSTM if self.cfg.rnn_layer == 'lstm' else nn.GRU
+        input_size = self.decoder.input_size if layer_i == 0 else 2 * self.decoder.hidden_size
+        view = rnn(input_size, self.decoder.hidden_size, num_layers=1, bias=True, batch_first=True)
+        for name in ["weight_ih", "weight_hh", "bias_ih", "bias_hh"]:
+            setattr(view, f"{name}_l0", getattr(self.decoder, f"{name}_l{layer_i}{suffix}"))
+        # Refreshes the weight list of the fused kernels
+        if hasattr(view, "_flat_weights_names"):
+            view._flat_weights = [getattr(view, name) for name in view._flat_weights_names]
+        return view
+
+    def decode(self, dec_input, dec_state):
+        """Runs the decoder over the inputs `(B, L, 1)` of consecutive steps, as one length-1 call per step would.
+
+        In a length-1 call, both directions of the bidirectional decoder process the step, and each carries its own
+        state to the next call. A sequence call would run the reverse direction backwards in time, so each layer
+        and direction runs as a unidirectional view over the whole sequence instead.
+        """
+        x = self.dec_embedding(dec_input)
+        # A single step is one call of the bidirectional decoder
+        if x.shape[1] == 1:
+            return self.decoder(x, dec_state)
+
+        is_lstm = self.cfg.rnn_layer == 'lstm'
+        dec_h, dec_cell = dec_state if is_lstm else (dec_state, None)
+        hs, cells = [], []
+        for layer_i, views in enumerate(self.dec_views):
+            if layer_i > 0:
+                x = F.dropout(x, self.decoder.dropout, self.training)
+            outs = []
+            for dir_i, view in enumerate(views):
+                k = 2 * layer_i + dir_i
+                if is_lstm:
+                    out, (h, cell) = view(x, (dec_h[k:k + 1].contiguous(), dec_cell[k:k + 1].contiguous()))
+                    cells.append(cell)
+                else:
+                    out, h = view(x, dec_h[k:k + 1].contiguous())
+                hs.append(h)
+                outs.append(out)
+            x = torch.cat(outs, -1)
+
+        dec_state = (torch.cat(hs, 0), torch.cat(cells, 0)) if is_lstm else torch.cat(hs, 0)
+        return x, dec_state
+
     def forward_img(self, input):
-        features = []
         if isinstance(input, torch.Tensor):
             input = (input,)
 
-        for x in input:
-            for block in self.blocks:
-                if isinstance(block, list) or isinstance(block, tuple):
-                    for sub_block in block:
-                        x = sub_block(x)
-                else:
-                    x = block(x)
-                x = self.dropout_between(x)
-            img_ft = self.gap(x)
-            img_ft = img_ft.squeeze(-1).squeeze(-1)
-            features.append(img_ft)
+        # All images go through the backbone in one batch, with the batch norm statistics of each image
+        n_imgs = len(input)
+        x = input[0] if n_imgs == 1 else torch.cat(input, 0)
+        x = x.contiguous(memory_format=self.memory_format)
+        for block in self.blocks:
+            if self.checkpoint_img_blocks and self.training:
+                x = checkpoint_forward(partial(run_block_chunked, block, n_chunks=n_imgs), x, modules=block)
+            else:
+                x = run_block_chunked(block, x, n_chunks=n_imgs)
+            x = self.dropout_between(x)
+        img_ft = self.gap(x)
+        img_ft = img_ft.squeeze(-1).squeeze(-1)
 
-        features = torch.cat(features, 1)
+        features = torch.cat(img_ft.chunk(n_imgs, 0), 1)
         if self.n_img_features > 0:
             features = self.img_ft_projection(features)
         return features
@@ -193,85 +255,77 @@ class BiRecurrent_Model(nn.Module):
             meta_ft.append(img_features)
         meta_ft = torch.cat(meta_ft, dim=-1)
 
-        meta_ft = meta_ft.unsqueeze(1).repeat(1, self.cfg.seq_len, 1)
+        meta_ft = meta_ft.unsqueeze(1).expand(-1, self.cfg.seq_len, -1)
 
-        if self.cfg.rnn_layer == 'lstm':
-            enc_out, (enc_h, enc_cell) = self.encoder(meta_ft)
-            dec_h = enc_h
-            dec_cell = enc_cell
-        elif self.cfg.rnn_layer == 'gru':
-            enc_out, enc_h = self.encoder(meta_ft)
-            dec_h = enc_h
+        # The hidden (and cell) states of the encoder initialize the decoder
+        enc_out, dec_state = self.encoder(meta_ft)
 
         batch_size = meta_ft.shape[0]
 
         dec_input = -1.0 * torch.ones((batch_size, 1), dtype=torch.float32).to(self.device)  # target[:, 0]
 
-        pn_logits_out = []
-
-        for t in range(self.cfg.seq_len):
-            # insert input token embedding, previous hidden and previous cell states
-            # receive output tensor (predictions) and new hidden and cell states
-            dec_input = dec_input.unsqueeze(1)
-            dec_input = self.dec_embedding(dec_input)
+        # Teacher forcing is decided for all steps upfront, in the order of the per-step decisions
+        teacher_force = [random.random() < self.cfg.teacher_forcing_ratio for _ in range(self.cfg.seq_len)]
 
-            if self.cfg.rnn_layer == 'lstm':
-                dec_out, (dec_h, dec_cell) = self.decoder(dec_input, (dec_h, dec_cell))
-            elif self.cfg.rnn_layer == 'gru':
-                dec_out, dec_h = self.decoder(dec_input, dec_h)
-
-            pn_logits = self.predict(dec_out).flatten(1)
-
-            # place predictions in a tensor holding predictions for each token
+        pn_logits_out = []
+        start = 0
+        while start < self.cfg.seq_len:
+            # Steps whose inputs are the targets of the previous steps are decoded in one call, so fully teacher
+            # forced training decodes the whole sequence at once
+            end = start + 1
+            while end < self.cfg.seq_len and teacher_force[end - 1]:
+                end += 1
+            chunk_input = torch.cat((dec_input.unsqueeze(1), target[:, start:end - 1].float()), 1)
+            dec_out, dec_state = self.decode(chunk_input, dec_state)
+
+            pn_logits = self.predict(dec_out)
             pn_logits_out.append(pn_logits)
 
-            # decide if we are going to use teacher forcing or not
-            teacher_force = random.random() < self.cfg.teacher_forcing_ratio
-
-            # get the highest predicted token from our predictions
-            top1 = pn_logits.argmax(1, keepdim=True).float()
-            # top1 = (torch.sigmoid(dec_out) > 0.5).float()
-
             # if teacher forcing, use actual next token as next input
-            # if not, use predicted token
-            dec_input = target[:, t] if teacher_force else top1
+            # if not, use the highest predicted token
+            if teacher_force[end - 1]:
+                dec_input = target[:, end - 1]
+            else:
+                dec_input = pn_logits[:, -1].argmax(-1, keepdim=True).float()
+            start = end
 
-        pn_logits_out = torch.stack(pn_logits_out, 1)
+        pn_logits_out = torch.cat(pn_logits_out, 1)
         return pn_logits_out
 
-    def fit(self, input, target, stage="train", *args, **kwarg):
+    def fit(self, input, target, stage="train", zero_grad=True, step=True, *args, **kwarg):
         pn_target = target['prognosis']
         pn_masks = target['prognosis_mask']
 
-        pn_logits = self.forward(input, pn_target)
+        with self.amp.autocast():
+            pn_logits = self.forward(input, pn_target)
+        # Losses and metrics are computed in fp32
+        pn_logits = pn_logits.float()
 
         outputs = {'pn': {'prob': [], 'label': []}}
 
         T_max = self.cfg.seq_len
-        rec_losses = torch.zeros((T_max), device=pn_target.device)
-        n_t_pn = 0
+        pn_probs = self._compute_probs(pn_logits)
+        pn_labels = self._to_numpy(pn_target)
+        pn_masks_np = self._to_numpy(pn_masks)
         for t in range(T_max):
             # Apply mask
-            logits_masked = pn_logits[pn_masks[:, t], t, :]
-            labels_masked = pn_target[pn_masks[:, t], t, :]
-            outputs['pn']['prob'].append(self._compute_probs(logits_masked))
-            outputs['pn']['label'].append(self._to_numpy(labels_masked))
-            if logits_masked.shape[0] > 0 and labels_masked.shape[0] > 0:
-                rec_loss = self.crit_pn(logits_masked, labels_masked)
-                rec_losses[t] = rec_loss
-                n_t_pn += 1
+            outputs['pn']['prob'].append(pn_probs[pn_masks_np[:, t], t, :])
+            outputs['pn']['label'].append(pn_labels[pn_masks_np[:, t], t, :])
+
+        n_t_pn = int(pn_masks.any(0).sum())
 
         losses = {'loss_y0': -1}
         if n_t_pn > 0:
-            loss = rec_losses.sum() / n_t_pn
+            loss = self.crit_pn(pn_logits, pn_target, mask=pn_masks, counts=target.get('prognosis_counts'),
+                                sample_weight=target.get('sample_weights'))
             losses['loss_pn'] = loss.item()
             losses['loss'] = loss.item()
             if stage == "train":
-                self.optimizer.zero_grad()
-                loss.backward()
-                if self.clip_norm > 0:
-                    nn.utils.clip_grad_norm_(self.parameters(), self.clip_norm)
-                self.optimizer.step()
+                if zero_grad:
+                    self.optimizer.zero_grad()
+                self.amp.backward(loss)
+                if step:
+                    self.amp.step(self.optimizer, self.parameters(), self.clip_norm)
         else:
             losses['loss_pn'] = 0.0
             losses['loss'] = 0.0
@@ -0,0 +1,117 @@
+import inspect
+from contextlib import contextmanager
+
+import torch
+from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+# Non-reentrant checkpointing (pytorch>=1.11) also propagates gradients to parameters when no input requires grad
+_HAS_NON_REENTRANT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+
+def get_memory_format(cfg):
+    """`torch.channels_last` (NHWC strides) for the backbone if `cfg.channels_last`, else the default NCHW format."""
+    if hasattr(cfg, "channels_last") and cfg.channels_last:
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def _as_module_list(block):
+    return list(block) if isinstance(block, (list, tuple)) else [block]
+
+
+@contextmanager
+def preserved_batch_norm_stats(modules):
+    """Restores the running statistics of the batch norm layers of `modules` that update them, on exit."""
+    bns = [m for module in modules for m in module.modules()
+           if isinstance(m, _BatchNorm) and m.training and m.track_running_stats]
+    saved = [(bn.running_mean.clone(), bn.running_var.clone(), bn.num_batches_tracked.clone()) for bn in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for bn, (running_mean, running_var, num_batches_tracked) in zip(bns, saved):
+                bn.running_mean.copy_(running_mean)
+                bn.running_var.copy_(running_var)
+                bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_forward(function, *args, modules=None):
+    """Runs `function` without storing its intermediate activations, which are recomputed during backward.
+
+    The recomputation runs the batch norm layers of `modules` in training mode again, so their running statistics
+    are restored after it, and are updated once per step as without checkpointing.
+    """
+    if modules is not None:
+        n_calls = [0]
+        forward = function
+
+        def function(*inputs):
+            n_calls[0] += 1
+            if n_calls[0] == 1:
+                return forward(*inputs)
+            with preserved_batch_norm_stats(_as_module_list(modules)):
+                return forward(*inputs)
+
+    if _HAS_NON_REENTRANT:
+        return checkpoint(function, *args, use_reentrant=False)
+    if not any([isinstance(arg, torch.Tensor) and arg.requires_grad for arg in args]):
+        return function(*args)
+    return checkpoint(function, *args)
+
+
+def run_block(block, x):
+    if isinstance(block, list) or isinstance(block, tuple):
+        for sub_block in block:
+            x = sub_block(x)
+    else:
+        x = block(x)
+    return x
+
+
+def _chunked_forward(forward, n_chunks):
+    def chunked_forward(x):
+        return torch.cat([forward(chunk) for chunk in x.chunk(n_chunks, 0)], 0)
+    return chunked_forward
+
+
+@contextmanager
+def chunked_batch_norm(modules, n_chunks):
+    """Normalizes each of `n_chunks` equal parts of the batch with its own statistics in the batch norm layers of
+    `modules` that use batch statistics, and updates their running statistics once per part, as separate calls would.
+    """
+    bns = [m for module in modules for m in module.modules()
+           if isinstance(m, _BatchNorm) and (m.training or not m.track_running_stats)] if n_chunks > 1 else []
+    for bn in bns:
+        bn.forward = _chunked_forward(bn.forward, n_chunks)
+    try:
+        yield
+    finally:
+        for bn in bns:
+            del bn.forward
+
+
+def run_block_chunked(block, x, n_chunks=1):
+    """Runs `block` on `n_chunks` inputs concatenated along the batch dimension, see :func:`chunked_batch_norm`."""
+    with chunked_batch_norm(_as_module_list(block), n_chunks):
+        return run_block(block, x)
+
+
+def get_output_size(blocks, img_size, n_channels=None):
+    """Spatial size `(h, w)` of the output of `blocks` for square inputs of `img_size`, from a dummy forward pass.
+    The number of input channels is taken from the first convolution if not given."""
+    modules = [m for block in blocks for m in (block if isinstance(block, (list, tuple)) else [block])]
+    if n_channels is None:
+        n_channels = next(m for module in modules for m in module.modules() if isinstance(m, nn.Conv2d)).in_channels
+    training = [m.training for m in modules]
+    # Eval mode, so that the batch norm statistics are not updated by the dummy input
+    for m in modules:
+        m.eval()
+    with torch.no_grad():
+        x = torch.zeros(1, n_channels, img_size, img_size)
+        for block in blocks:
+            x = run_block(block, x)
+    for m, mode in zip(modules, training):
+        m.train(mode)
+    return tuple(x.shape[-2:])
@@ -0,0 +1,152 @@
+import json
+import logging as log
+import math
+import os
+import queue
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import coloredlogs
+import hydra
+import pandas as pd
+from omegaconf import OmegaConf
+
+from sweep import get_cpu_slots, run_train
+
+coloredlogs.install()
+
+
+def sample_trial(space, rng):
+    """Draws one value per hyperparameter: from a list of choices, or from a `low`/`high` range (`log` scale)."""
+    overrides = {}
+    for name, values in space.items():
+        if isinstance(values, list):
+            overrides[name] = rng.choice(values)
+        elif 'log' in values and values['log']:
+            overrides[name] = math.exp(rng.uniform(math.log(values['low']), math.log(values['high'])))
+        else:
+            overrides[name] = rng.uniform(values['low'], values['high'])
+    return overrides
+
+
+def get_rungs(min_epochs, max_epochs, eta):
+    rungs = [min_epochs]
+    while rungs[-1] * eta <= max_epochs:
+        rungs.append(rungs[-1] * eta)
+    if rungs[-1] < max_epochs:
+        rungs.append(max_epochs)
+    return rungs
+
+
+def read_score(run_dir, search_metric):
+    """Reads the best value of `task/metric` stored by model selection, or None if the trial stored none."""
+    stored_models_fullname = os.path.join(run_dir, "stored_models.json")
+    if not os.path.isfile(stored_models_fullname):
+        return None
+    with open(stored_models_fullname, "r") as f:
+        stored_models = json.load(f)
+    task, metric_name = search_metric.split("/")
+    if not stored_models[task][metric_name]['filename']:
+        return None
+    return stored_models[task][metric_name]['best']
+
+
+def is_minimized(search_metric):
+    metric_name = search_metric.split("/")[-1]
+    return metric_name == "mse" or "loss" in metric_name
+
+
+@hydra.main(config_path="configs", config_name="config_search")
+def main(cfg):
+    wdir = hydra.utils.get_original_cwd()
+    search_dir = os.getcwd()
+    log_dir = os.path.join(search_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    print(cfg.pretty())
+
+    rng = random.Random(cfg.search_seed)
+    space = OmegaConf.to_container(cfg.space, resolve=True)
+    base_overrides = [f"config={cfg.config}", f"site={cfg.site}", f"fold_index={cfg.fold_index}",
+                      f"seed={cfg.seed}", "termination.patience=-1"] + \
+                     list(OmegaConf.to_container(cfg.train_overrides))
+
+    log.info('Preparing caches')
+    if run_train(wdir, base_overrides + ["prepare_only=True", f"hydra.run.dir={os.path.join(search_dir, 'prepare')}"],
+                 os.path.join(log_dir, "prepare.log")) != 0:
+        raise RuntimeError(f'Failed preparing caches, see {log_dir}.')
+
+    trials = []
+    for trial_i in range(cfg.n_trials):
+        name = f"trial-{trial_i:03d}"
+        trials.append({'name': name, 'run_dir': os.path.join(search_dir, "trials", name),
+                       'params': sample_trial(space, rng), 'scores': {}, 'returncode': None})
+
+    cpu_slots = get_cpu_slots(cfg.n_jobs, cfg.cores_per_job)
+    free_slots = queue.Queue()
+    for slot in cpu_slots:
+        free_slots.put(slot)
+
+    def run_trial(trial, n_epochs):
+        # Promoted trials continue from the training state of the previous rung
+        resume = [f"resume={trial['run_dir']}"] if os.path.isdir(trial['run_dir']) else []
+        args = base_overrides + [f"{k}={v}" for k, v in trial['params'].items()] + \
+            [f"n_epochs={n_epochs}", f"hydra.run.dir={trial['run_dir']}"] + resume
+        cores = free_slots.get()
+        try:
+            start = time.time()
+            trial['returncode'] = run_train(wdir, args, os.path.join(log_dir, f"{trial['name']}_{n_epochs}.log"),
+                                            cores=cores)
+        finally:
+            free_slots.put(cores)
+        trial['scores'][n_epochs] = read_score(trial['run_dir'], cfg.search_metric) \
+            if trial['returncode'] == 0 else None
+        log.info(f"{trial['name']} at {n_epochs} epochs: {cfg.search_metric}={trial['scores'][n_epochs]} "
+                 f"({time.time() - start:.0f}s).")
+        return trial
+
+    rungs = get_rungs(cfg.min_epochs, cfg.max_epochs, cfg.eta)
+    minimize = is_minimized(cfg.search_metric)
+    alive = trials
+    log.info(f'Successive halving of {len(trials)} trials over rungs {rungs} on {len(cpu_slots)} slots.')
+    for rung_i, n_epochs in enumerate(rungs):
+        with ThreadPoolExecutor(max_workers=len(cpu_slots)) as executor:
+            alive = list(executor.map(lambda trial: run_trial(trial, n_epochs), alive))
+
+        if rung_i == len(rungs) - 1:
+            break
+        # Failed trials and trials without a stored model are ranked last
+        def rank_key(trial):
+            score = trial['scores'][n_epochs]
+            if score is None:
+                return 1, 0.0
+            return 0, score if minimize else -score
+
+        ranked = sorted(alive, key=rank_key)
+        n_promoted = max(1, int(math.ceil(len(alive) / cfg.eta)))
+        alive = [trial for trial in ranked[:n_promoted] if trial['scores'][n_epochs] is not None]
+        log.info(f"Promote {[trial['name'] for trial in alive]} to {rungs[rung_i + 1]} epochs.")
+        if len(alive) == 0:
+            break
+
+    rows = []
+    for trial in trials:
+        row = {'trial': trial['name'], 'run_dir': trial['run_dir'], 'returncode': trial['returncode']}
+        row.update(trial['params'])
+        for n_epochs in rungs:
+            row[f'{cfg.search_metric}@{n_epochs}'] = trial['scores'].get(n_epochs)
+        rows.append(row)
+    results = pd.DataFrame(rows)
+    results_fullname = os.path.join(search_dir, "results.csv")
+    results.to_csv(results_fullname, index=False)
+    print(f'Write file {results_fullname}')
+
+    finished = [trial for trial in alive if trial['scores'].get(rungs[-1]) is not None]
+    if len(finished) > 0:
+        best = sorted(finished, key=lambda trial: trial['scores'][rungs[-1]], reverse=not minimize)[0]
+        print(f"Best trial {best['name']} with {cfg.search_metric}={best['scores'][rungs[-1]]}: {best['params']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json
+import logging as log
+import os
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import coloredlogs
+import hydra
+import pandas as pd
+from omegaconf import OmegaConf
+
+coloredlogs.install()
+
+
+def get_job_name(site, fold_index, seed):
+    return f"site-{site}_fold-{fold_index}_seed-{seed}"
+
+
+def get_cpu_slots(n_jobs, cores_per_job):
+    """Splits the available cores into `n_jobs` disjoint sets of `cores_per_job` cores."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if n_jobs <= 0:
+        n_jobs = max(1, len(cores) // cores_per_job)
+    if n_jobs * cores_per_job > len(cores):
+        log.warning(f'{n_jobs} jobs x {cores_per_job} cores exceed the {len(cores)} available cores.')
+    return [[cores[(i * cores_per_job + j) % len(cores)] for j in range(cores_per_job)] for i in range(n_jobs)]
+
+
+def run_train(wdir, args, log_fullname, cores=None):
+    env = dict(os.environ)
+    # train.py resolves relative paths and mean_std.npy from PWD
+    env['PWD'] = wdir
+    if cores is not None:
+        for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            env[var] = str(len(cores))
+
+    cmd = [sys.executable, os.path.join(wdir, "train.py")] + args
+    with open(log_fullname, "w") as f:
+        f.write(" ".join(cmd) + "\n")
+        f.flush()
+        proc = subprocess.Popen(cmd, cwd=wdir, env=env, stdout=f, stderr=subprocess.STDOUT)
+        # Pinned right after the start, as `preexec_fn` is not safe with the scheduler threads
+        if cores is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except ProcessLookupError:
+                pass
+        return proc.wait()
+
+
+def collect_results(jobs):
+    rows = []
+    for job in jobs:
+        stored_models_fullname = os.path.join(job['run_dir'], "stored_models.json")
+        if not os.path.isfile(stored_models_fullname):
+            rows.append({'site': job['site'], 'fold': job['fold'], 'seed': job['seed'],
+                         'returncode': job['returncode'], 'task': None, 'metric': None, 'best': None,
+                         'filename': None})
+            continue
+        with open(stored_models_fullname, "r") as f:
+            stored_models = json.load(f)
+        for task in stored_models:
+            for metric_name in stored_models[task]:
+                rows.append({'site': job['site'], 'fold': job['fold'], 'seed': job['seed'],
+                             'returncode': job['returncode'], 'task': task, 'metric': metric_name,
+                             'best': stored_models[task][metric_name]['best'],
+                             'filename': stored_models[task][metric_name]['filename']})
+    return pd.DataFrame(rows)
+
+
+@hydra.main(config_path="configs", config_name="config_sweep")
+def main(cfg):
+    wdir = hydra.utils.get_original_cwd()
+    sweep_dir = os.getcwd()
+    log_dir = os.path.join(sweep_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    print(cfg.pretty())
+
+    train_overrides = [f"config={cfg.config}"] + list(OmegaConf.to_container(cfg.train_overrides))
+
+    # Metadata splits depend on the site and seed only, and mean/std is shared, so build them once before the
+    # jobs start instead of letting concurrent jobs race on the same files
+    for site in cfg.sites:
+        for seed in cfg.seeds:
+            name = f"site-{site}_seed-{seed}"
+            log.info(f'Preparing caches for {name}')
+            returncode = run_train(wdir, train_overrides + [f"site={site}", f"seed={seed}", "prepare_only=True",
+                                                            f"hydra.run.dir={os.path.join(sweep_dir, 'prepare', name)}"],
+                                   os.path.join(log_dir, f"prepare_{name}.log"))
+            if returncode != 0:
+                raise RuntimeError(f'Failed preparing caches for {name}, see {log_dir}.')
+
+    jobs = []
+    for seed in cfg.seeds:
+        for site in cfg.sites:
+            for fold_index in cfg.folds:
+                name = get_job_name(site, fold_index, seed)
+                jobs.append({'name': name, 'site': site, 'fold': fold_index, 'seed': seed,
+                             'run_dir': os.path.join(sweep_dir, "runs", name), 'returncode': None})
+
+    cpu_slots = get_cpu_slots(cfg.n_jobs, cfg.cores_per_job)
+    free_slots = queue.Queue()
+    for slot in cpu_slots:
+        free_slots.put(slot)
+    log.info(f'Running {len(jobs)} jobs on {len(cpu_slots)} slots of {cfg.cores_per_job} cores.')
+
+    def run_job(job):
+        cores = free_slots.get()
+        try:
+            start = time.time()
+            job['returncode'] = run_train(wdir, train_overrides + [f"site={job['site']}",
+                                                                   f"fold_index={job['fold']}",
+                                                                   f"seed={job['seed']}",
+                                                                   f"hydra.run.dir={job['run_dir']}"],
+                                          os.path.join(log_dir, f"{job['name']}.log"), cores=cores)
+            log.info(f"Finished {job['name']} with code {job['returncode']} in {time.time() - start:.0f}s.")
+        finally:
+            free_slots.put(cores)
+        return job
+
+    with ThreadPoolExecutor(max_workers=len(cpu_slots)) as executor:
+        jobs = list(executor.map(run_job, jobs))
+
+    results = collect_results(jobs)
+    results_fullname = os.path.join(sweep_dir, "results.csv")
+    results.to_csv(results_fullname, index=False)
+    print(f'Write file {results_fullname}')
+
+    n_failed = len([job for job in jobs if job['returncode'] != 0])
+    if n_failed > 0:
+        log.warning(f'{n_failed}/{len(jobs)} jobs failed, see {log_dir}.')
+
+    if len(results.index) > 0 and results['best'].notnull().any():
+        summary = results.dropna(subset=['best']).groupby(['task', 'metric'])['best'].agg(['mean', 'std', 'count'])
+        print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+from functools import partial
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+from torch import nn  # noqa: E402
+
+from models.feature_transformer import Transformer  # noqa: E402
+from models.utils import checkpoint_forward, run_block_chunked  # noqa: E402
+
+
+def create_block():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, 3, padding=1, bias=False), nn.BatchNorm2d(8), nn.ReLU(),
+                         nn.Conv2d(8, 8, 3, padding=1, bias=False), nn.BatchNorm2d(8, momentum=None)).train()
+
+
+def run_steps(block, checkpointed, n_chunks=1, n_steps=3):
+    torch.manual_seed(1)
+    for _ in range(n_steps):
+        x = torch.randn(4 * n_chunks, 3, 8, 8, requires_grad=True)
+        function = partial(run_block_chunked, block, n_chunks=n_chunks)
+        y = checkpoint_forward(function, x, modules=block) if checkpointed else function(x)
+        y.sum().backward()
+    return block
+
+
+@pytest.mark.parametrize("n_chunks", [1, 2])
+def test_checkpointing_keeps_batch_norm_stats(n_chunks):
+    reference = run_steps(create_block(), False, n_chunks=n_chunks)
+    checkpointed = run_steps(create_block(), True, n_chunks=n_chunks)
+    for name, buffer in reference.named_buffers():
+        assert torch.allclose(buffer, dict(checkpointed.named_buffers())[name]), name
+    for name, param in reference.named_parameters():
+        assert torch.allclose(param.grad, dict(checkpointed.named_parameters())[name].grad, atol=1e-6), name
+
+
+def test_checkpointed_transformer_returns_requested_attentions():
+    torch.manual_seed(0)
+    transformer = Transformer(dim=16, depth=2, heads=2, mlp_dim=32, dropout=0.0, checkpoint=True).train()
+    x = torch.randn(2, 5, 16, requires_grad=True)
+    _, attentions = transformer(x, return_attn=True)
+    assert all(attn is not None and attn.shape == (2, 2, 5, 5) for attn in attentions)
+    _, attentions = transformer(x)
+    assert all(attn is None for attn in attentions)
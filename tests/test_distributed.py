@@ -0,0 +1,41 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import torch.distributed as dist  # noqa: E402
+import torch.multiprocessing as mp  # noqa: E402
+from torch import nn  # noqa: E402
+
+from common.distributed import broadcast_buffers  # noqa: E402
+
+
+def create_block():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4)).train()
+
+
+def run_broadcast_buffers(rank, world_size, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    try:
+        block = create_block()
+        weight = block[0].weight.detach().clone()
+        # Each rank updates the running statistics on its own batch
+        torch.manual_seed(rank + 1)
+        block(torch.randn(2, 3, 8, 8) + rank)
+
+        broadcast_buffers(block)
+
+        # Buffers of rank 0
+        reference = create_block()
+        torch.manual_seed(1)
+        reference(torch.randn(2, 3, 8, 8))
+        for name, buffer in reference.named_buffers():
+            assert torch.equal(dict(block.named_buffers())[name], buffer)
+        assert torch.equal(block[0].weight, weight)
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_broadcast_buffers_copies_running_stats_of_rank_0(tmp_path):
+    mp.spawn(run_broadcast_buffers, args=(2, str(tmp_path / "init")), nprocs=2)
@@ -0,0 +1,51 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+from models.feature_transformer import Attention, FeatureTransformer, select_tokens, _HAS_SDPA  # noqa: E402
+
+
+def create_transformer(patch_dim, num_patches=16):
+    torch.manual_seed(0)
+    return FeatureTransformer(num_patches=num_patches, patch_dim=patch_dim, num_classes=3, dim=16, depth=2, heads=2,
+                              mlp_dim=32, n_outputs=2, dropout=0.1, emb_dropout=0.1).eval()
+
+
+def test_shared_features_match_concatenation():
+    model = create_transformer(patch_dim=12)
+    features, shared = torch.randn(2, 16, 8), torch.randn(2, 1, 4)
+    with torch.no_grad():
+        preds, states, _ = model(torch.cat((features, shared.repeat(1, 16, 1)), -1))
+        shared_preds, shared_states, _ = model(features, shared_features=shared)
+    assert torch.allclose(preds, shared_preds, atol=1e-5)
+    assert torch.allclose(states, shared_states, atol=1e-5)
+
+
+def test_keeping_all_tokens_matches_unreduced():
+    model = create_transformer(patch_dim=8)
+    features = torch.randn(2, 16, 8)
+    with torch.no_grad():
+        preds, states, _ = model(features)
+        kept_states, positions = select_tokens(states, n_keep=16)
+        kept_preds, kept_output_states, _ = model(features, token_indices=positions[:, 1:] - 1)
+    assert torch.equal(kept_states, states)
+    assert torch.equal(positions, torch.arange(17).expand(2, -1))
+    assert torch.allclose(preds, kept_preds, atol=1e-6)
+    assert torch.allclose(states, kept_output_states, atol=1e-6)
+
+
+@pytest.mark.skipif(not _HAS_SDPA, reason="fused attention needs pytorch>=2.0")
+@pytest.mark.parametrize("masked", [False, True])
+def test_fused_attention_matches_reference(masked):
+    torch.manual_seed(0)
+    attention = Attention(dim=16, heads=2).eval()
+    x = torch.randn(2, 6, 16)
+    mask = torch.tensor([[True, True, False, True, False], [True, False, True, True, True]]) if masked else None
+    with torch.no_grad():
+        out, attn = attention(x, mask)
+        reference, reference_attn = attention(x, mask, return_attn=True)
+    assert attn is None and reference_attn is not None
+    # Masked queries attend to nothing, and only the outputs of the others are used
+    valid = torch.nn.functional.pad(mask, (1, 0), value=True) if masked else torch.ones(2, 6, dtype=torch.bool)
+    assert torch.allclose(out[valid], reference[valid], atol=1e-5)
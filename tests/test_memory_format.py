@@ -0,0 +1,26 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.networks import se_resnet50  # noqa: E402
+from models.utils import run_block  # noqa: E402
+
+
+def run_blocks(blocks, x):
+    for block in blocks:
+        x = run_block(block, x)
+    return x
+
+
+def test_channels_last_matches_contiguous():
+    torch.manual_seed(0)
+    net = se_resnet50(pretrained=None).eval()
+    blocks = [net.layer0, net.layer1, net.layer2]
+    n_channels = next(m for m in net.layer0.modules() if isinstance(m, torch.nn.Conv2d)).in_channels
+    x = torch.randn(2, n_channels, 64, 64)
+    with torch.no_grad():
+        reference = run_blocks(blocks, x)
+        net.to(memory_format=torch.channels_last)
+        output = run_blocks(blocks, x.contiguous(memory_format=torch.channels_last))
+    assert output.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(output, reference, rtol=1e-4, atol=1e-5)
@@ -1,19 +1,32 @@
+import atexit
+import copy
+import json
 import random
 import logging as log
 import coloredlogs
 import hydra
 import numpy as np
+import pandas as pd
 import torch
+import torch.multiprocessing as mp
 import yaml
 import os
 from omegaconf import OmegaConf
 from sklearn.metrics import roc_auc_score, balanced_accuracy_score, \
     mean_squared_error, cohen_kappa_score
 from tqdm import tqdm
-from common.data import ItemLoader
+from common.checkpoint import CheckpointWriter, BlobStore, TRAINING_STATE_FILENAME, LEGACY_TRAINING_STATE_FILENAME, \
+    get_training_state, load_training_state, snapshot
+from common.data import ItemLoader, LossImportanceSampler, TensorItemLoader, channels_last_collate, default_collate
+from common.distributed import init_distributed, cleanup_distributed, is_main_process, get_rank, get_world_size, \
+    broadcast_module, broadcast_buffers, all_gather_objects
+from common.feature_cache import FeatureCache, CachedFeatureParser, build_feature_cache, get_feature_cache_key, \
+    get_unique_items
+from common.termination import create_termination_controller
 from common.utils import proc_targets, calculate_class_weights, calculate_metric, load_metadata, init_mean_std, \
-    parse_item_progs, store_model, update_max_grades, parse_img, init_transforms
+    parse_item_progs, store_model, update_max_grades, parse_img, init_transforms, get_item_IDs, get_img_size
 from models import create_model
+from models.utils import get_memory_format
 
 coloredlogs.install()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -23,20 +36,35 @@ task2metrics = {'grading': ['ba', 'ka', 'mauc', 'ba.ka'],
                 'pn': ['ba', 'mse', 'mauc', 'loss'],
                 'all': ['loss']}
 
-stored_models = {}
-for task in task_names:
-    stored_models[task] = {}
-    for _name in task2metrics[task]:
-        if _name == "mse" or "loss" in _name:
-            stored_models[task][_name] = {'best': 1000000.0, "filename": ""}
-        else:
-            stored_models[task][_name] = {'best': -1, "filename": ""}
+
+
+def init_stored_models():
+    stored_models = {}
+    for task in task_names:
+        stored_models[task] = {}
+        for _name in task2metrics[task]:
+            if _name == "mse" or "loss" in _name:
+                stored_models[task][_name] = {'best': 1000000.0, "filename": ""}
+            else:
+                stored_models[task][_name] = {'best': -1, "filename": ""}
+    return stored_models
+
+
+stored_models = init_stored_models()
+checkpoint_writer = None
+blob_store = None
 
 
 @hydra.main(config_path="configs", config_name="config_train")
 def main(cfg):
+    global checkpoint_writer, blob_store
     if int(cfg.seed) < 0:
         cfg.seed = random.randint(0, 1000000)
+    distributed = init_distributed(cfg)
+    if distributed:
+        # All ranks must share the seed of rank 0
+        cfg.seed = all_gather_objects(cfg.seed)[0]
+        log.info(f'Rank {get_rank()}/{get_world_size()} joined the process group.')
     torch.manual_seed(cfg.seed)
     np.random.seed(cfg.seed)
     random.seed(cfg.seed)
@@ -47,13 +75,23 @@ def main(cfg):
     if not os.path.isabs(cfg.meta_root):
         cfg.meta_root = os.path.join(wdir, cfg.meta_root)
 
-    if not os.path.isdir(cfg.snapshots):
-        os.makedirs(cfg.snapshots, exist_ok=True)
+    resume_dir = get_resume_dir(cfg)
+    if resume_dir:
+        if len(get_co_train_folds(cfg)) > 0:
+            raise ValueError('Resuming does not support co-training of folds.')
+        # Keep storing into the snapshots of the resumed run, whose stored models are restored below, and write the
+        # run files (args.yaml, stored_models.json, termination.json) next to them
+        cfg.snapshots = os.path.join(resume_dir, cfg.snapshots)
+        os.chdir(resume_dir)
 
-    print(cfg.pretty())
+    if is_main_process():
+        if not os.path.isdir(cfg.snapshots):
+            os.makedirs(cfg.snapshots, exist_ok=True)
 
-    with open("args.yaml", "w") as f:
-        yaml.dump(OmegaConf.to_container(cfg), f, default_flow_style=False)
+        print(cfg.pretty())
+
+        with open("args.yaml", "w") as f:
+            yaml.dump(OmegaConf.to_container(cfg), f, default_flow_style=False)
 
     # Load and split data
     oai_site_folds, oai_meta, oai_meta_test, most_meta = load_metadata(cfg, proc_targets=proc_targets, eval_only=False)
@@ -62,27 +100,301 @@ def main(cfg):
     oai_mean, oai_std = init_mean_std(cfg, wdir, oai_meta, parse_img)
     print(f'Mean: {oai_mean}\nStd: {oai_std}')
 
+    # Only build the metadata split and mean/std caches (e.g. before a sweep)
+    if hasattr(cfg, "prepare_only") and cfg.prepare_only:
+        cleanup_distributed()
+        return
+
     y0_weights, pn_weights, pr_weights = calculate_class_weights(oai_meta, cfg)
 
     oai_meta.describe()
 
+    co_train_folds = get_co_train_folds(cfg)
+    if len(co_train_folds) > 0:
+        if distributed:
+            raise ValueError('Co-training of folds does not support distributed training.')
+        co_train(cfg, co_train_folds, oai_site_folds, oai_mean, oai_std, pn_weights, y0_weights)
+        return
+
     df_train, df_val = oai_site_folds[cfg.fold_index - 1]
     df_train = df_train[df_train['visit_id'] == 0]
     df_val = df_val[df_val['visit_id'] == 0]
 
+    model = create_model(cfg, device, pn_weights=pn_weights, y0_weights=y0_weights)
+    terminator = create_termination_controller(cfg, get_selection_metrics(cfg))
+
+    start_epoch = 0
+    state = None
+    training_state_fullname = os.path.join(cfg.snapshots, TRAINING_STATE_FILENAME)
+    if resume_dir:
+        resume_state_fullname = training_state_fullname
+        if not os.path.isfile(resume_state_fullname):
+            resume_state_fullname = os.path.join(cfg.snapshots, LEGACY_TRAINING_STATE_FILENAME)
+        if not os.path.isfile(resume_state_fullname):
+            raise ValueError(f'Cannot find training state {training_state_fullname} to resume from.')
+        # Ranks draw from their own seeds below
+        state = load_training_state(resume_state_fullname, model, restore_rng=not distributed)
+        start_epoch = state['epoch'] + 1
+        stored_models.update(state['stored_models'])
+        if 'termination' in state:
+            terminator.load_state_dict(state['termination'])
+        log.info(f'Resume {resume_dir} from epoch {start_epoch}.')
+    else:
+        load_pretrained_model(cfg, model)
+
+    transforms = init_transforms(oai_mean, oai_std, img_size=get_img_size(cfg))
+    parse_item_cb = parse_item_progs
+    if hasattr(cfg, "feature_cache") and cfg.feature_cache.enabled:
+        parse_item_cb = create_cached_feature_parser(cfg, wdir, model, [df_train, df_val], oai_mean, oai_std,
+                                                     transforms['eval'])
+
+    loader_cls = get_loader_class(cfg, parse_item_cb)
     loaders = dict()
 
     for stage, df in zip(['train', 'eval'], [df_train, df_val]):
         df['visit'] = df['visit'].astype(int)
         if stage == 'eval' and cfg.use_only_baseline:
             df = df[df['visit_id'] == 0]
-        loaders[f'oai_{stage}'] = ItemLoader(
+        sampler = create_importance_sampler(cfg, df, distributed) if stage == "train" else None
+        loaders[f'oai_{stage}'] = loader_cls(
             meta_data=df, root=cfg.root, batch_size=cfg.bs, num_workers=cfg.num_workers,
-            transform=init_transforms(oai_mean, oai_std)[stage], parser_kwargs=cfg.parser,
-            parse_item_cb=parse_item_progs, shuffle=True if stage == "train" else False, drop_last=False)
-
-    model = create_model(cfg, device, pn_weights=pn_weights, y0_weights=y0_weights)
-
+            transform=transforms[stage], parser_kwargs=cfg.parser, collate_fn=get_collate_fn(cfg),
+            parse_item_cb=parse_item_cb, shuffle=True if stage == "train" and sampler is None else False,
+            drop_last=False, sampler=sampler, distributed=distributed, seed=cfg.seed)
+
+    if state is not None and 'sample_losses' in state and loaders['oai_train'].sampler is not None:
+        loaders['oai_train'].sampler.losses = state['sample_losses']
+
+    if distributed:
+        broadcast_module(model)
+        # Different dropout and augmentation draws on each rank
+        rank_seed = cfg.seed + get_rank() + get_world_size() * start_epoch
+        torch.manual_seed(rank_seed)
+        np.random.seed(rank_seed)
+        random.seed(rank_seed)
+
+    checkpoint_writer = CheckpointWriter()
+    if is_main_process() and (cfg.dedup_snapshots if hasattr(cfg, "dedup_snapshots") else True):
+        blob_store = BlobStore(cfg.snapshots, writer=checkpoint_writer)
+    save_training_state = cfg.save_training_state if hasattr(cfg, "save_training_state") else True
+
+    async_validator = None
+    if hasattr(cfg, "async_eval") and cfg.async_eval:
+        if distributed:
+            raise ValueError('Asynchronous validation does not support distributed training.')
+        async_validator = AsyncValidator(cfg, df_val, oai_mean, oai_std, pn_weights, y0_weights, stored_models)
+
+    # Progressive resizing changes the input size of the training images, while validation keeps `img_size`
+    resizable = "IMG" in cfg.parser.metadata and parse_item_cb is parse_item_progs
+    if resizable:
+        check_img_size_schedule(cfg)
+    train_img_size = get_img_size(cfg)
+
+    stop_reason = None
+    # The training state of an epoch is saved once its validation has updated the stored models, so that a resumed run
+    # never points at stored models that a later validation has replaced
+    pending_states = {}
+    for epoch_i in range(start_epoch, cfg.n_epochs):
+        if resizable:
+            train_img_size = update_train_img_size(cfg, loaders['oai_train'], epoch_i, train_img_size, oai_mean,
+                                                   oai_std)
+        if async_validator is not None:
+            loaders['oai_train'].set_epoch(epoch_i)
+            main_loop(loaders['oai_train'], epoch_i, model, cfg, "train")
+            if save_training_state and is_main_process():
+                # Copied, as the next epoch trains while this one is validated
+                pending_states[epoch_i] = snapshot(get_epoch_state(model, epoch_i, loaders['oai_train'].sampler))
+            # Validation of this epoch runs while the next epoch trains
+            async_validator.submit(epoch_i, model)
+            results = async_validator.poll()
+        else:
+            for stage in ["train", "eval"]:
+            # for stage in ["eval"]:
+                if distributed and stage == "eval":
+                    # All ranks validate the model of rank 0, which stores it, with its batch norm statistics
+                    broadcast_buffers(model)
+                loaders[f'oai_{stage}'].set_epoch(epoch_i)
+                main_loop(loaders[f'oai_{stage}'], epoch_i, model, cfg, stage)
+            if save_training_state and is_main_process():
+                pending_states[epoch_i] = get_epoch_state(model, epoch_i, loaders['oai_train'].sampler)
+            results = [{'epoch': epoch_i, 'stored_models': stored_models}]
+
+        for result in results:
+            reason = end_validated_epoch(result, terminator, pending_states, training_state_fullname)
+            if distributed:
+                # Only rank 0 selects models, so all ranks follow its decision
+                reason = all_gather_objects(reason)[0]
+            if stop_reason is None and reason is not None:
+                stop_reason, stop_epoch_i = reason, result['epoch']
+
+        if stop_reason is not None:
+            break
+
+    if async_validator is not None:
+        # The epochs trained after the one that triggered a stop are still validated and saved
+        for result in async_validator.close():
+            end_validated_epoch(result, terminator, pending_states, training_state_fullname)
+        save_stored_models(stored_models)
+
+    # After the pending validations, so that the recorded best models are final
+    if stop_reason is not None and is_main_process():
+        terminator.write_reason(stop_reason, stop_epoch_i, stored_models)
+
+    checkpoint_writer.close()
+    cleanup_distributed()
+
+
+def get_epoch_state(model, epoch_i, sampler):
+    """Training state after epoch `epoch_i`, without the stored models and termination state, which follow from its
+    validation."""
+    training_state = get_training_state(model, epoch_i, None)
+    if isinstance(sampler, LossImportanceSampler):
+        training_state['sample_losses'] = sampler.losses
+    return training_state
+
+
+def end_validated_epoch(result, terminator, pending_states, training_state_fullname):
+    """Takes the stored models of a validated epoch, saves its training state if pending, and returns the reason to
+    stop after it, or None."""
+    epoch_i = result['epoch']
+    stored_models.update(result['stored_models'])
+    terminator.update(epoch_i, stored_models)
+    if epoch_i in pending_states:
+        training_state = pending_states.pop(epoch_i)
+        training_state['stored_models'] = stored_models
+        training_state['termination'] = terminator.state_dict()
+        checkpoint_writer.save(training_state, training_state_fullname)
+    return terminator.check(epoch_i)
+
+
+class AsyncValidator(object):
+    """Runs the `eval` stage and model selection in a separate process, while training continues.
+
+    Weight snapshots are handed over through shared memory. At most one snapshot waits for validation, so that
+    training blocks instead of running ahead when validation is slower than an epoch of training.
+    """
+
+    def __init__(self, cfg, df_val, oai_mean, oai_std, pn_weights, y0_weights, stored_models):
+        n_threads = cfg.async_eval_threads if hasattr(cfg, "async_eval_threads") and cfg.async_eval_threads > 0 \
+            else max(1, torch.get_num_threads() // 4)
+        # The threads of the validation process are taken from the training process
+        self.n_main_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, self.n_main_threads - n_threads))
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        self.n_pending = 0
+        # Not daemonic, as daemonic processes cannot start the workers of their loader. It is then stopped
+        # explicitly, by `close` or at exit when training fails
+        self.process = ctx.Process(target=validation_worker, name="validation_worker", daemon=False,
+                                   args=(OmegaConf.to_container(cfg, resolve=True), df_val, oai_mean, oai_std,
+                                         pn_weights, y0_weights, copy.deepcopy(stored_models), n_threads,
+                                         self.requests, self.results))
+        self.process.start()
+        atexit.register(self.terminate)
+
+    def submit(self, epoch_i, model):
+        state_dict = snapshot(model.state_dict())
+        for value in state_dict.values():
+            value.share_memory_()
+        self.requests.put((epoch_i, state_dict))
+        self.n_pending += 1
+
+    def poll(self, block=False):
+        """Returns the results of the finished validations, waiting for all pending ones if `block`."""
+        results = []
+        while self.n_pending > 0:
+            if not block and self.results.empty():
+                break
+            result = self.results.get()
+            if 'error' in result:
+                raise RuntimeError(f'Validation process failed: {result["error"]}')
+            self.n_pending -= 1
+            results.append(result)
+        return results
+
+    def close(self):
+        results = self.poll(block=True)
+        self.requests.put(None)
+        self.process.join()
+        atexit.unregister(self.terminate)
+        torch.set_num_threads(self.n_main_threads)
+        return results
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+def validation_worker(cfg_container, df_val, oai_mean, oai_std, pn_weights, y0_weights, initial_stored_models,
+                      n_threads, requests, results):
+    global checkpoint_writer, blob_store
+    try:
+        torch.set_num_threads(n_threads)
+        cfg = OmegaConf.create(cfg_container)
+        stored_models.update(initial_stored_models)
+        checkpoint_writer = CheckpointWriter()
+        if cfg.dedup_snapshots if hasattr(cfg, "dedup_snapshots") else True:
+            blob_store = BlobStore(cfg.snapshots, writer=checkpoint_writer)
+
+        loader = ItemLoader(
+            meta_data=df_val, root=cfg.root, batch_size=cfg.bs, num_workers=cfg.num_workers,
+            transform=init_transforms(oai_mean, oai_std, img_size=get_img_size(cfg))['eval'], parser_kwargs=cfg.parser,
+            parse_item_cb=parse_item_progs, collate_fn=get_collate_fn(cfg), shuffle=False, drop_last=False)
+        model = create_model(cfg, device, pn_weights=pn_weights, y0_weights=y0_weights)
+
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            epoch_i, state_dict = request
+            model.load_state_dict(state_dict, strict=True)
+            del state_dict
+            metrics, _ = main_loop(loader, epoch_i, model, cfg, "eval")
+            # Snapshots of this epoch are on disk before the main process hears about them
+            checkpoint_writer.flush()
+            results.put({'epoch': epoch_i, 'metrics': metrics, 'stored_models': copy.deepcopy(stored_models)})
+        checkpoint_writer.close()
+    except Exception as e:
+        results.put({'error': repr(e)})
+        raise
+
+
+def get_resume_dir(cfg):
+    if not hasattr(cfg, "resume") or not cfg.resume:
+        return ""
+    resume_dir = hydra.utils.to_absolute_path(cfg.resume)
+    if not os.path.isdir(resume_dir):
+        raise ValueError(f'Cannot find run directory {resume_dir} to resume from.')
+    return resume_dir
+
+
+def create_importance_sampler(cfg, df, distributed=False):
+    if not hasattr(cfg, "importance_sampling") or not cfg.importance_sampling.enabled:
+        return None
+    if distributed:
+        raise ValueError('Importance sampling does not support distributed training.')
+    return LossImportanceSampler(get_item_IDs(df), momentum=cfg.importance_sampling.momentum,
+                                 power=cfg.importance_sampling.power, smoothing=cfg.importance_sampling.smoothing,
+                                 seed=cfg.seed)
+
+
+def compute_sample_losses(IDs_by_t, probs_by_t, labels_by_t):
+    """Negative log-likelihood of each item, averaged over its valid horizons."""
+    sums, counts = {}, {}
+    for IDs, probs, labels in zip(IDs_by_t, probs_by_t, labels_by_t):
+        if len(IDs) == 0:
+            continue
+        nll = -np.log(np.take_along_axis(probs, labels.reshape(-1, 1).astype(int), axis=-1).flatten() + 1e-7)
+        for ID, loss in zip(IDs, nll):
+            sums[ID] = sums.get(ID, 0.0) + loss
+            counts[ID] = counts.get(ID, 0) + 1
+    IDs = list(sums.keys())
+    return IDs, [sums[ID] / counts[ID] for ID in IDs]
+
+
+def load_pretrained_model(cfg, model):
     if cfg.pretrained_model and not os.path.exists(cfg.pretrained_model):
         log.fatal(f'Cannot find pretrained model {cfg.pretrained_model}')
         assert False
@@ -93,10 +405,189 @@ def main(cfg):
         except ValueError:
             log.fatal(f'Failed loading {cfg.pretrained_model}')
 
+
+def check_img_size_schedule(cfg):
+    """Raises if `img_size_schedule` does not end at `img_size`, which the model, validation and evaluation use."""
+    final_img_size = get_img_size(cfg, cfg.n_epochs - 1)
+    if final_img_size != get_img_size(cfg):
+        raise ValueError(f'The last size of `img_size_schedule` is {final_img_size}, but `img_size` is '
+                         f'{get_img_size(cfg)}.')
+
+
+def update_train_img_size(cfg, loader, epoch_i, img_size, oai_mean, oai_std):
+    """Switches the training transform to the size of `img_size_schedule` at `epoch_i`, and returns that size."""
+    new_img_size = get_img_size(cfg, epoch_i)
+    if new_img_size != img_size:
+        log.info(f'Train on {new_img_size}x{new_img_size} images from epoch {epoch_i}.')
+        loader.set_transform(init_transforms(oai_mean, oai_std, img_size=new_img_size)['train'])
+    return new_img_size
+
+
+def create_cached_feature_parser(cfg, wdir, model, dfs, oai_mean, oai_std, transform):
+    """Extracts the backbone features of the images of `dfs` once, and returns a parser that reads them instead."""
+    if not hasattr(model, "forward_img_features"):
+        raise ValueError(f'Method {cfg.method_name} does not support the feature cache.')
+    if len(get_co_train_folds(cfg)) > 0 or (hasattr(cfg, "async_eval") and cfg.async_eval):
+        raise ValueError('The feature cache does not support co-training of folds and asynchronous validation.')
+    cache_root = cfg.feature_cache.root if os.path.isabs(cfg.feature_cache.root) \
+        else os.path.join(wdir, cfg.feature_cache.root)
+    IDs = get_item_IDs(get_unique_items(dfs))
+    cache = FeatureCache(cache_root, get_feature_cache_key(cfg, oai_mean, oai_std, IDs))
+    # Other ranks wait for the cache of the main process
+    if is_main_process():
+        build_feature_cache(cfg, model, dfs, parse_item_progs, transform, cache)
+    all_gather_objects(None)
+    return CachedFeatureParser(parse_item_progs, cache)
+
+
+def get_collate_fn(cfg):
+    return channels_last_collate if get_memory_format(cfg) == torch.channels_last else default_collate
+
+
+def get_loader_class(cfg, parse_item_cb):
+    """Keeps whole splits in tensors when `in_memory_data` is set, which needs items without image augmentation."""
+    if not hasattr(cfg, "in_memory_data") or not cfg.in_memory_data:
+        return ItemLoader
+    if "IMG" in cfg.parser.metadata and not isinstance(parse_item_cb, CachedFeatureParser):
+        raise ValueError('In-memory data needs the feature cache when images are in `parser.metadata`.')
+    return TensorItemLoader
+
+
+def get_co_train_folds(cfg):
+    return list(cfg.co_train_folds) if hasattr(cfg, "co_train_folds") and cfg.co_train_folds else []
+
+
+def co_train(cfg, fold_indices, oai_site_folds, oai_mean, oai_std, pn_weights, y0_weights):
+    """Trains the models of several folds on a single stream over the union of their training splits.
+
+    Each batch is loaded once, and each of its samples is routed to the models of the folds whose training split
+    contains it. Every fold has its own model, optimizer, validation loader and stored models in
+    `<snapshots>/fold_<k>`.
+    """
+    global checkpoint_writer, blob_store
+    check_co_train_options(cfg)
+    checkpoint_writer = CheckpointWriter()
+    dedup_snapshots = cfg.dedup_snapshots if hasattr(cfg, "dedup_snapshots") else True
+    save_training_state = cfg.save_training_state if hasattr(cfg, "save_training_state") else True
+
+    transforms = init_transforms(oai_mean, oai_std, img_size=get_img_size(cfg))
+    df_trains, fold_IDs, models, eval_loaders, fold_stored_models, saved_dirs = {}, {}, {}, {}, {}, {}
+    blob_stores = {}
+    for fold_index in fold_indices:
+        df_train, df_val = oai_site_folds[fold_index - 1]
+        df_train = df_train[df_train['visit_id'] == 0].copy()
+        df_val = df_val[df_val['visit_id'] == 0].copy()
+        df_train['visit'] = df_train['visit'].astype(int)
+        df_val['visit'] = df_val['visit'].astype(int)
+
+        df_trains[fold_index] = df_train
+        fold_IDs[fold_index] = set(get_item_IDs(df_train))
+        eval_loaders[fold_index] = ItemLoader(
+            meta_data=df_val, root=cfg.root, batch_size=cfg.bs, num_workers=cfg.num_workers,
+            transform=transforms['eval'], parser_kwargs=cfg.parser, parse_item_cb=parse_item_progs, shuffle=False,
+            collate_fn=get_collate_fn(cfg), drop_last=False, name=f"fold_{fold_index}")
+
+        models[fold_index] = create_model(cfg, device, pn_weights=pn_weights, y0_weights=y0_weights)
+        load_pretrained_model(cfg, models[fold_index])
+        fold_stored_models[fold_index] = init_stored_models()
+        saved_dirs[fold_index] = os.path.join(cfg.snapshots, f"fold_{fold_index}")
+        os.makedirs(saved_dirs[fold_index], exist_ok=True)
+        blob_stores[fold_index] = BlobStore(saved_dirs[fold_index], writer=checkpoint_writer) if dedup_snapshots \
+            else None
+
+    df_union = pd.concat(list(df_trains.values()))
+    df_union = df_union[~pd.Series(get_item_IDs(df_union), index=df_union.index).duplicated().values]
+
+    # Each fold gets about `bs` samples per batch, and one pass over the union is one epoch of every fold
+    n_fold_train = np.mean([len(df.index) for df in df_trains.values()])
+    bs = max(cfg.bs, int(round(cfg.bs * len(df_union.index) / n_fold_train)))
+    log.info(f'Co-training folds {fold_indices} on {len(df_union.index)} samples with batch size {bs}.')
+
+    train_loader = ItemLoader(
+        meta_data=df_union, root=cfg.root, batch_size=bs, num_workers=cfg.num_workers,
+        transform=transforms['train'], parser_kwargs=cfg.parser, parse_item_cb=parse_item_progs, shuffle=True,
+        collate_fn=get_collate_fn(cfg), drop_last=False)
+
+    check_img_size_schedule(cfg)
+    train_img_size = get_img_size(cfg)
     for epoch_i in range(cfg.n_epochs):
-        for stage in ["train", "eval"]:
-        # for stage in ["eval"]:
-            main_loop(loaders[f'oai_{stage}'], epoch_i, model, cfg, stage)
+        train_img_size = update_train_img_size(cfg, train_loader, epoch_i, train_img_size, oai_mean, oai_std)
+        train_loader.set_epoch(epoch_i)
+        co_train_loop(train_loader, epoch_i, models, fold_IDs, cfg)
+        for fold_index in fold_indices:
+            # Model selection stores into the blob store of the fold
+            blob_store = blob_stores[fold_index]
+            main_loop(eval_loaders[fold_index], epoch_i, models[fold_index], cfg, "eval",
+                      stored_models=fold_stored_models[fold_index], saved_dir=saved_dirs[fold_index],
+                      summary_filename=f"stored_models_fold_{fold_index}.json")
+            if save_training_state:
+                checkpoint_writer.save(get_training_state(models[fold_index], epoch_i, fold_stored_models[fold_index]),
+                                       os.path.join(saved_dirs[fold_index], TRAINING_STATE_FILENAME))
+    checkpoint_writer.close()
+
+
+def check_co_train_options(cfg):
+    """Raises for the options that co-training of folds does not support."""
+    unsupported = []
+    if get_grad_accum_steps(cfg) > 1:
+        unsupported.append("grad_accum_steps")
+    terminator = create_termination_controller(cfg, get_selection_metrics(cfg))
+    if terminator.max_seconds > 0 or any(patience >= 0 for patience in terminator.patience.values()):
+        unsupported.append("termination")
+    for name in ["async_eval", "in_memory_data"]:
+        if hasattr(cfg, name) and cfg[name]:
+            unsupported.append(name)
+    for name in ["feature_cache", "importance_sampling"]:
+        if hasattr(cfg, name) and cfg[name].enabled:
+            unsupported.append(f"{name}.enabled")
+    if len(unsupported) > 0:
+        raise ValueError(f'Co-training of folds does not support {", ".join(unsupported)}.')
+
+
+def select_items(data, idx):
+    """Selects the samples `idx` of a (nested) batch of tensors and lists."""
+    if isinstance(data, torch.Tensor):
+        return data[torch.tensor(idx, dtype=torch.int64, device=data.device)]
+    elif isinstance(data, dict):
+        return {key: select_items(value, idx) for key, value in data.items()}
+    elif isinstance(data, list) or isinstance(data, tuple):
+        if len(data) > 0 and isinstance(data[0], torch.Tensor):
+            return [select_items(value, idx) for value in data]
+        return [data[i] for i in idx]
+    else:
+        return data
+
+
+def co_train_loop(loader, epoch_i, models, fold_IDs, cfg):
+    n_iters = len(loader)
+    progress_bar = tqdm(range(n_iters), total=n_iters, desc=f"co-train::{epoch_i}")
+    accumulated_losses = {fold_index: [] for fold_index in models}
+
+    for model in models.values():
+        model.train()
+
+    for batch_i in progress_bar:
+        batch = loader.sample(1)[0]
+        IDs = batch['data']['input']['ID']
+        input, targets = prepare_batch(cfg, batch)
+
+        for fold_index, model in models.items():
+            idx = [i for i, ID in enumerate(IDs) if ID in fold_IDs[fold_index]]
+            if len(idx) == 0:
+                continue
+            if len(idx) < len(IDs):
+                fold_input, fold_targets = select_items(input, idx), select_items(targets, idx)
+            else:
+                fold_input, fold_targets = input, targets
+
+            losses, _ = model.fit(fold_input, fold_targets, batch_i=batch_i, n_iters=n_iters, epoch_i=epoch_i,
+                                  stage="train")
+            if losses['loss'] is not None:
+                accumulated_losses[fold_index].append(losses['loss'])
+
+        display_metrics = {f'loss:{fold_index}': f'{np.array(accumulated_losses[fold_index]).mean():.03f}'
+                           for fold_index in models if len(accumulated_losses[fold_index]) > 0}
+        progress_bar.set_postfix(display_metrics)
 
 
 def whether_update_metrics(batch_i, n_iters):
@@ -125,24 +616,59 @@ def filter_metrics(cfg, metrics):
     return filtered_metrics
 
 
-def model_selection(cfg, filtered_metrics, model, epoch_i):
-    global stored_models
+def get_selection_metrics(cfg):
+    """`(task, metric)` pairs stored by :func:`model_selection`."""
+    metrics = []
+    if check_y0_exists(cfg):
+        metrics.append(('grading', 'ba.ka'))
+    if cfg.prognosis_coef > 0:
+        metrics.extend([('pn', 'ba'), ('pn', 'loss')])
+    metrics.append(('all', 'loss'))
+    return metrics
+
+
+def model_selection(cfg, filtered_metrics, model, epoch_i, stored_models=None, saved_dir=None,
+                    summary_filename="stored_models.json"):
+    if stored_models is None:
+        stored_models = globals()['stored_models']
+    if saved_dir is None:
+        saved_dir = cfg.snapshots
     # y0
     if check_y0_exists(cfg):
         stored_models = store_model(
-            epoch_i, 'grading', "ba.ka", filtered_metrics, stored_models, model, cfg.snapshots, cond="max",
-            mode="scalar")
+            epoch_i, 'grading', "ba.ka", filtered_metrics, stored_models, model, saved_dir, cond="max",
+            mode="scalar", writer=checkpoint_writer, blob_store=blob_store)
 
     # Prognosis
     if cfg.prognosis_coef > 0:
         stored_models = store_model(
-            epoch_i, 'pn', "ba", filtered_metrics, stored_models, model, cfg.snapshots, cond="max",
-            mode=f"{cfg.model_selection_mode}_rev" if cfg.model_selection_mode == "beta" else cfg.model_selection_mode)
+            epoch_i, 'pn', "ba", filtered_metrics, stored_models, model, saved_dir, cond="max",
+            mode=f"{cfg.model_selection_mode}_rev" if cfg.model_selection_mode == "beta" else cfg.model_selection_mode,
+            writer=checkpoint_writer, blob_store=blob_store)
         stored_models = store_model(
-            epoch_i, 'pn', "loss", filtered_metrics, stored_models, model, cfg.snapshots, cond="min", mode="scalar")
+            epoch_i, 'pn', "loss", filtered_metrics, stored_models, model, saved_dir, cond="min", mode="scalar",
+            writer=checkpoint_writer, blob_store=blob_store)
 
     stored_models = store_model(
-        epoch_i, 'all', "loss", filtered_metrics, stored_models, model, cfg.snapshots, cond="min", mode="scalar")
+        epoch_i, 'all', "loss", filtered_metrics, stored_models, model, saved_dir, cond="min", mode="scalar",
+        writer=checkpoint_writer, blob_store=blob_store)
+
+    if blob_store is not None:
+        blob_store.collect_garbage()
+
+    save_stored_models(stored_models, summary_filename)
+
+
+def save_stored_models(stored_models, filename="stored_models.json"):
+    """Writes the best value and snapshot of every selection metric, read back by `sweep.py`."""
+    summary = {}
+    for task in stored_models:
+        summary[task] = {}
+        for metric_name in stored_models[task]:
+            summary[task][metric_name] = {'best': float(stored_models[task][metric_name]['best']),
+                                          'filename': stored_models[task][metric_name]['filename']}
+    with open(filename, "w") as f:
+        json.dump(summary, f, indent=2)
 
 
 def prepare_display_metrics(cfg, display_metrics, metrics_by):
@@ -173,16 +699,141 @@ def get_masked_IDs(cfg, batch, mask_name, t=None):
         return [IDs[i] for i in range(len(IDs)) if batch[mask_name][i, t]]
 
 
-def main_loop(loader, epoch_i, model, cfg, stage="train"):
+def get_grad_accum_steps(cfg):
+    return cfg.grad_accum_steps if hasattr(cfg, "grad_accum_steps") and cfg.grad_accum_steps > 1 else 1
+
+
+def prepare_batch(cfg, batch):
+    # Input
+    input = {}
+    for in_key in batch['data']['input']:
+        if isinstance(batch['data']['input'][in_key], torch.Tensor):
+            input[in_key] = batch['data']['input'][in_key].to(device)
+        else:
+            input[in_key] = batch['data']['input'][in_key]
+
+    for inp in input.values():
+        if isinstance(inp, torch.Tensor):
+            batch_size = inp.shape[0]
+            break
+        elif (isinstance(inp, tuple) or isinstance(inp, list)) and isinstance(inp[0], torch.Tensor):
+            batch_size = inp[0].shape[0]
+            break
+
+    in_seq_len = batch['prognosis'].shape[1]
+
+    input['label_len'] = torch.tensor([in_seq_len] * batch_size, dtype=torch.int32).to(device)
+
+    # Target
+    targets = {}
+    targets[f'current_{cfg.grading}'] = batch[cfg.grading].to(device)
+    targets[f'current_{cfg.grading}_mask'] = batch[f'{cfg.grading}_mask'].to(device)
+    targets['prognosis'] = batch['prognosis'].to(device)
+    targets['prognosis_mask'] = batch['prognosis_mask'].to(device)
+    return input, targets
+
+
+def count_accumulated_targets(cfg, batches):
+    """Counts valid targets over micro-batches, so that their losses sum up to the loss of the whole batch."""
+    pn_counts = torch.stack([batch['prognosis_mask'].sum(0) for batch in batches], 0).sum(0)
+    y0_count = int(sum([batch[f'{cfg.grading}_mask'].sum() for batch in batches]))
+    return {'prognosis_counts': pn_counts.to(device), f'current_{cfg.grading}_count': y0_count}
+
+
+def is_missing_loss(loss):
+    # The models without the current KL output report `loss_y0` as None or -1
+    return loss is None or (not isinstance(loss, torch.Tensor) and loss == -1)
+
+
+def sum_losses(accumulated, losses):
+    """Adds the losses of a micro-batch to `accumulated`, skipping missing ones, which are only kept if no micro-batch
+    has that loss."""
+    for loss_name in losses:
+        if loss_name not in accumulated or is_missing_loss(accumulated[loss_name]):
+            accumulated[loss_name] = losses[loss_name]
+        elif not is_missing_loss(losses[loss_name]):
+            accumulated[loss_name] += losses[loss_name]
+    return accumulated
+
+
+def init_metrics_by(cfg, out_seq_len):
+    metrics_by = {'pn': {}, cfg.grading: {}, 'all': {}}
+    for task in task_names:
+        metrics_by[task] = {}
+        for _name in task2metrics[task]:
+            metrics_by[task][_name] = {i: None for i in range(out_seq_len)}
+    return metrics_by
+
+
+def gather_accumulated_metrics(cfg, accumulated_metrics, has_y0_outputs):
+    """Merges the metrics accumulated by all ranks, in rank order."""
+    gathered = all_gather_objects((accumulated_metrics, has_y0_outputs))
+    merged, has_y0_outputs = gathered[0]
+    for other, other_has_y0_outputs in gathered[1:]:
+        has_y0_outputs = has_y0_outputs or other_has_y0_outputs
+        for key in ['ID', 'loss', 'loss_pn', 'loss_y0']:
+            merged[key].extend(other[key])
+        for task in task_names:
+            for key in merged[task]:
+                for t in range(cfg.seq_len):
+                    merged[task][key][t].extend(other[task][key][t])
+        if isinstance(merged[cfg.grading], dict):
+            for key in merged[cfg.grading]:
+                merged[cfg.grading][key].extend(other[cfg.grading][key])
+    return merged, has_y0_outputs
+
+
+def calculate_metrics_by(cfg, accumulated_metrics, metrics_by, has_y0_outputs):
+    for t in range(cfg.seq_len):
+        # Prognosis
+        metrics_by['pn']['ba'][t] = calculate_metric(balanced_accuracy_score,
+                                                     accumulated_metrics['pn']['label_by'][t],
+                                                     accumulated_metrics['pn']['pred_by'][t])
+        metrics_by['pn']['mauc'][t] = calculate_metric(roc_auc_score,
+                                                       accumulated_metrics['pn']['label_by'][t],
+                                                       accumulated_metrics['pn']['prob_by'][t],
+                                                       average='macro',
+                                                       labels=[i for i in range(cfg.n_pn_classes)],
+                                                       multi_class=cfg.multi_class_mode)
+
+        metrics_by['pn']['mse'][t] = calculate_metric(mean_squared_error,
+                                                      accumulated_metrics['pn']['label_by'][t],
+                                                      accumulated_metrics['pn']['pred_by'][t])
+
+    if has_y0_outputs:
+        metrics_by['grading']['ba'] = calculate_metric(balanced_accuracy_score,
+                                                       accumulated_metrics[cfg.grading]['label'],
+                                                       accumulated_metrics[cfg.grading]['pred'])
+        metrics_by['grading']['ka'] = calculate_metric(cohen_kappa_score,
+                                                       accumulated_metrics[cfg.grading]['label'],
+                                                       accumulated_metrics[cfg.grading]['pred'],
+                                                       weights="quadratic")
+        metrics_by['grading']['mauc'] = calculate_metric(roc_auc_score,
+                                                         accumulated_metrics[cfg.grading]['label'],
+                                                         accumulated_metrics[cfg.grading]['prob'],
+                                                         average='macro',
+                                                         labels=[i for i in range(cfg.n_pn_classes)],
+                                                         multi_class=cfg.multi_class_mode)
+
+    return metrics_by
+
+
+def main_loop(loader, epoch_i, model, cfg, stage="train", stored_models=None, saved_dir=None,
+              summary_filename="stored_models.json"):
     global best_bacc, saved_bacc_model_fullname
     global best_f1, saved_f1_model_fullname
     global best_auc, saved_auc_model_fullname
     global best_ap, saved_ap_model_fullname
     global task_names, task2metrics
-    global stored_models
 
-    n_iters = len(loader)
-    progress_bar = tqdm(range(n_iters), total=n_iters, desc=f"{stage}::{epoch_i}")
+    importance_sampler = loader.sampler if stage == "train" and isinstance(loader.sampler, LossImportanceSampler) \
+        else None
+
+    # Gradients of `n_accum` micro-batches are accumulated before each optimizer step
+    n_accum = get_grad_accum_steps(cfg) if stage == "train" else 1
+    n_batches = len(loader)
+    n_iters = (n_batches + n_accum - 1) // n_accum
+    progress_bar = tqdm(range(n_iters), total=n_iters, desc=f"{stage}::{epoch_i}", disable=not is_main_process())
     accumulated_metrics = {'ID': [], 'loss': [], 'loss_pn': [], 'loss_y0': [], 'pn': None, cfg.grading: None}
     for task in task_names:
         accumulated_metrics[task] = {}
@@ -202,43 +853,59 @@ def main_loop(loader, epoch_i, model, cfg, stage="train"):
 
     final_metrics = {}
     task = 'pn'
+    has_y0_outputs = False
 
     for batch_i in progress_bar:
-        batch = loader.sample(1)[0]
-
-        IDs = batch['data']['input']['ID']
-        accumulated_metrics['ID'].extend(IDs)
-
-        # Input
-        input = {}
-        for in_key in batch['data']['input']:
-            if isinstance(batch['data']['input'][in_key], torch.Tensor):
-                input[in_key] = batch['data']['input'][in_key].to(device)
-            else:
-                input[in_key] = batch['data']['input'][in_key]
-
-        for inp in input.values():
-            if isinstance(inp, torch.Tensor):
-                batch_size = inp.shape[0]
-                break
-            elif (isinstance(inp, tuple) or isinstance(inp, list)) and isinstance(inp[0], torch.Tensor):
-                batch_size = inp[0].shape[0]
-                break
-
-        in_seq_len = batch['prognosis'].shape[1]
+        n_micro = min(n_accum, n_batches - batch_i * n_accum)
+        micro_batches = loader.sample(n_micro)
+        accumulated_counts = count_accumulated_targets(cfg, micro_batches) if n_micro > 1 else {}
 
         out_seq_len = cfg.seq_len
 
-        input['label_len'] = torch.tensor([in_seq_len] * batch_size, dtype=torch.int32).to(device)
-
-        # Target
-        targets = {}
-        targets[f'current_{cfg.grading}'] = batch[cfg.grading].to(device)
-        targets[f'current_{cfg.grading}_mask'] = batch[f'{cfg.grading}_mask'].to(device)
-        targets['prognosis'] = batch['prognosis'].to(device)
-        targets['prognosis_mask'] = batch['prognosis_mask'].to(device)
-
-        losses, outputs = model.fit(input, targets, batch_i=batch_i, n_iters=n_iters, epoch_i=epoch_i, stage=stage)
+        losses = {}
+        has_y0_outputs = False
+        for micro_i, batch in enumerate(micro_batches):
+            IDs = batch['data']['input']['ID']
+            accumulated_metrics['ID'].extend(IDs)
+
+            input, targets = prepare_batch(cfg, batch)
+            targets.update(accumulated_counts)
+            if importance_sampler is not None:
+                # Corrects the bias of drawing high-loss items more often
+                targets['sample_weights'] = torch.from_numpy(importance_sampler.get_weights(IDs)).to(device)
+
+            micro_losses, outputs = model.fit(input, targets, batch_i=batch_i, n_iters=n_iters, epoch_i=epoch_i,
+                                              stage=stage, zero_grad=micro_i == 0, step=micro_i == n_micro - 1)
+            losses = sum_losses(losses, micro_losses)
+
+            if importance_sampler is not None:
+                importance_sampler.update(*compute_sample_losses(
+                    [get_masked_IDs(cfg, batch, 'prognosis_mask', t) for t in range(cfg.seq_len)],
+                    outputs['pn']['prob'], outputs['pn']['label']))
+
+            for t in range(cfg.seq_len):
+                task = 'pn'
+                labels = outputs[task]['label'][t].flatten()
+                preds = np.argmax(outputs[task]['prob'][t], axis=-1)
+                probs = outputs[task]['prob'][t]
+
+                IDs_masked = get_masked_IDs(cfg, batch, 'prognosis_mask', t)
+                accumulated_metrics[task]['ID_by'][t].extend(IDs_masked)
+                accumulated_metrics[task]['softmax_by'][t].append(outputs[task]['prob'][t])
+                accumulated_metrics[task]['pred_by'][t].extend(list(preds))
+                accumulated_metrics[task]['prob_by'][t].extend(list(probs))
+                accumulated_metrics[task]['label_by'][t].extend(list(labels.astype(int)))
+
+            # Current KL
+            if check_y0_exists(cfg) and cfg.grading in outputs:
+                has_y0_outputs = True
+                IDs_masked = get_masked_IDs(cfg, batch, f'{cfg.grading}_mask')
+                accumulated_metrics[cfg.grading]['ID'].extend(IDs_masked)
+                accumulated_metrics[cfg.grading]['pred'].extend(
+                    list(np.argmax(outputs[cfg.grading]['prob'], axis=-1)))
+                accumulated_metrics[cfg.grading]['label'].extend(list(outputs[cfg.grading]['label']))
+                accumulated_metrics[cfg.grading]['softmax'].append(outputs[cfg.grading]['prob'])
+                accumulated_metrics[cfg.grading]['prob'].extend(list(outputs[cfg.grading]['prob']))
 
         # Metrics
         display_metrics = {}
@@ -247,69 +914,14 @@ def main_loop(loader, epoch_i, model, cfg, stage="train"):
                 accumulated_metrics[loss_name].append(losses[loss_name])
                 display_metrics[loss_name] = f'{np.array(accumulated_metrics[loss_name]).mean():.03f}'
 
-        metrics_by = {'pn': {}, cfg.grading: {}, 'all': {}}
-        for task in task_names:
-            metrics_by[task] = {}
-            for _name in task2metrics[task]:
-                metrics_by[task][_name] = {i: None for i in range(out_seq_len)}
+        metrics_by = init_metrics_by(cfg, out_seq_len)
 
         accumulated_metrics['loss_pn'].append(losses['loss_pn'])
         accumulated_metrics['loss_y0'].append(losses['loss_y0'])
         accumulated_metrics['loss'].append(losses['loss'])
 
-        for t in range(cfg.seq_len):
-            task = 'pn'
-            labels = outputs[task]['label'][t].flatten()
-            preds = np.argmax(outputs[task]['prob'][t], axis=-1)
-            probs = outputs[task]['prob'][t]
-
-            IDs_masked = get_masked_IDs(cfg, batch, 'prognosis_mask', t)
-            accumulated_metrics[task]['ID_by'][t].extend(IDs_masked)
-            accumulated_metrics[task]['softmax_by'][t].append(outputs[task]['prob'][t])
-            accumulated_metrics[task]['pred_by'][t].extend(list(preds))
-            accumulated_metrics[task]['prob_by'][t].extend(list(probs))
-            accumulated_metrics[task]['label_by'][t].extend(list(labels.astype(int)))
-
-            if whether_update_metrics(batch_i, n_iters):
-                # Prognosis
-                metrics_by['pn']['ba'][t] = calculate_metric(balanced_accuracy_score,
-                                                             accumulated_metrics['pn']['label_by'][t],
-                                                             accumulated_metrics['pn']['pred_by'][t])
-                metrics_by['pn']['mauc'][t] = calculate_metric(roc_auc_score,
-                                                               accumulated_metrics['pn']['label_by'][t],
-                                                               accumulated_metrics['pn']['prob_by'][t],
-                                                               average='macro',
-                                                               labels=[i for i in range(cfg.n_pn_classes)],
-                                                               multi_class=cfg.multi_class_mode)
-
-                metrics_by['pn']['mse'][t] = calculate_metric(mean_squared_error,
-                                                              accumulated_metrics['pn']['label_by'][t],
-                                                              accumulated_metrics['pn']['pred_by'][t])
-
-        # Current KL
-        if check_y0_exists(cfg) and cfg.grading in outputs:
-            IDs_masked = get_masked_IDs(cfg, batch, f'{cfg.grading}_mask')
-            accumulated_metrics[cfg.grading]['ID'].extend(IDs_masked)
-            accumulated_metrics[cfg.grading]['pred'].extend(list(np.argmax(outputs[cfg.grading]['prob'], axis=-1)))
-            accumulated_metrics[cfg.grading]['label'].extend(list(outputs[cfg.grading]['label']))
-            accumulated_metrics[cfg.grading]['softmax'].append(outputs[cfg.grading]['prob'])
-            accumulated_metrics[cfg.grading]['prob'].extend(list(outputs[cfg.grading]['prob']))
-            if whether_update_metrics(batch_i, n_iters):
-                metrics_by['grading']['ba'] = calculate_metric(balanced_accuracy_score,
-                                                               accumulated_metrics[cfg.grading]['label'],
-                                                               accumulated_metrics[cfg.grading]['pred'])
-                metrics_by['grading']['ka'] = calculate_metric(cohen_kappa_score,
-                                                               accumulated_metrics[cfg.grading]['label'],
-                                                               accumulated_metrics[cfg.grading]['pred'],
-                                                               weights="quadratic")
-                metrics_by['grading']['mauc'] = calculate_metric(roc_auc_score,
-                                                                 accumulated_metrics[cfg.grading]['label'],
-                                                                 accumulated_metrics[cfg.grading]['prob'],
-                                                                 average='macro',
-                                                                 labels=[i for i in range(cfg.n_pn_classes)],
-                                                                 multi_class=cfg.multi_class_mode)
-
         if whether_update_metrics(batch_i, n_iters):
+            metrics_by = calculate_metrics_by(cfg, accumulated_metrics, metrics_by, has_y0_outputs)
             display_metrics = prepare_display_metrics(cfg, display_metrics, metrics_by)
             progress_bar.set_postfix(display_metrics)
 
@@ -317,6 +929,12 @@ def main_loop(loader, epoch_i, model, cfg, stage="train"):
         if batch_i >= n_iters - 1:
             final_metrics = metrics_by
 
+    if get_world_size() > 1:
+        # Metrics over the whole set from the shards of all ranks
+        accumulated_metrics, has_y0_outputs = gather_accumulated_metrics(cfg, accumulated_metrics, has_y0_outputs)
+        final_metrics = calculate_metrics_by(cfg, accumulated_metrics, init_metrics_by(cfg, cfg.seq_len),
+                                             has_y0_outputs)
+
     metrics = {'all': {}}
     for task in task_names:
         metrics[task] = {}
@@ -332,9 +950,10 @@ def main_loop(loader, epoch_i, model, cfg, stage="train"):
     metrics['all']['loss'] = np.array(accumulated_metrics['loss']).mean()
 
     # Store model
-    if stage == "eval" and not cfg.skip_store:
+    if stage == "eval" and not cfg.skip_store and is_main_process():
         filtered_metrics = metrics
-        model_selection(cfg, filtered_metrics, model, epoch_i)
+        model_selection(cfg, filtered_metrics, model, epoch_i, stored_models=stored_models, saved_dir=saved_dir,
+                        summary_filename=summary_filename)
 
     return metrics, accumulated_metrics
 